@@ -0,0 +1,197 @@
+// benchmark_ganadores.js
+// Compara la búsqueda de ganadores de un sorteo de dos formas, sobre ventas sembradas en un esquema temporal:
+//  - recorrido completo: leer todas las ventas y buscar los triples en JS (lo que hacía procesar-ganadores);
+//  - consulta indexada: VENTAS_GANADORAS_SQL (dbQueries.js), la misma que ejecuta getVentasGanadorasFromDB.
+// Se repite para varios tamaños de 'ventas' con la misma cantidad de ventas ganadoras (GANADORAS): el resto
+// de las ventas nunca tiene un número ganador, así la consulta indexada debe mantenerse casi constante
+// mientras el recorrido completo crece con la tabla. El plan que se imprime es el de esa misma consulta.
+//
+// Uso: node benchmark_ganadores.js
+// Variables opcionales: BENCH_TAMANOS (tamaños de 'ventas' separados por coma, "10000,100000" por defecto),
+// BENCH_GANADORAS (ventas ganadoras del sorteo medido, 50 por defecto), BENCH_REPETICIONES (5 por defecto)
+// y BENCH_CONSERVAR=1 para no borrar el esquema al terminar.
+
+const { Pool } = require('pg');
+const dotenv = require('dotenv');
+const { VENTAS_GANADORAS_SQL } = require('./dbQueries');
+dotenv.config();
+
+const pool = new Pool({
+    connectionString: process.env.DATABASE_URL,
+    ssl: {
+        rejectUnauthorized: false
+    }
+});
+
+const ESQUEMA = 'bench_ganadores';
+const TAMANOS = (process.env.BENCH_TAMANOS || '10000,100000').split(',').map(n => parseInt(n, 10)).filter(n => n > 0);
+const REPETICIONES = parseInt(process.env.BENCH_REPETICIONES || '5', 10);
+const GANADORAS = parseInt(process.env.BENCH_GANADORAS || '50', 10);
+const SORTEOS = 120; // Sorteos retenidos; el sorteo medido es el último
+const FECHA_SORTEO = '2025-01-01';
+
+// Resultados del día con el formato de 'resultados_zulia' (tres horas, triples A y B de 3 dígitos)
+const RESULTADOS = [
+    { hora: '12:45 PM', tripleA: '123', tripleB: '456' },
+    { hora: '04:45 PM', tripleA: '789', tripleB: '27' },
+    { hora: '07:05 PM', tripleA: '500', tripleB: '999' }
+];
+const TRIPLES = RESULTADOS.flatMap(r => [r.tripleA, r.tripleB]).map(triple => String(triple).padStart(3, '0'));
+
+/**
+ * Números ganadores en las formas de variantesNumeroVendido (server.js): 3, 4 y 5 dígitos.
+ * @returns {Array<string>}
+ */
+function numerosGanadores() {
+    const numeros = new Set();
+    RESULTADOS.forEach(r => {
+        [r.tripleA, r.tripleB].forEach(triple => {
+            [3, 4, 5].filter(d => d >= String(triple).length).forEach(d => numeros.add(String(triple).padStart(d, '0')));
+        });
+    });
+    return Array.from(numeros);
+}
+
+/**
+ * Recrea 'ventas' y 'ventas_numeros' con la estructura de ensureTablesExist y siembra 'total' ventas
+ * repartidas en SORTEOS sorteos, con 1 a 5 números de 3 dígitos cada una que nunca son ganadores, más
+ * GANADORAS ventas del sorteo medido con un triple ganador cada una.
+ */
+async function sembrarVentas(client, total) {
+    await client.query('DROP TABLE IF EXISTS ventas_numeros, ventas;');
+    await client.query(`
+        CREATE TABLE ventas (
+            id BIGINT PRIMARY KEY,
+            "purchaseDate" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "drawDate" DATE NOT NULL,
+            "drawNumber" INTEGER NOT NULL,
+            "ticketNumber" VARCHAR(255) UNIQUE NOT NULL,
+            "buyerName" VARCHAR(255) NOT NULL,
+            "buyerPhone" VARCHAR(255) NOT NULL,
+            numbers JSONB NOT NULL,
+            "validationStatus" VARCHAR(50) DEFAULT 'Pendiente'
+        );
+    `);
+    await client.query(`
+        CREATE TABLE ventas_numeros (
+            draw_number INTEGER NOT NULL,
+            numero VARCHAR(10) NOT NULL,
+            venta_id BIGINT NOT NULL REFERENCES ventas(id) ON DELETE CASCADE,
+            PRIMARY KEY (draw_number, numero, venta_id)
+        );
+    `);
+    await client.query(`
+        WITH p AS (
+            SELECT array_agg(lpad(i::text, 3, '0')) AS perdedores
+            FROM generate_series(0, 999) AS i
+            WHERE lpad(i::text, 3, '0') <> ALL($4::text[])
+        )
+        INSERT INTO ventas (id, "purchaseDate", "drawDate", "drawNumber", "ticketNumber", "buyerName", "buyerPhone", numbers, "validationStatus")
+        SELECT g, $2::date - ($3::int - 1 - g % $3::int) * INTERVAL '1 day' - INTERVAL '3 hours',
+               $2::date - ($3::int - 1 - g % $3::int), 1000 + g % $3::int, 'T' || lpad(g::text, 8, '0'),
+               'Comprador ' || g, '0414' || lpad(g::text, 7, '0'),
+               (SELECT jsonb_agg(perdedores[1 + (g * 7919 + k * 104729) % array_length(perdedores, 1)])
+                FROM generate_series(1, 1 + g % 5) AS k),
+               'Confirmado'
+        FROM generate_series(1, $1::int) AS g, p;
+    `, [total, FECHA_SORTEO, SORTEOS, TRIPLES]);
+    // Ventas ganadoras del sorteo medido: siempre GANADORAS, sin importar el tamaño de la tabla
+    await client.query(`
+        INSERT INTO ventas (id, "purchaseDate", "drawDate", "drawNumber", "ticketNumber", "buyerName", "buyerPhone", numbers, "validationStatus")
+        SELECT $1::int + g, $2::date - INTERVAL '3 hours', $2::date, 1000 + $3::int - 1, 'G' || lpad(g::text, 8, '0'),
+               'Ganador ' || g, '0424' || lpad(g::text, 7, '0'),
+               jsonb_build_array(($4::text[])[1 + g % array_length($4::text[], 1)], '001'),
+               'Confirmado'
+        FROM generate_series(1, $5::int) AS g;
+    `, [total, FECHA_SORTEO, SORTEOS, TRIPLES, GANADORAS]);
+    await client.query(`
+        INSERT INTO ventas_numeros (draw_number, numero, venta_id)
+        SELECT DISTINCT v."drawNumber", numero, v.id
+        FROM ventas v CROSS JOIN LATERAL jsonb_array_elements_text(v.numbers) AS numero;
+    `);
+    await client.query('ANALYZE ventas; ANALYZE ventas_numeros;');
+}
+
+/**
+ * Forma anterior: todas las ventas retenidas al proceso y búsqueda de los triples por venta en JS.
+ * @returns {Promise<number>} Cantidad de ventas ganadoras.
+ */
+async function ganadoresPorRecorrido(client, drawNumber) {
+    const res = await client.query('SELECT * FROM ventas');
+    let ganadoras = 0;
+    for (const venta of res.rows) {
+        const fechaVenta = venta.drawDate instanceof Date
+            ? `${venta.drawDate.getFullYear()}-${String(venta.drawDate.getMonth() + 1).padStart(2, '0')}-${String(venta.drawDate.getDate()).padStart(2, '0')}`
+            : String(venta.drawDate);
+        if (fechaVenta !== FECHA_SORTEO || venta.drawNumber.toString() !== drawNumber.toString()) continue;
+        const digitosVenta = venta.numbers.length > 0 ? String(venta.numbers[0]).length : 0;
+        const acierta = RESULTADOS.some(r =>
+            [r.tripleA, r.tripleB].some(triple => triple && venta.numbers.includes(String(triple).padStart(digitosVenta, '0')))
+        );
+        if (acierta) ganadoras++;
+    }
+    return ganadoras;
+}
+
+/**
+ * Forma actual: VENTAS_GANADORAS_SQL, la consulta de getVentasGanadorasFromDB (server.js).
+ * @returns {Promise<number>} Cantidad de ventas ganadoras.
+ */
+async function ganadoresPorIndice(client, drawNumber) {
+    const res = await client.query(VENTAS_GANADORAS_SQL, [drawNumber, FECHA_SORTEO, numerosGanadores()]);
+    return res.rows.length;
+}
+
+/**
+ * @returns {Promise<{mediana: number, ganadoras: number}>} Mediana en ms de REPETICIONES ejecuciones.
+ */
+async function medir(fn) {
+    const tiempos = [];
+    let ganadoras = 0;
+    for (let i = 0; i < REPETICIONES; i++) {
+        const inicio = process.hrtime.bigint();
+        ganadoras = await fn();
+        tiempos.push(Number(process.hrtime.bigint() - inicio) / 1e6);
+    }
+    tiempos.sort((a, b) => a - b);
+    return { mediana: tiempos[Math.floor(tiempos.length / 2)], ganadoras };
+}
+
+async function runBenchmark() {
+    const client = await pool.connect();
+    try {
+        await client.query(`DROP SCHEMA IF EXISTS ${ESQUEMA} CASCADE;`);
+        await client.query(`CREATE SCHEMA ${ESQUEMA};`);
+        await client.query(`SET search_path TO ${ESQUEMA};`);
+        const drawNumber = 1000 + SORTEOS - 1;
+
+        console.log(`Ganadores del sorteo ${drawNumber} (${FECHA_SORTEO}), mediana de ${REPETICIONES} ejecuciones:\n`);
+        for (const total of TAMANOS) {
+            await sembrarVentas(client, total);
+            const recorrido = await medir(() => ganadoresPorRecorrido(client, drawNumber));
+            const indice = await medir(() => ganadoresPorIndice(client, drawNumber));
+            if (recorrido.ganadoras !== indice.ganadoras || indice.ganadoras !== GANADORAS) {
+                throw new Error(`Las formas no coinciden: ${recorrido.ganadoras} vs ${indice.ganadoras} ventas ganadoras (se sembraron ${GANADORAS}).`);
+            }
+            const plan = await client.query(
+                `EXPLAIN (ANALYZE, BUFFERS) ${VENTAS_GANADORAS_SQL}`,
+                [drawNumber, FECHA_SORTEO, numerosGanadores()]
+            );
+            console.log(`${total + GANADORAS} ventas, ${indice.ganadoras} ganadoras`);
+            console.log(`  recorrido completo: ${recorrido.mediana.toFixed(2)} ms`);
+            console.log(`  consulta indexada:  ${indice.mediana.toFixed(2)} ms`);
+            console.log(plan.rows.map(row => `    ${row['QUERY PLAN']}`).join('\n') + '\n');
+        }
+    } catch (err) {
+        console.error('Error durante el benchmark de ganadores:', err);
+        process.exitCode = 1;
+    } finally {
+        if (process.env.BENCH_CONSERVAR !== '1') {
+            await client.query(`DROP SCHEMA IF EXISTS ${ESQUEMA} CASCADE;`).catch(() => {});
+        }
+        client.release();
+        await pool.end();
+    }
+}
+
+runBenchmark();
@@ -0,0 +1,239 @@
+// benchmark_indices.js
+// Mide el plan y la latencia de las consultas de ventas, ganadores, premios y resultados_zulia antes y
+// después de crear los índices de dbIndexes.js, sobre datos sembrados en un esquema temporal.
+//
+// Uso: node benchmark_indices.js
+// Variables opcionales: BENCH_VENTAS (ventas a sembrar, 100000 por defecto), BENCH_DIAS (días de historial
+// de ganadores/premios/resultados, 2000 por defecto), BENCH_REPETICIONES (5 por defecto) y
+// BENCH_CONSERVAR=1 para no borrar el esquema al terminar. No toca las tablas reales: todo vive en el esquema
+// 'bench_indices'.
+
+const { Pool } = require('pg');
+const dotenv = require('dotenv');
+dotenv.config();
+
+const { INDICES, ensureIndexesInDB } = require('./dbIndexes');
+
+const pool = new Pool({
+    connectionString: process.env.DATABASE_URL,
+    ssl: {
+        rejectUnauthorized: false
+    }
+});
+
+const ESQUEMA = 'bench_indices';
+const TOTAL_VENTAS = parseInt(process.env.BENCH_VENTAS || '100000', 10);
+const DIAS_HISTORIAL = parseInt(process.env.BENCH_DIAS || '2000', 10);
+const REPETICIONES = parseInt(process.env.BENCH_REPETICIONES || '5', 10);
+
+/**
+ * Crea las tablas con la misma estructura e índices únicos que ensureTablesExist y siembra los datos.
+ * Las ventas cubren los últimos 120 días, con 50 vendedores (30% de ventas sin vendedor) y cuatro estados.
+ * @param {object} client - Cliente de pg con search_path en el esquema del benchmark.
+ */
+async function sembrarDatos(client) {
+    await client.query(`
+        CREATE TABLE ventas (
+            id BIGINT PRIMARY KEY,
+            "purchaseDate" TIMESTAMP WITH TIME ZONE NOT NULL,
+            "drawDate" DATE NOT NULL,
+            "drawTime" VARCHAR(50) NOT NULL,
+            "drawNumber" INTEGER NOT NULL,
+            "ticketNumber" VARCHAR(255) UNIQUE NOT NULL,
+            "buyerName" VARCHAR(255) NOT NULL,
+            "buyerPhone" VARCHAR(255) NOT NULL,
+            numbers JSONB NOT NULL,
+            "valueUSD" NUMERIC(10, 2) NOT NULL,
+            "valueBs" NUMERIC(10, 2) NOT NULL,
+            "paymentMethod" VARCHAR(255) NOT NULL,
+            "paymentReference" VARCHAR(255),
+            "voucherURL" TEXT,
+            "validationStatus" VARCHAR(50) DEFAULT 'Pendiente',
+            "voidedReason" TEXT,
+            "voidedAt" TIMESTAMP WITH TIME ZONE,
+            "closedReason" TEXT,
+            "closedAt" TIMESTAMP WITH TIME ZONE,
+            "sellerId" VARCHAR(255),
+            "sellerName" VARCHAR(255),
+            "sellerAgency" VARCHAR(255)
+        );
+    `);
+    await client.query(`
+        INSERT INTO ventas (id, "purchaseDate", "drawDate", "drawTime", "drawNumber", "ticketNumber", "buyerName",
+                            "buyerPhone", numbers, "valueUSD", "valueBs", "paymentMethod", "validationStatus", "sellerId")
+        SELECT g, v.compra, v.compra::date + 1, '12:00 PM', 1000 + (g % 120), 'T' || lpad(g::text, 8, '0'),
+               'Comprador ' || g, '0414' || lpad((g % 10000000)::text, 7, '0'),
+               jsonb_build_array(lpad((g % 1000)::text, 3, '0'), lpad(((g * 7) % 1000)::text, 3, '0')),
+               2.00, 80.00, 'Pago Movil',
+               (ARRAY['Confirmado', 'Confirmado', 'Pendiente', 'Falso', 'Anulado'])[1 + (g % 5)],
+               CASE WHEN g % 10 < 3 THEN NULL ELSE 'vendedor_' || (g % 50) END
+        FROM generate_series(1, $1::int) AS g
+        CROSS JOIN LATERAL (SELECT NOW() - random() * INTERVAL '120 days' AS compra) AS v;
+    `, [TOTAL_VENTAS]);
+
+    for (const tabla of ['resultados_zulia', 'premios', 'ganadores']) {
+        await client.query(`CREATE TABLE ${tabla} (id SERIAL PRIMARY KEY, data JSONB NOT NULL);`);
+    }
+    await client.query(`CREATE UNIQUE INDEX unique_resultados_zulia_fecha_tipoloteria ON resultados_zulia ((data->>'fecha'), (data->>'tipoLoteria'));`);
+    await client.query(`CREATE UNIQUE INDEX unique_premios_fechasorteo ON premios ((data->>'fechaSorteo'));`);
+    await client.query(`CREATE UNIQUE INDEX unique_ganadores_drawdata ON ganadores ((data->>'drawDate'), (data->>'drawNumber'), (data->>'lotteryType'));`);
+
+    await client.query(`
+        INSERT INTO resultados_zulia (data)
+        SELECT jsonb_build_object('fecha', to_char(CURRENT_DATE - d, 'YYYY-MM-DD'), 'tipoLoteria', t,
+                                  'resultados', jsonb_build_array(jsonb_build_object('hora', '12:45 PM', 'tripleA', '123')))
+        FROM generate_series(0, $1::int - 1) AS d CROSS JOIN unnest(ARRAY['zulia', 'chance']) AS t;
+    `, [DIAS_HISTORIAL]);
+    await client.query(`
+        INSERT INTO premios (data)
+        SELECT jsonb_build_object('fechaSorteo', to_char(CURRENT_DATE - d, 'YYYY-MM-DD'), 'sorteo12PM', '{}'::jsonb)
+        FROM generate_series(0, $1::int - 1) AS d;
+    `, [DIAS_HISTORIAL]);
+    await client.query(`
+        INSERT INTO ganadores (data)
+        SELECT jsonb_build_object('drawDate', to_char(CURRENT_DATE - d, 'YYYY-MM-DD'), 'drawNumber', (5000 - d)::text,
+                                  'lotteryType', t, 'winners', '[]'::jsonb)
+        FROM generate_series(0, $1::int - 1) AS d CROSS JOIN unnest(ARRAY['zulia', 'chance']) AS t;
+    `, [DIAS_HISTORIAL]);
+
+    await client.query('ANALYZE;');
+}
+
+/**
+ * Consultas medidas. 'antes' es la forma que usaba server.js y 'despues' la actual (iguales si no cambió).
+ * Los DELETE se ejecutan dentro de una transacción que se revierte. La limpieza se mide en su caso diario:
+ * la fecha de corte solo deja fuera el día más antiguo.
+ */
+function construirConsultas() {
+    const fechaSorteo = "to_char(CURRENT_DATE - 10, 'YYYY-MM-DD')";
+    const corteVentas = "to_char(CURRENT_DATE - 119, 'YYYY-MM-DD')";
+    const corteHistorial = `to_char(CURRENT_DATE - ${DIAS_HISTORIAL - 1}, 'YYYY-MM-DD')`;
+    return [
+        {
+            nombre: 'Ventas de un sorteo por estado',
+            antes: `SELECT * FROM ventas WHERE "drawDate" = (${fechaSorteo})::date AND "validationStatus" = ANY(ARRAY['Confirmado', 'Pendiente'])`
+        },
+        {
+            nombre: 'Reporte de ventas por vendedor',
+            antes: `SELECT * FROM ventas WHERE 1=1 AND "sellerId" = 'vendedor_7' ORDER BY "purchaseDate" DESC`
+        },
+        {
+            nombre: 'Primera página de GET /api/ventas',
+            antes: 'SELECT * FROM ventas ORDER BY "purchaseDate" DESC, id DESC LIMIT 50'
+        },
+        {
+            nombre: 'Limpieza de ventas antiguas',
+            antes: `DELETE FROM ventas WHERE "purchaseDate"::date < (${corteVentas})::date`,
+            despues: `DELETE FROM ventas WHERE "purchaseDate" < (${corteVentas})::date`
+        },
+        {
+            nombre: 'Ganador por sorteo ((data->>\'drawNumber\')::int)',
+            antes: `SELECT data FROM ganadores WHERE (data->>'drawDate')::text = ${fechaSorteo} AND (data->>'drawNumber')::int = 4990 AND (data->>'lotteryType')::text = 'zulia' LIMIT 1`
+        },
+        {
+            nombre: 'Limpieza de ganadores',
+            antes: `DELETE FROM ganadores WHERE (data->>'drawDate')::date < (${corteHistorial})::date`,
+            despues: `DELETE FROM ganadores WHERE (data->>'drawDate') < ${corteHistorial}`
+        },
+        {
+            nombre: 'Limpieza de premios',
+            antes: `DELETE FROM premios WHERE (data->>'fechaSorteo')::date < (${corteHistorial})::date`,
+            despues: `DELETE FROM premios WHERE (data->>'fechaSorteo') < ${corteHistorial}`
+        },
+        {
+            nombre: 'Limpieza de resultados_zulia',
+            antes: `DELETE FROM resultados_zulia WHERE (data->>'fecha')::date < (${corteHistorial})::date`,
+            despues: `DELETE FROM resultados_zulia WHERE (data->>'fecha') < ${corteHistorial}`
+        }
+    ];
+}
+
+/**
+ * Resume un plan de EXPLAIN (FORMAT JSON) con los nodos que leen tablas, ej. "Index Scan using idx on ventas".
+ * @param {object} nodo - Nodo 'Plan' de EXPLAIN.
+ * @returns {Array<string>}
+ */
+function resumirPlan(nodo) {
+    const lecturas = [];
+    if (nodo['Relation Name']) {
+        const indice = nodo['Index Name'] ? ` using ${nodo['Index Name']}` : '';
+        lecturas.push(`${nodo['Node Type']}${indice} on ${nodo['Relation Name']}`);
+    }
+    for (const hijo of nodo.Plans || []) {
+        lecturas.push(...resumirPlan(hijo));
+    }
+    return lecturas;
+}
+
+/**
+ * Ejecuta una consulta con EXPLAIN (ANALYZE, BUFFERS) varias veces.
+ * @param {object} client - Cliente de pg.
+ * @param {string} sql - Consulta.
+ * @returns {Promise<{plan: string, mediana: number, buffers: number}>} Plan de la última ejecución, mediana del
+ *          'Execution Time' en ms y bloques compartidos leídos (hit + read) en la última ejecución.
+ */
+async function medirConsulta(client, sql) {
+    const tiempos = [];
+    let ultimo = null;
+    for (let i = 0; i < REPETICIONES; i++) {
+        await client.query('BEGIN');
+        try {
+            const res = await client.query(`EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ${sql}`);
+            ultimo = res.rows[0]['QUERY PLAN'][0];
+            tiempos.push(ultimo['Execution Time']);
+        } finally {
+            await client.query('ROLLBACK'); // Los DELETE no deben cambiar los datos entre repeticiones
+        }
+    }
+    tiempos.sort((a, b) => a - b);
+    return {
+        plan: resumirPlan(ultimo.Plan).join(' + '),
+        mediana: tiempos[Math.floor(tiempos.length / 2)],
+        buffers: (ultimo.Plan['Shared Hit Blocks'] || 0) + (ultimo.Plan['Shared Read Blocks'] || 0)
+    };
+}
+
+async function runBenchmark() {
+    const client = await pool.connect();
+    try {
+        console.log(`Sembrando ${TOTAL_VENTAS} ventas y ${DIAS_HISTORIAL} días de historial en el esquema "${ESQUEMA}"...`);
+        await client.query(`DROP SCHEMA IF EXISTS ${ESQUEMA} CASCADE;`);
+        await client.query(`CREATE SCHEMA ${ESQUEMA};`);
+        await client.query(`SET search_path TO ${ESQUEMA};`);
+        await sembrarDatos(client);
+
+        const consultas = construirConsultas();
+        const antes = [];
+        for (const consulta of consultas) {
+            antes.push(await medirConsulta(client, consulta.antes));
+        }
+
+        console.log(`Creando índices: ${INDICES.map(indice => indice.nombre).join(', ')}`);
+        await ensureIndexesInDB(client);
+
+        const despues = [];
+        for (const consulta of consultas) {
+            despues.push(await medirConsulta(client, consulta.despues || consulta.antes));
+        }
+
+        console.log(`\nResultados (mediana de ${REPETICIONES} ejecuciones, EXPLAIN ANALYZE):\n`);
+        consultas.forEach((consulta, k) => {
+            const mejora = despues[k].mediana > 0 ? (antes[k].mediana / despues[k].mediana).toFixed(1) : '-';
+            console.log(consulta.nombre);
+            console.log(`  antes:   ${antes[k].mediana.toFixed(3)} ms, ${antes[k].buffers} bloques  ${antes[k].plan}`);
+            console.log(`  después: ${despues[k].mediana.toFixed(3)} ms, ${despues[k].buffers} bloques  ${despues[k].plan}`);
+            console.log(`  ${mejora}x\n`);
+        });
+    } catch (err) {
+        console.error('Error durante el benchmark de índices:', err);
+        process.exitCode = 1;
+    } finally {
+        if (process.env.BENCH_CONSERVAR !== '1') {
+            await client.query(`DROP SCHEMA IF EXISTS ${ESQUEMA} CASCADE;`).catch(() => {});
+        }
+        client.release();
+        await pool.end();
+    }
+}
+
+runBenchmark();
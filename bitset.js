@@ -0,0 +1,122 @@
+// bitset.js
+// Conjunto de bits de tamaño fijo para representar el estado de los números de la rifa en memoria.
+//
+// El bit i corresponde al número i (ej. el bit 7 es el número '007'). Los bits se guardan en bytes
+// con el bit más significativo primero, de modo que el buffer se puede enviar tal cual a un cliente:
+// el número i está en el byte (i >> 3), bit (7 - (i & 7)).
+
+class Bitset {
+    /**
+     * @param {number} size - Cantidad de bits (el total de números del sorteo, ej. 1000 o 100000).
+     */
+    constructor(size) {
+        if (!Number.isInteger(size) || size < 0) {
+            throw new Error(`Tamaño inválido para el conjunto de bits: ${size}.`);
+        }
+        this.size = size;
+        this.bytes = new Uint8Array(Math.ceil(size / 8));
+    }
+
+    /**
+     * @param {number} i - Posición del bit.
+     * @returns {boolean} Si el bit está encendido. Fuera de rango devuelve false.
+     */
+    has(i) {
+        if (i < 0 || i >= this.size) return false;
+        return (this.bytes[i >> 3] & (0x80 >> (i & 7))) !== 0;
+    }
+
+    /**
+     * Enciende o apaga un bit. Las posiciones fuera de rango se ignoran.
+     * @param {number} i - Posición del bit.
+     * @param {boolean} [value] - Valor del bit (por defecto true).
+     */
+    set(i, value = true) {
+        if (i < 0 || i >= this.size) return;
+        if (value) {
+            this.bytes[i >> 3] |= (0x80 >> (i & 7));
+        } else {
+            this.bytes[i >> 3] &= ~(0x80 >> (i & 7));
+        }
+    }
+
+    /**
+     * Enciende o apaga todos los bits a la vez.
+     * @param {boolean} [value] - Valor de los bits (por defecto true).
+     * @returns {Bitset} El mismo conjunto, para encadenar.
+     */
+    fill(value = true) {
+        this.bytes.fill(value ? 0xff : 0);
+        const sobrantes = this.bytes.length * 8 - this.size;
+        if (value && sobrantes > 0) {
+            this.bytes[this.bytes.length - 1] &= (0xff << sobrantes) & 0xff; // Los bits de relleno quedan en 0
+        }
+        return this;
+    }
+
+    /**
+     * @returns {Array<number>} Posiciones de los bits encendidos, en orden. Salta los bytes en 0,
+     *          así que recorrer un conjunto disperso de 100000 bits cuesta poco más que sus bits encendidos.
+     */
+    indices() {
+        const posiciones = [];
+        for (let b = 0; b < this.bytes.length; b++) {
+            const byte = this.bytes[b];
+            if (byte === 0) continue;
+            for (let k = 0; k < 8; k++) {
+                if (byte & (0x80 >> k)) posiciones.push((b << 3) + k);
+            }
+        }
+        return posiciones;
+    }
+
+    /**
+     * @returns {number} Cantidad de bits encendidos.
+     */
+    count() {
+        let total = 0;
+        for (let b of this.bytes) {
+            while (b) {
+                b &= b - 1;
+                total++;
+            }
+        }
+        return total;
+    }
+
+    /**
+     * @returns {string} Los bytes del conjunto codificados en base64 (ej. 1000 bits -> 125 bytes -> 168 caracteres).
+     */
+    toBase64() {
+        return Buffer.from(this.bytes.buffer, this.bytes.byteOffset, this.bytes.byteLength).toString('base64');
+    }
+
+    /**
+     * @returns {Array<Array<number>>} Rangos [inicio, fin] (inclusivos) de bits encendidos consecutivos.
+     */
+    ranges() {
+        const rangos = [];
+        let inicio = -1;
+        for (let i = 0; i < this.size; i++) {
+            if (this.has(i)) {
+                if (inicio < 0) inicio = i;
+            } else if (inicio >= 0) {
+                rangos.push([inicio, i - 1]);
+                inicio = -1;
+            }
+        }
+        if (inicio >= 0) rangos.push([inicio, this.size - 1]);
+        return rangos;
+    }
+
+    /**
+     * @returns {Bitset} Una copia independiente.
+     */
+    clone() {
+        const copia = new Bitset(this.size);
+        copia.bytes.set(this.bytes);
+        return copia;
+    }
+}
+
+module.exports = { Bitset };
@@ -23,13 +23,16 @@ const createTableQueries = `
 -- Tabla para horarios_zulia
 CREATE TABLE IF NOT EXISTS horarios_zulia (
     id SERIAL PRIMARY KEY,
-    hora VARCHAR(10) UNIQUE NOT NULL -- Añadido UNIQUE para permitir ON CONFLICT
+    hora VARCHAR(50) NOT NULL,
+    tipo_loteria VARCHAR(50) NOT NULL DEFAULT 'zulia', -- Tipo de lotería del horario
+    premio_clave VARCHAR(50) -- Clave en 'premios' que paga los resultados de esta hora (ej. 'sorteo12PM')
 );
+CREATE UNIQUE INDEX IF NOT EXISTS unique_horarios_zulia_tipo_hora ON horarios_zulia (tipo_loteria, hora);
 
 -- Tabla para numeros
 CREATE TABLE IF NOT EXISTS numeros (
     id SERIAL PRIMARY KEY,
-    numero VARCHAR(3) UNIQUE NOT NULL,
+    numero VARCHAR(10) UNIQUE NOT NULL,
     comprado BOOLEAN DEFAULT FALSE
 );
 
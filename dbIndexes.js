@@ -0,0 +1,77 @@
+// dbIndexes.js
+// Índices secundarios de la base de datos, definidos a partir de los predicados que usan las consultas de server.js.
+//
+// Las expresiones deben coincidir exactamente con las de las consultas para que el planificador use el índice
+// (ej. ((data->>'drawNumber')::int) en 'ganadores'). Los casts de texto o timestamptz a DATE no son inmutables
+// y no se pueden indexar: esas consultas comparan el texto ISO 'YYYY-MM-DD' o el timestamp directamente.
+// Lo usan ensureTablesExist (server.js) y benchmark_indices.js, así el benchmark mide los mismos índices.
+
+const INDICES = [
+    {
+        nombre: 'idx_ventas_purchase_date_id',
+        tabla: 'ventas',
+        definicion: '("purchaseDate", id)',
+        uso: 'Paginación por clave de GET /api/ventas, exportación y limpieza de ventas antiguas ("purchaseDate" < fecha)'
+    },
+    {
+        nombre: 'idx_ventas_draw_date_status',
+        tabla: 'ventas',
+        definicion: '("drawDate", "validationStatus")',
+        uso: 'Ventas de un sorteo por estado (evaluación del sorteo, corte, filtros del panel)'
+    },
+    {
+        nombre: 'idx_ventas_seller_purchase_date',
+        tabla: 'ventas',
+        definicion: '("sellerId", "purchaseDate")',
+        uso: 'Reporte de ventas por vendedor (ORDER BY "purchaseDate") y filtro sellerId'
+    },
+    {
+        nombre: 'idx_ganadores_draw_date_number_int',
+        tabla: 'ganadores',
+        definicion: "((data->>'drawDate'), ((data->>'drawNumber')::int), (data->>'lotteryType'))",
+        uso: "Búsqueda de ganadores por (data->>'drawNumber')::int; el índice único compara drawNumber como texto"
+    }
+    // 'premios' y 'resultados_zulia' ya tienen índices únicos sobre (data->>'fechaSorteo') y
+    // ((data->>'fecha'), (data->>'tipoLoteria')), que sirven a sus búsquedas y a la limpieza por rango de fecha.
+];
+
+/**
+ * Crea los índices que falten sin bloquear escrituras (CREATE INDEX CONCURRENTLY). Si un índice quedó
+ * inválido porque su construcción se interrumpió, se borra y se vuelve a crear. Tras crear índices se
+ * ejecuta ANALYZE para que el planificador tenga estadísticas de las expresiones indexadas.
+ * No debe ejecutarse dentro de una transacción. Un índice que falla se informa y no detiene el resto.
+ * @param {object} client - Cliente de pg (fuera de una transacción).
+ * @param {Array<object>} [indices] - Índices a asegurar (por defecto INDICES).
+ * @returns {Promise<Array<string>>} Nombres de los índices creados.
+ */
+async function ensureIndexesInDB(client, indices = INDICES) {
+    const creados = [];
+    const tablasModificadas = new Set();
+    for (const indice of indices) {
+        try {
+            const existente = await client.query(
+                'SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)',
+                [indice.nombre]
+            );
+            if (existente.rows.length > 0 && existente.rows[0].indisvalid) {
+                continue;
+            }
+            if (existente.rows.length > 0) {
+                console.warn(`WARN_DB_INDICES: El índice "${indice.nombre}" quedó inválido; se vuelve a crear.`);
+                await client.query(`DROP INDEX CONCURRENTLY IF EXISTS ${indice.nombre};`);
+            }
+            await client.query(`CREATE INDEX CONCURRENTLY IF NOT EXISTS ${indice.nombre} ON ${indice.tabla} ${indice.definicion};`);
+            creados.push(indice.nombre);
+            tablasModificadas.add(indice.tabla);
+            console.log(`DB: Índice "${indice.nombre}" creado (${indice.uso}).`);
+        } catch (error) {
+            console.error(`ERROR_DB_INDICES: No se pudo crear el índice "${indice.nombre}":`, error.message);
+        }
+    }
+    for (const tabla of tablasModificadas) {
+        await client.query(`ANALYZE ${tabla};`);
+    }
+    return creados;
+}
+
+module.exports = { INDICES, ensureIndexesInDB };
@@ -0,0 +1,19 @@
+// dbQueries.js
+// Consultas de server.js que también mide un benchmark, para que ambos ejecuten exactamente el mismo SQL.
+// Lo usan getVentasGanadorasFromDB (server.js) y benchmark_ganadores.js.
+
+/**
+ * Ventas de un sorteo que tienen alguno de los números indicados, con los números acertados en 'aciertos'.
+ * Recorre 'ventas_numeros' por su clave primaria (draw_number, numero), así que el costo depende de la
+ * cantidad de ganadores y no del tamaño de 'ventas'.
+ * Parámetros: $1 número de sorteo, $2 fecha del sorteo ('YYYY-MM-DD'), $3 números (text[]).
+ */
+const VENTAS_GANADORAS_SQL = `
+    SELECT v.*, array_agg(vn.numero ORDER BY vn.numero) AS aciertos
+    FROM ventas_numeros vn
+    JOIN ventas v ON v.id = vn.venta_id
+    WHERE vn.draw_number = $1 AND vn.numero = ANY($3::text[]) AND v."drawDate" = $2::date
+    GROUP BY v.id
+    ORDER BY v."purchaseDate", v.id`;
+
+module.exports = { VENTAS_GANADORAS_SQL };
@@ -0,0 +1,89 @@
+// freeList.js
+// Conjunto de posiciones (0..size-1) con alta, baja y muestreo aleatorio en O(1) por elemento.
+//
+// Los miembros se guardan compactos al inicio de un arreglo y cada posición recuerda dónde está
+// dentro de él, así que quitar un miembro es moverle encima el último. Se usa para los números
+// libres de la rifa: elegir K números al azar cuesta O(K) aunque queden 10 libres de 1000.
+
+const crypto = require('crypto');
+
+class FreeList {
+    /**
+     * @param {number} size - Cantidad de posiciones posibles (el total de números del sorteo).
+     * @param {boolean} [lleno] - Si se empieza con todas las posiciones como miembros (por defecto false).
+     */
+    constructor(size, lleno = false) {
+        if (!Number.isInteger(size) || size < 0) {
+            throw new Error(`Tamaño inválido para la lista de libres: ${size}.`);
+        }
+        this.capacity = size;
+        this.items = new Int32Array(size); // Miembros en items[0..size-1]
+        this.posiciones = new Int32Array(size).fill(-1); // Índice de cada posición en items, o -1
+        this.size = 0;
+        if (lleno) {
+            for (let i = 0; i < size; i++) {
+                this.items[i] = i;
+                this.posiciones[i] = i;
+            }
+            this.size = size;
+        }
+    }
+
+    /**
+     * @param {number} i - Posición.
+     * @returns {boolean} Si la posición es miembro. Fuera de rango devuelve false.
+     */
+    has(i) {
+        return i >= 0 && i < this.capacity && this.posiciones[i] >= 0;
+    }
+
+    /**
+     * Agrega una posición (si ya es miembro o está fuera de rango no hace nada).
+     * @param {number} i - Posición.
+     */
+    add(i) {
+        if (i < 0 || i >= this.capacity || this.posiciones[i] >= 0) return;
+        this.items[this.size] = i;
+        this.posiciones[i] = this.size;
+        this.size++;
+    }
+
+    /**
+     * Quita una posición (si no es miembro no hace nada).
+     * @param {number} i - Posición.
+     */
+    delete(i) {
+        if (!this.has(i)) return;
+        const lugar = this.posiciones[i];
+        const ultimo = this.items[this.size - 1];
+        this.items[lugar] = ultimo;
+        this.posiciones[ultimo] = lugar;
+        this.posiciones[i] = -1;
+        this.size--;
+    }
+
+    /**
+     * Elige hasta k miembros distintos al azar, con probabilidad uniforme (Fisher-Yates parcial con
+     * crypto.randomInt). Solo reordena los miembros, no cambia el conjunto.
+     * @param {number} k - Cantidad a elegir.
+     * @param {Set<number>|null} [excluir] - Posiciones que no deben elegirse aunque sean miembros.
+     * @returns {Array<number>} Las posiciones elegidas (menos de k si no hay suficientes).
+     */
+    sample(k, excluir = null) {
+        const elegidos = [];
+        for (let j = 0; j < this.size && elegidos.length < k; j++) {
+            const r = j + crypto.randomInt(this.size - j);
+            const elegido = this.items[r];
+            this.items[r] = this.items[j];
+            this.posiciones[this.items[r]] = r;
+            this.items[j] = elegido;
+            this.posiciones[elegido] = j;
+            if (!excluir || !excluir.has(elegido)) {
+                elegidos.push(elegido);
+            }
+        }
+        return elegidos;
+    }
+}
+
+module.exports = { FreeList };
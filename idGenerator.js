@@ -0,0 +1,56 @@
+// idGenerator.js
+// Generador de IDs de 64 bits (estilo "snowflake") para las tablas 'ventas' y 'comprobantes'.
+//
+// Estructura del ID (63 bits útiles, siempre positivo dentro de un BIGINT de PostgreSQL):
+//   [ 41 bits: milisegundos desde ID_EPOCH_MS ][ 10 bits: nodo ][ 12 bits: contador ]
+// Los IDs son únicos mientras cada proceso use un nodo distinto y crecen con el tiempo,
+// así que siguen el orden de "purchaseDate" y las búsquedas por rango sobre el índice de la PK.
+
+const ID_EPOCH_MS = Date.UTC(2024, 0, 1); // 2024-01-01T00:00:00Z
+const NODE_ID_BITS = 10;
+const SEQUENCE_BITS = 12;
+const MAX_NODE_ID = (1 << NODE_ID_BITS) - 1; // 1023
+const MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1; // 4095
+
+/**
+ * Crea un generador de IDs para un nodo (proceso) concreto.
+ * Si el reloj retrocede o se agotan los 4096 IDs de un milisegundo, el generador
+ * sigue avanzando sobre el último milisegundo usado, de modo que nunca repite ni retrocede.
+ * @param {number} nodeId - Identificador del nodo, entre 0 y 1023. Debe ser único por proceso.
+ * @param {function(): number} [now] - Fuente de tiempo en milisegundos (por defecto Date.now).
+ * @returns {{ nextId: function(): string, nodeId: number }} nextId devuelve el ID como string decimal
+ *          (igual que el driver pg devuelve las columnas BIGINT), porque no cabe en un Number de JS.
+ */
+function createIdGenerator(nodeId, now = Date.now) {
+    if (!Number.isInteger(nodeId) || nodeId < 0 || nodeId > MAX_NODE_ID) {
+        throw new Error(`ID de nodo inválido para el generador de IDs: ${nodeId}. Debe estar entre 0 y ${MAX_NODE_ID}.`);
+    }
+    const nodePart = BigInt(nodeId) << BigInt(SEQUENCE_BITS);
+    let lastTimestamp = -1;
+    let sequence = 0;
+
+    function nextId() {
+        let timestamp = now() - ID_EPOCH_MS;
+        if (timestamp <= lastTimestamp) {
+            timestamp = lastTimestamp;
+            sequence++;
+            if (sequence > MAX_SEQUENCE) {
+                timestamp = lastTimestamp + 1;
+                sequence = 0;
+            }
+        } else {
+            sequence = 0;
+        }
+        lastTimestamp = timestamp;
+        const id = (BigInt(timestamp) << BigInt(NODE_ID_BITS + SEQUENCE_BITS)) | nodePart | BigInt(sequence);
+        return id.toString();
+    }
+
+    return { nextId, nodeId };
+}
+
+module.exports = {
+    createIdGenerator,
+    ID_EPOCH_MS,
+    MAX_NODE_ID
+};
@@ -65,7 +65,7 @@ async function runMigrations() {
         await client.query(`
             CREATE TABLE IF NOT EXISTS numeros (
                 id SERIAL PRIMARY KEY,
-                numero VARCHAR(3) UNIQUE NOT NULL,
+                numero VARCHAR(10) UNIQUE NOT NULL,
                 comprado BOOLEAN DEFAULT FALSE,
                 originalDrawNumber INTEGER
             );
@@ -105,6 +105,12 @@ async function runMigrations() {
                 hora VARCHAR(10) UNIQUE NOT NULL
             );
         `);
+        // Horarios por tipo de lotería con la clave de 'premios' que paga cada hora
+        await client.query(`ALTER TABLE horarios_zulia ADD COLUMN IF NOT EXISTS tipo_loteria VARCHAR(50) NOT NULL DEFAULT 'zulia';`);
+        await client.query(`ALTER TABLE horarios_zulia ADD COLUMN IF NOT EXISTS premio_clave VARCHAR(50);`);
+        await client.query(`ALTER TABLE horarios_zulia ALTER COLUMN hora TYPE VARCHAR(50);`);
+        await client.query(`ALTER TABLE horarios_zulia DROP CONSTRAINT IF EXISTS horarios_zulia_hora_key;`);
+        await client.query(`CREATE UNIQUE INDEX IF NOT EXISTS unique_horarios_zulia_tipo_hora ON horarios_zulia (tipo_loteria, hora);`);
         console.log('Tabla "horarios_zulia" asegurada.');
 
         // 6. Crear tabla 'resultados_zulia'
@@ -150,6 +156,35 @@ async function runMigrations() {
         `).catch(e => console.warn(`Advertencia: El índice unique_ganadores_drawdata ya existe o hubo un error al añadirlo: ${e.message}`));
         console.log('Tabla "ganadores" asegurada.');
 
+        // Tickets ganadores por fila (el servidor copia aquí los ganadores existentes al crearla)
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS ganadores_tickets (
+                draw_date DATE NOT NULL,
+                draw_number INTEGER NOT NULL,
+                lottery_type VARCHAR(50) NOT NULL,
+                ticket_number VARCHAR(255) NOT NULL,
+                venta_id BIGINT,
+                buyer_name VARCHAR(255),
+                buyer_phone VARCHAR(255),
+                numbers JSONB NOT NULL DEFAULT '[]'::jsonb,
+                purchase_date TIMESTAMP WITH TIME ZONE NOT NULL,
+                coincident_numbers JSONB NOT NULL DEFAULT '[]'::jsonb,
+                detalle_horas JSONB NOT NULL DEFAULT '{}'::jsonb,
+                premio_usd NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                premio_bs NUMERIC(16, 2) NOT NULL DEFAULT 0,
+                estado_pago VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+                pagado_at TIMESTAMP WITH TIME ZONE,
+                pago_referencia TEXT,
+                premio_usd_pagado NUMERIC(14, 2),
+                processed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (draw_date, draw_number, lottery_type, ticket_number)
+            );
+        `);
+        await client.query(`ALTER TABLE ganadores_tickets ADD COLUMN IF NOT EXISTS premio_usd_pagado NUMERIC(14, 2);`);
+        await client.query(`CREATE INDEX IF NOT EXISTS idx_ganadores_tickets_sorteo_compra ON ganadores_tickets (draw_date, draw_number, lottery_type, purchase_date, ticket_number);`);
+        await client.query(`CREATE INDEX IF NOT EXISTS idx_ganadores_tickets_buyer_phone ON ganadores_tickets (buyer_phone, draw_date);`);
+        console.log('Tabla "ganadores_tickets" asegurada.');
+
         // 9. Crear tabla 'comprobantes'
         await client.query(`
             CREATE TABLE IF NOT EXISTS comprobantes (
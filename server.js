@@ -12,8 +12,13 @@ const moment = require('moment-timezone');
 const archiver = require('archiver');
 const { v4: uuidv4 } = require('uuid'); // Para generar IDs únicos
 const crypto = require('crypto'); // Para generar IDs únicos si es necesario
-const { Pool } = require('pg'); // Importar la librería pg para PostgreSQL
+const { Pool, Client } = require('pg'); // Importar la librería pg para PostgreSQL
 const fs = require('fs').promises; // Necesario para operaciones de archivos locales (uploads, reports)
+const { createIdGenerator, MAX_NODE_ID } = require('./idGenerator'); // IDs de 64 bits para ventas y comprobantes
+const { Bitset } = require('./bitset'); // Estado de los números de la rifa en memoria
+const { FreeList } = require('./freeList'); // Números libres para la selección automática
+const { ensureIndexesInDB } = require('./dbIndexes'); // Índices secundarios alineados con las consultas
+const { VENTAS_GANADORAS_SQL } = require('./dbQueries'); // Consultas compartidas con los benchmarks
 
 dotenv.config();
 
@@ -44,17 +49,50 @@ const COMPROBANTES_DIR = path.join(UPLOADS_DIR, 'comprobantes'); // Asegurarse d
 const SALES_THRESHOLD_PERCENTAGE = 80;
 const DRAW_SUSPENSION_HOUR = 12;
 const DRAW_SUSPENSION_MINUTE = 15;
-const TOTAL_RAFFLE_NUMBERS = 1000;
+// Tamaños permitidos del espacio de números de un sorteo (configuracion.total_numeros): 000-999, 0000-9999 y 00000-99999.
+// Los números se escriben con tantos dígitos como el mayor del espacio.
+const ESPACIOS_NUMEROS_PERMITIDOS = [1000, 10000, 100000];
+const TOTAL_RAFFLE_NUMBERS = 1000; // Espacio por defecto (el de las configuraciones anteriores a total_numeros)
+const NUMEROS_BLOQUEO_INTENTOS = 3;
+// Un número comprado sigue vendido durante el sorteo para el que se compró y el siguiente;
+// al avanzar 'numero_sorteo_correlativo' más allá queda libre sin actualizar su fila (ver numero_vendido en la DB).
+// Es la regla que ya aplicaba /api/set-manual-draw-date; el cierre manual conservaba un sorteo más.
+const NUMEROS_GENERACIONES_VIGENTES = 2;
+// Estados de venta que cuentan como tickets vendidos del sorteo activo
+const ESTADOS_VENTA_ACTIVOS = ['Confirmado', 'Pendiente'];
+// Cantidad de números de ticket que cada proceso reserva de una vez en 'secuencia_tickets' (por fecha del ticket).
+// Con 1 la numeración queda densa; valores mayores reducen los viajes a la DB a cambio de huecos si el proceso se reinicia.
+const TICKET_SEQUENCE_BLOCK_SIZE = Math.max(1, parseInt(process.env.TICKET_SEQUENCE_BLOCK_SIZE, 10) || 1);
 
 // --- Funciones Auxiliares para Operaciones con la Base de Datos ---
 
+/**
+ * Ejecuta una función con el cliente recibido o, si no se pasa ninguno, con uno prestado del pool.
+ * Permite que las funciones auxiliares participen en la transacción del llamador
+ * (mismo BEGIN/COMMIT y una sola conexión por solicitud) o funcionen de forma independiente.
+ * @param {object|null} client - Cliente de pg existente (opcional).
+ * @param {function(object): Promise<*>} fn - Función que recibe el cliente a usar.
+ * @returns {Promise<*>} El resultado de fn.
+ */
+async function withDBClient(client, fn) {
+    if (client) {
+        return fn(client);
+    }
+    const ownClient = await pool.connect();
+    try {
+        return await fn(ownClient);
+    } finally {
+        ownClient.release();
+    }
+}
+
 /**
  * Obtiene la configuración de la base de datos.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  * @returns {Promise<object>} El objeto de configuración.
  */
-async function getConfiguracionFromDB() {
-    const client = await pool.connect();
-    try {
+async function getConfiguracionFromDB(client = null) {
+    return withDBClient(client, async (client) => {
         const res = await client.query('SELECT * FROM configuracion LIMIT 1');
         if (res.rows.length > 0) {
             const config = res.rows[0];
@@ -66,18 +104,16 @@ async function getConfiguracionFromDB() {
             return config;
         }
         return {}; // Retorna un objeto vacío si no hay configuración
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Actualiza la configuración en la base de datos.
  * @param {object} configData - Los datos de configuración a actualizar.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function updateConfiguracionInDB(configData) {
-    const client = await pool.connect();
-    try {
+async function updateConfiguracionInDB(configData, client = null) {
+    return withDBClient(client, async (client) => {
         const query = `
             UPDATE configuracion SET
                 pagina_bloqueada = $1, fecha_sorteo = $2, precio_ticket = $3,
@@ -87,8 +123,9 @@ async function updateConfiguracionInDB(configData) {
                 mail_config_host = $10, mail_config_port = $11, mail_config_secure = $12,
                 mail_config_user = $13, mail_config_pass = $14, mail_config_sender_name = $15,
                 raffleNumbersInitialized = $16, last_sales_notification_count = $17,
-                sales_notification_threshold = $18, block_reason_message = $19
-            WHERE id = $20
+                sales_notification_threshold = $18, block_reason_message = $19,
+                total_numeros = $20
+            WHERE id = $21
         `;
         const values = [
             configData.pagina_bloqueada, configData.fecha_sorteo, configData.precio_ticket,
@@ -102,25 +139,92 @@ async function updateConfiguracionInDB(configData) {
             configData.mail_config_user, configData.mail_config_pass, configData.mail_config_sender_name,
             configData.raffleNumbersInitialized, configData.last_sales_notification_count,
             configData.sales_notification_threshold, configData.block_reason_message,
+            createNumerosEspacio(configData.total_numeros).total,
             configData.id // Asumiendo que el ID de la configuración es 1 o el ID existente
         ];
         await client.query(query, values);
-    } finally {
-        client.release();
-    }
+        invalidateConfiguracionCache(); // El NOTIFY del trigger llega al confirmar; esto cubre las lecturas locales inmediatas
+    });
+}
+
+/**
+ * @param {number|string|null} total - Valor de configuracion.total_numeros.
+ * @returns {{total: number, digitos: number}} El espacio de números del sorteo (el de por defecto si el valor no es válido).
+ */
+function createNumerosEspacio(total) {
+    const valor = parseInt(total, 10);
+    const totalValido = ESPACIOS_NUMEROS_PERMITIDOS.includes(valor) ? valor : TOTAL_RAFFLE_NUMBERS;
+    return { total: totalValido, digitos: String(totalValido - 1).length };
+}
+
+/**
+ * Lee el espacio de números del sorteo actual.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<{total: number, digitos: number}>}
+ */
+async function getNumerosEspacioFromDB(client = null) {
+    return withDBClient(client, async (client) => {
+        const res = await client.query('SELECT total_numeros FROM configuracion LIMIT 1');
+        return createNumerosEspacio(res.rows.length > 0 ? res.rows[0].total_numeros : null);
+    });
+}
+
+/**
+ * @param {string|number} numero - Número de la rifa (ej. '007').
+ * @param {{total: number, digitos: number}} espacio - Espacio de números del sorteo.
+ * @returns {number} Su posición en el espacio, o -1 si no es un número de la rifa con esos dígitos.
+ */
+function numeroToIndex(numero, espacio) {
+    const str = String(numero);
+    if (str.length !== espacio.digitos || !/^\d+$/.test(str)) return -1;
+    const i = parseInt(str, 10);
+    return i < espacio.total ? i : -1;
+}
+
+/**
+ * @param {number} i - Posición en el espacio.
+ * @param {{total: number, digitos: number}} espacio - Espacio de números del sorteo.
+ * @returns {string} El número con ceros a la izquierda (ej. '007' o '00007').
+ */
+function indexToNumero(i, espacio) {
+    return String(i).padStart(espacio.digitos, '0');
 }
 
 /**
  * Obtiene los números de rifa desde la base de datos.
+ * La grilla se arma a partir del espacio de números del sorteo: 'numeros' solo tiene filas de los
+ * números que alguna vez se compraron o reservaron, y los que no tienen fila están disponibles.
+ * Cada número incluye 'reservado' (tiene una reserva vigente) y 'disponible' (ni comprado ni reservado).
+ * @param {Array<string>|null} [soloNumeros] - Si se indica, solo se devuelven estos números (los que no pertenecen al espacio se omiten)
+ *        y cada uno incluye además 'reservadoHasta' (vencimiento de su reserva vigente o null), como en los deltas.
  * @returns {Promise<Array>} Array de objetos de números.
  */
-async function getNumerosFromDB() {
+async function getNumerosFromDB(soloNumeros = null) {
     const client = await pool.connect();
     try {
+        const espacio = await getNumerosEspacioFromDB(client);
+        const grilla = soloNumeros
+            ? {
+                sql: 'SELECT unnest($1::text[]) AS numero',
+                params: [Array.from(new Set(soloNumeros.map(n => String(n)))).filter(n => numeroToIndex(n, espacio) >= 0)]
+            }
+            : {
+                sql: "SELECT lpad(i::text, $2, '0') AS numero FROM generate_series(0, $1 - 1) AS i",
+                params: [espacio.total, espacio.digitos]
+            };
+        const query = `
+            SELECT g.numero, numero_vendido(n.comprado, n."originalDrawNumber") AS comprado,
+                   CASE WHEN numero_vendido(n.comprado, n."originalDrawNumber") THEN n."originalDrawNumber" END AS "originalDrawNumber",
+                   (r.numero IS NOT NULL) AS reservado,
+                   (NOT numero_vendido(n.comprado, n."originalDrawNumber") AND r.numero IS NULL) AS disponible
+                   ${soloNumeros ? ', r.expires_at AS "reservadoHasta"' : ''}
+            FROM (${grilla.sql}) g
+            LEFT JOIN numeros n ON n.numero = g.numero
+            LEFT JOIN reservas_numeros r ON r.numero = g.numero AND r.expires_at > NOW()
+            ORDER BY g.numero`;
         // Log the query before execution
-        console.log('DEBUG_DB: Ejecutando SELECT en tabla numeros: SELECT numero, comprado, "originalDrawNumber" FROM numeros ORDER BY numero::INTEGER');
-        // FIX: Changed 'originaldrawnumber' to '"originalDrawNumber"' to match case-sensitive column name
-        const res = await client.query('SELECT numero, comprado, "originalDrawNumber" FROM numeros ORDER BY numero::INTEGER');
+        console.log(`DEBUG_DB: Ejecutando SELECT de la grilla de ${espacio.total} números (con reservas vigentes).`);
+        const res = await client.query(query, grilla.params);
         console.log(`DEBUG_DB: Consulta SELECT en numeros exitosa. Filas encontradas: ${res.rows.length}`);
         return res.rows;
     } catch (dbError) { // Catch the specific DB error
@@ -139,37 +243,1094 @@ async function getNumerosFromDB() {
  * @param {string} numero - El número a actualizar.
  * @param {boolean} comprado - Estado de comprado.
  * @param {number|null} originalDrawNumber - Número de sorteo original.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function updateNumeroInDB(numero, comprado, originalDrawNumber) {
-    const client = await pool.connect();
-    try {
+async function updateNumeroInDB(numero, comprado, originalDrawNumber, client = null) {
+    return withDBClient(client, async (client) => {
         await client.query(
             'UPDATE numeros SET comprado = $1, "originalDrawNumber" = $2 WHERE numero = $3', // Added quotes for consistency
             [comprado, originalDrawNumber, numero]
         );
-    } finally {
-        client.release();
+    });
+}
+
+/**
+ * Bloquea (FOR UPDATE, en orden para evitar deadlocks) las filas de 'numeros' solicitadas.
+ * Como 'numeros' solo guarda los números ya usados, antes se crean como libres las filas que falten
+ * de los números válidos para el espacio del sorteo: el costo depende de cuántos números se piden,
+ * no del tamaño del espacio.
+ * Compras y reservas pasan por aquí, así que ambas quedan serializadas por número y la
+ * siguiente sentencia de la transacción ve el estado confirmado más reciente de esas filas.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @param {Array<string>} solicitados - Números sin duplicados.
+ * @returns {Promise<Array<string>>} Los números válidos para el espacio del sorteo, ya bloqueados.
+ */
+async function lockNumerosInDB(client, solicitados) {
+    const espacio = await getNumerosEspacioFromDB(client);
+    let pendientes = solicitados.filter(n => numeroToIndex(n, espacio) >= 0).sort();
+    const bloqueados = [];
+    // Si la compactación borra una fila libre entre el INSERT y el bloqueo, se vuelve a crear
+    for (let intento = 0; intento < NUMEROS_BLOQUEO_INTENTOS && pendientes.length > 0; intento++) {
+        await client.query(
+            `INSERT INTO numeros (numero, comprado, "originalDrawNumber")
+             SELECT numero, FALSE, NULL FROM unnest($1::text[]) AS numero ORDER BY numero
+             ON CONFLICT (numero) DO NOTHING`,
+            [pendientes]
+        );
+        const res = await client.query(
+            'SELECT numero FROM numeros WHERE numero = ANY($1::text[]) ORDER BY numero FOR UPDATE',
+            [pendientes]
+        );
+        const encontrados = new Set(res.rows.map(row => row.numero));
+        encontrados.forEach(numero => bloqueados.push(numero));
+        pendientes = pendientes.filter(n => !encontrados.has(n));
+    }
+    if (pendientes.length > 0) {
+        throw new Error(`No se pudieron bloquear los números ${pendientes.join(', ')}.`);
     }
+    return bloqueados.sort();
 }
 
 /**
- * Inserta o actualiza múltiples números de rifa en una transacción.
- * @param {Array<Object>} numerosArray - Array de objetos de números { numero, comprado, originalDrawNumber }.
+ * Marca como comprados todos los números solicitados con una sola sentencia condicional.
+ * Tras bloquear las filas, solo se actualizan si NINGUNA está comprada ni reservada por otra
+ * reserva vigente, por lo que el costo no depende del tamaño de 'numeros' ni de 'ventas'.
+ * Si se pasa el token de una reserva, sus números se consideran del comprador y la reserva se consume.
+ * Debe ejecutarse con un cliente que ya tenga una transacción abierta.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @param {Array<string>} numerosSolicitados - Números a reclamar (ej. ['007', '123']).
+ * @param {number} originalDrawNumber - Número de sorteo al que quedan asociados.
+ * @param {string|null} [tokenReserva] - Token de la reserva que se canjea con esta compra (opcional).
+ * @returns {Promise<{reclamados: Array<string>, conflictos: Array<string>, invalidos: Array<string>}>}
+ *          'conflictos' son los comprados o reservados por otros; 'invalidos' los que no pertenecen
+ *          al espacio de números del sorteo.
  */
-async function upsertNumerosInDB(numerosArray) {
-    const client = await pool.connect();
+async function claimNumerosInDB(client, numerosSolicitados, originalDrawNumber, tokenReserva = null) {
+    const solicitados = Array.from(new Set(numerosSolicitados.map(n => String(n))));
+    const encontrados = await lockNumerosInDB(client, solicitados);
+    const invalidos = solicitados.filter(n => !encontrados.includes(n));
+
+    const res = await client.query(
+        `WITH solicitados AS (
+            SELECT n.numero,
+                   numero_vendido(n.comprado, n."originalDrawNumber") OR EXISTS (
+                       SELECT 1 FROM reservas_numeros r
+                       WHERE r.numero = n.numero AND r.expires_at > NOW() AND r.token IS DISTINCT FROM $3
+                   ) AS ocupado
+            FROM numeros n
+            WHERE n.numero = ANY($1::text[])
+        ), reclamados AS (
+            UPDATE numeros SET comprado = TRUE, "originalDrawNumber" = $2
+            WHERE numero IN (SELECT numero FROM solicitados)
+              AND NOT EXISTS (SELECT 1 FROM solicitados WHERE ocupado)
+            RETURNING numero
+        )
+        SELECT
+            COALESCE((SELECT array_agg(numero ORDER BY numero) FROM reclamados), '{}') AS reclamados,
+            COALESCE((SELECT array_agg(numero ORDER BY numero) FROM solicitados WHERE ocupado), '{}') AS conflictos`,
+        [encontrados, originalDrawNumber, tokenReserva]
+    );
+    const { reclamados, conflictos } = res.rows[0];
+
+    if (tokenReserva && conflictos.length === 0 && invalidos.length === 0) {
+        await client.query('DELETE FROM reservas_numeros WHERE token = $1', [tokenReserva]); // La reserva queda canjeada
+    }
+    return { reclamados, conflictos, invalidos };
+}
+
+// INICIO DE NUEVA LÓGICA: RESERVAS TEMPORALES DE NÚMEROS
+/**
+ * Reserva números durante unos minutos para un comprador, sin marcarlos como comprados.
+ * Una fila de 'reservas_numeros' con expires_at vencido se trata como inexistente y se
+ * sobrescribe al reservar, así que expirar no requiere barrer la tabla; la limpieza periódica
+ * borra las vencidas usando el índice sobre expires_at.
+ * Si se pasa un token existente, los números se añaden a esa reserva y se extiende su vencimiento.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @param {Array<string>} numerosSolicitados - Números a reservar.
+ * @param {string} token - Token de la reserva.
+ * @param {number} minutos - Duración de la reserva.
+ * @returns {Promise<{reservados: Array<string>, conflictos: Array<string>, invalidos: Array<string>, expiresAt: string|null}>}
+ */
+async function holdNumerosInDB(client, numerosSolicitados, token, minutos) {
+    const solicitados = Array.from(new Set(numerosSolicitados.map(n => String(n))));
+    const encontrados = await lockNumerosInDB(client, solicitados);
+    const invalidos = solicitados.filter(n => !encontrados.includes(n));
+
+    const compradosRes = await client.query(
+        'SELECT numero FROM numeros WHERE numero = ANY($1::text[]) AND numero_vendido(comprado, "originalDrawNumber")',
+        [encontrados]
+    );
+    const comprados = compradosRes.rows.map(row => row.numero);
+    const libres = encontrados.filter(n => !comprados.includes(n));
+
+    const reservaRes = await client.query(
+        `INSERT INTO reservas_numeros (numero, token, expires_at)
+         SELECT numero, $2, NOW() + make_interval(mins => $3) FROM unnest($1::text[]) AS numero
+         ON CONFLICT (numero) DO UPDATE SET
+             token = EXCLUDED.token,
+             expires_at = EXCLUDED.expires_at
+         WHERE reservas_numeros.expires_at <= NOW() OR reservas_numeros.token = EXCLUDED.token
+         RETURNING numero, expires_at;`,
+        [libres, token, minutos]
+    );
+    const reservados = reservaRes.rows.map(row => row.numero);
+    const conflictos = [...comprados, ...libres.filter(n => !reservados.includes(n))].sort();
+
+    if (conflictos.length === 0 && invalidos.length === 0) {
+        // Extender también el vencimiento de los números que ya tenía esta reserva
+        await client.query(
+            'UPDATE reservas_numeros SET expires_at = NOW() + make_interval(mins => $2) WHERE token = $1',
+            [token, minutos]
+        );
+    }
+    const expiresAt = reservaRes.rows.length > 0 ? reservaRes.rows[0].expires_at : null;
+    return { reservados: reservados.sort(), conflictos, invalidos, expiresAt };
+}
+
+/**
+ * Libera todos los números de una reserva.
+ * @param {string} token - Token de la reserva.
+ * @returns {Promise<Array<string>>} Los números liberados.
+ */
+async function releaseHoldInDB(token) {
+    const res = await pool.query('DELETE FROM reservas_numeros WHERE token = $1 RETURNING numero', [token]);
+    return res.rows.map(row => row.numero);
+}
+
+/**
+ * Borra las reservas vencidas. Usa el índice sobre expires_at, así que solo toca las filas vencidas.
+ * Las reservas vencidas ya se ignoran en compras y consultas; esto solo recupera espacio.
+ */
+async function purgeExpiredHoldsInDB() {
     try {
-        await client.query('BEGIN'); // Iniciar transacción
-        for (const item of numerosArray) {
+        const res = await pool.query('DELETE FROM reservas_numeros WHERE expires_at <= NOW()');
+        if (res.rowCount > 0) {
+            console.log(`DEBUG_RESERVAS: ${res.rowCount} reservas vencidas eliminadas.`);
+        }
+    } catch (error) {
+        console.error('ERROR_RESERVAS: Error al eliminar reservas vencidas:', error.message);
+    }
+}
+// FIN DE NUEVA LÓGICA: RESERVAS TEMPORALES DE NÚMEROS
+
+// INICIO DE NUEVA LÓGICA: CACHÉ EN MEMORIA DE DISPONIBILIDAD DE NÚMEROS
+// Cada proceso mantiene en memoria el espacio de números del sorteo, cuáles están comprados y cuáles tienen una
+// reserva vigente, para servir la grilla y descartar conflictos sin consultar la DB.
+// PostgreSQL sigue siendo la fuente de verdad: triggers sobre 'numeros' y 'reservas_numeros' emiten
+// un NOTIFY con los números cambiados al confirmarse cada transacción, cada proceso relee solo esos
+// números, y una reconciliación periódica recarga todo por si se perdió algún aviso.
+// Mientras la conexión de LISTEN no está activa, la caché se marca como no cargada y se lee de la DB.
+const NUMEROS_NOTIFY_CHANNEL = 'numeros_cambios';
+const CONFIGURACION_NOTIFY_CHANNEL = 'configuracion_cambios';
+const CAMBIOS_LISTENER_RETRY_MS = 5000;
+// Tiempo que se espera una versión de 'numeros' tomada por otra transacción antes de darla por abandonada
+const NUMEROS_VERSION_ESPERA_MS = 30000;
+
+/**
+ * Crea un estado vacío de la caché de números para un espacio de números.
+ * Solo los conjuntos de bits y la lista de libres ocupan todo el espacio; sorteos y reservas se guardan
+ * por posición en Maps, porque en una grilla de 100000 números casi todos están libres.
+ * @param {{total: number, digitos: number}} espacio - Espacio de números del sorteo.
+ * @returns {object} { espacio, existentes, comprados, drawNumbers, reservas, libres }
+ */
+function createNumerosCacheState(espacio) {
+    return {
+        espacio,
+        existentes: new Bitset(espacio.total).fill(), // Todo el espacio existe; se conserva para los formatos compactos
+        comprados: new Bitset(espacio.total),
+        drawNumbers: new Map(), // posición -> sorteo del número comprado
+        reservas: new Map(), // posición -> { token, vence } (vence en ms)
+        libres: new FreeList(espacio.total, true) // Ni comprados ni con reserva: candidatos de la selección automática
+    };
+}
+
+/**
+ * Mantiene la lista de libres de una posición al día con 'comprados' y 'reservas'.
+ * Una reserva vencida sigue fuera de la lista hasta que la limpieza periódica la borra de la DB
+ * (y su aviso la quita de la caché); mientras tanto la selección automática simplemente no la ofrece.
+ * @param {object} state - Estado de la caché.
+ * @param {number} i - Posición del número.
+ */
+function actualizarLibreEnCache(state, i) {
+    if (state.comprados.has(i) || state.reservas.has(i)) {
+        state.libres.delete(i);
+    } else {
+        state.libres.add(i);
+    }
+}
+
+let numerosCache = createNumerosCacheState(createNumerosEspacio(TOTAL_RAFFLE_NUMBERS));
+let numerosCacheVersion = 0; // Versión de 'numeros' que la caché ya refleja (nunca mayor que la de sus datos)
+let numerosCacheCargado = false;
+let cambiosListenerActivo = false;
+let numerosCambiosPendientes = new Set();
+let numerosVersionesPendientes = new Set(); // Versiones anunciadas cuyos números aún no se releen
+let numerosVersionesAplicadas = new Set(); // Ya aplicadas pero por encima de un hueco: esperan a las anteriores
+let numerosVersionesOmitidas = new Set(); // Huecos dados por abandonados (ver resolverHuecoVersionNumeros)
+let numerosHuecoTimer = null;
+let numerosRecargaTotalPendiente = false;
+let numerosRefreshEnCurso = null;
+
+/**
+ * @param {object} state - Estado de la caché.
+ * @param {number} i - Posición del número.
+ * @param {number} ahora - Momento de referencia en ms.
+ * @returns {{token: string, vence: number}|null} La reserva del número si sigue vigente.
+ */
+function reservaVigente(state, i, ahora) {
+    const reserva = state.reservas.get(i);
+    return reserva && reserva.vence > ahora ? reserva : null;
+}
+
+function applyNumeroRowToCache(state, row) {
+    const i = numeroToIndex(row.numero, state.espacio);
+    if (i < 0) return;
+    state.comprados.set(i, row.comprado);
+    if (row.comprado) {
+        state.drawNumbers.set(i, row.originalDrawNumber);
+    } else {
+        state.drawNumbers.delete(i);
+    }
+    actualizarLibreEnCache(state, i);
+}
+
+function applyHoldRowToCache(state, row) {
+    const i = numeroToIndex(row.numero, state.espacio);
+    if (i < 0) return;
+    state.reservas.set(i, { token: row.token, vence: new Date(row.expires_at).getTime() });
+    actualizarLibreEnCache(state, i);
+}
+
+/**
+ * Lee la versión confirmada de la grilla de números: la mayor versión tal que todas las anteriores ya
+ * se confirmaron o se abandonaron (ver numeros_version_confirmada en ensureTablesExist).
+ * @returns {Promise<number>}
+ */
+async function getNumerosVersionFromDB() {
+    const res = await pool.query('SELECT numeros_version_confirmada(make_interval(secs => $1)) AS version', [NUMEROS_VERSION_ESPERA_MS / 1000]);
+    return parseInt(res.rows[0].version, 10) || 0;
+}
+
+/**
+ * Marca versiones como aplicadas en la caché y avanza numerosCacheVersion mientras no haya huecos.
+ * Las versiones salen de una secuencia y se toman antes del COMMIT, así que pueden confirmarse (y
+ * avisarse) fuera de orden: la caché no anuncia una versión hasta haber aplicado todas las anteriores.
+ * Una versión que llega después de que su hueco se dio por abandonado se vuelve a anunciar con una
+ * versión nueva, para que los clientes con ?since= la reciban.
+ * @param {Iterable<number>} versiones - Versiones cuyos cambios ya están en la caché.
+ */
+function adoptarVersionesNumeros(versiones) {
+    for (const version of versiones) {
+        if (version > numerosCacheVersion) {
+            numerosVersionesAplicadas.add(version);
+        } else if (numerosVersionesOmitidas.delete(version)) {
+            console.warn(`WARN_CACHE_NUMEROS: La versión ${version} se confirmó después de darse por abandonada; se vuelve a anunciar.`);
+            pool.query('SELECT reanunciar_version_numeros($1)', [version])
+                .catch(error => console.error('ERROR_CACHE_NUMEROS: No se pudo volver a anunciar la versión:', error.message));
+        }
+    }
+    while (numerosVersionesAplicadas.delete(numerosCacheVersion + 1)) {
+        numerosCacheVersion++;
+    }
+    if (numerosVersionesAplicadas.size > 0 && !numerosHuecoTimer) {
+        const versionConHueco = numerosCacheVersion;
+        numerosHuecoTimer = setTimeout(() => {
+            numerosHuecoTimer = null;
+            if (numerosCacheVersion !== versionConHueco) {
+                adoptarVersionesNumeros([]); // El hueco se llenó; esperar por el siguiente si lo hay
+                return;
+            }
+            resolverHuecoVersionNumeros().catch(error => console.error('ERROR_CACHE_NUMEROS: Error al resolver un hueco de versiones:', error.message));
+        }, NUMEROS_VERSION_ESPERA_MS);
+    }
+}
+
+/**
+ * Resuelve un hueco de versiones que lleva NUMEROS_VERSION_ESPERA_MS sin llenarse: si alguna de esas
+ * versiones ya está en numeros_cambios_log, su aviso se perdió y se recarga la caché completa; si no,
+ * se dan por abandonadas (transacción revertida) y la versión de la caché avanza.
+ */
+async function resolverHuecoVersionNumeros() {
+    if (numerosVersionesAplicadas.size === 0) return;
+    const desde = numerosCacheVersion;
+    const hasta = Math.min(...numerosVersionesAplicadas) - 1;
+    const res = await pool.query(
+        'SELECT 1 FROM numeros_cambios_log WHERE version > $1 AND version <= $2 LIMIT 1',
+        [desde, hasta]
+    );
+    if (numerosCacheVersion !== desde) {
+        adoptarVersionesNumeros([]);
+        return;
+    }
+    if (res.rows.length > 0) {
+        console.warn(`WARN_CACHE_NUMEROS: Faltan avisos de versiones entre ${desde + 1} y ${hasta}; recargando la caché.`);
+        queueNumerosCacheRefresh(null);
+        return;
+    }
+    for (let version = desde + 1; version <= hasta; version++) {
+        numerosVersionesOmitidas.add(version);
+    }
+    for (const version of numerosVersionesOmitidas) {
+        if (version <= hasta - NUMEROS_LOG_RETENCION_VERSIONES) numerosVersionesOmitidas.delete(version);
+    }
+    numerosCacheVersion = hasta;
+    adoptarVersionesNumeros([]);
+}
+
+/**
+ * Lee de la DB el estado completo de la grilla. Solo se leen los números vendidos y las reservas
+ * vigentes, así que el costo depende de lo vendido y no del tamaño del espacio de números.
+ * La versión se lee antes que los datos, así los datos nunca son más viejos que la versión anunciada.
+ * @returns {Promise<{version: number, state: object}>}
+ */
+async function readNumerosStateFromDB() {
+    const version = await getNumerosVersionFromDB();
+    const espacio = await getNumerosEspacioFromDB();
+    const [numerosRes, reservasRes] = await Promise.all([
+        pool.query(
+            `SELECT numero, TRUE AS comprado, "originalDrawNumber" FROM numeros
+             WHERE length(numero) = $1 AND numero_vendido(comprado, "originalDrawNumber")`,
+            [espacio.digitos]
+        ),
+        pool.query('SELECT numero, token, expires_at FROM reservas_numeros WHERE expires_at > NOW()')
+    ]);
+    const state = createNumerosCacheState(espacio);
+    numerosRes.rows.forEach(row => applyNumeroRowToCache(state, row));
+    reservasRes.rows.forEach(row => applyHoldRowToCache(state, row));
+    return { version, state };
+}
+
+/**
+ * Estado visible para los compradores de un número de la caché (lo que se envía en los deltas del stream).
+ * @param {object} state - Estado de la caché.
+ * @param {number} i - Posición del número.
+ * @param {number} ahora - Momento de referencia en ms para decidir si la reserva sigue vigente.
+ * @returns {{numero: string, existe: boolean, comprado: boolean, reservadoHasta: string|null}}
+ *          'existe' es siempre true (todo el espacio del sorteo existe); se mantiene por compatibilidad.
+ */
+function estadoPublicoNumero(state, i, ahora) {
+    const reserva = reservaVigente(state, i, ahora);
+    return {
+        numero: indexToNumero(i, state.espacio),
+        existe: true,
+        comprado: state.comprados.has(i),
+        reservadoHasta: reserva ? new Date(reserva.vence).toISOString() : null
+    };
+}
+
+function mismoEstadoPublico(a, b) {
+    return a.comprado === b.comprado && a.reservadoHasta === b.reservadoHasta;
+}
+
+/**
+ * Recarga toda la caché desde la DB y la reemplaza de una vez.
+ * @returns {Promise<number>} Cantidad de números cuyo estado en caché no coincidía con la DB.
+ */
+async function reloadNumerosCache() {
+    const { version, state: nuevo } = await readNumerosStateFromDB();
+    const anterior = numerosCache;
+    const estabaCargado = numerosCacheCargado;
+    const mismoEspacio = anterior.espacio.total === nuevo.espacio.total;
+
+    let diferencias = 0;
+    const cambios = [];
+    if (mismoEspacio) {
+        // Solo pueden diferir las posiciones compradas o reservadas en alguno de los dos estados
+        const ahora = Date.now();
+        const candidatas = Array.from(new Set([
+            ...anterior.comprados.indices(), ...nuevo.comprados.indices(),
+            ...anterior.reservas.keys(), ...nuevo.reservas.keys()
+        ])).sort((a, b) => a - b);
+        for (const i of candidatas) {
+            const reservaAnterior = reservaVigente(anterior, i, ahora);
+            const reservaNueva = reservaVigente(nuevo, i, ahora);
+            const actual = estadoPublicoNumero(nuevo, i, ahora);
+            const cambioPublico = !mismoEstadoPublico(estadoPublicoNumero(anterior, i, ahora), actual);
+            if (cambioPublico) {
+                cambios.push(actual);
+            }
+            if (cambioPublico || anterior.drawNumbers.get(i) !== nuevo.drawNumbers.get(i) ||
+                (reservaAnterior && reservaAnterior.token) !== (reservaNueva && reservaNueva.token)) {
+                diferencias++;
+            }
+        }
+    }
+    numerosCache = nuevo;
+    numerosCacheVersion = Math.max(numerosCacheVersion, version);
+    for (const aplicada of numerosVersionesAplicadas) {
+        if (aplicada <= numerosCacheVersion) numerosVersionesAplicadas.delete(aplicada);
+    }
+    adoptarVersionesNumeros([]);
+    numerosCacheCargado = true;
+    if (mismoEspacio) {
+        broadcastNumerosCambios(cambios);
+    } else {
+        broadcastNumerosSnapshot(); // Cambió el espacio de números del sorteo: la grilla entera es otra
+    }
+    return estabaCargado ? diferencias : 0;
+}
+
+/**
+ * Relee de la DB solo los números indicados y actualiza su estado en la caché.
+ * @param {Array<string>} numeros - Números cambiados (tal como llegan en el NOTIFY).
+ * @param {Iterable<number>} versiones - Versiones anunciadas para esos cambios; se adoptan tras releerlos.
+ */
+async function refreshNumerosInCache(numeros, versiones) {
+    const state = numerosCache;
+    const indices = numeros.map(numero => numeroToIndex(numero, state.espacio)).filter(i => i >= 0);
+    if (indices.length === 0) {
+        adoptarVersionesNumeros(versiones);
+        return;
+    }
+    const lista = indices.map(i => indexToNumero(i, state.espacio));
+    const [numerosRes, reservasRes] = await Promise.all([
+        pool.query('SELECT numero, numero_vendido(comprado, "originalDrawNumber") AS comprado, "originalDrawNumber" FROM numeros WHERE numero = ANY($1::text[])', [lista]),
+        pool.query('SELECT numero, token, expires_at FROM reservas_numeros WHERE numero = ANY($1::text[]) AND expires_at > NOW()', [lista])
+    ]);
+    const ahora = Date.now();
+    const anteriores = indices.map(i => estadoPublicoNumero(state, i, ahora));
+    for (const i of indices) {
+        // Un número sin fila en 'numeros' está libre
+        state.comprados.set(i, false);
+        state.drawNumbers.delete(i);
+        state.reservas.delete(i);
+        actualizarLibreEnCache(state, i);
+    }
+    numerosRes.rows.forEach(row => applyNumeroRowToCache(state, row));
+    reservasRes.rows.forEach(row => applyHoldRowToCache(state, row));
+    adoptarVersionesNumeros(versiones);
+    const cambios = indices
+        .map(i => estadoPublicoNumero(state, i, ahora))
+        .filter((actual, k) => !mismoEstadoPublico(anteriores[k], actual));
+    broadcastNumerosCambios(cambios);
+}
+
+/**
+ * Encola una relectura de la caché. Los avisos que llegan mientras otra relectura está en curso
+ * se acumulan y se aplican juntos en la siguiente, así una ráfaga de compras cuesta pocas consultas.
+ * @param {Array<string>|null} numeros - Números a releer, o null para recargar todo.
+ * @param {number} [version] - Versión anunciada en el NOTIFY para esos cambios.
+ * @returns {Promise<void>}
+ */
+function queueNumerosCacheRefresh(numeros, version = 0) {
+    if (numeros === null) {
+        numerosRecargaTotalPendiente = true;
+    } else {
+        numeros.forEach(n => numerosCambiosPendientes.add(n));
+    }
+    if (version > 0) {
+        numerosVersionesPendientes.add(version);
+    }
+    if (!numerosRefreshEnCurso) {
+        numerosRefreshEnCurso = flushNumerosCacheRefresh().finally(() => {
+            numerosRefreshEnCurso = null;
+        });
+    }
+    return numerosRefreshEnCurso;
+}
+
+async function flushNumerosCacheRefresh() {
+    while (numerosRecargaTotalPendiente || numerosCambiosPendientes.size > 0) {
+        const recargaTotal = numerosRecargaTotalPendiente;
+        const numeros = Array.from(numerosCambiosPendientes);
+        const versiones = numerosVersionesPendientes;
+        numerosRecargaTotalPendiente = false;
+        numerosCambiosPendientes = new Set();
+        numerosVersionesPendientes = new Set();
+        try {
+            if (recargaTotal) {
+                const diferencias = await reloadNumerosCache();
+                // Los avisos ya recibidos son de transacciones confirmadas antes de releer: la recarga los incluye
+                adoptarVersionesNumeros(versiones);
+                if (diferencias > 0) {
+                    console.warn(`WARN_CACHE_NUMEROS: La reconciliación corrigió ${diferencias} números desincronizados en la caché.`);
+                }
+            } else {
+                await refreshNumerosInCache(numeros, versiones);
+            }
+        } catch (error) {
+            // Sin la relectura la caché puede estar vieja: leer de la DB hasta la próxima recarga completa
+            console.error('ERROR_CACHE_NUMEROS: Error al actualizar la caché de números:', error.message);
+            numerosCacheCargado = false;
+            numerosRecargaTotalPendiente = false;
+            numerosCambiosPendientes = new Set();
+            numerosVersionesPendientes = new Set();
+        }
+    }
+}
+
+/**
+ * Abre la conexión dedicada de LISTEN (números y configuración) y carga la caché de números completa.
+ * Si la conexión falla o se cierra, las cachés dejan de usarse y se reintenta cada pocos segundos.
+ */
+async function startCambiosListener() {
+    const listener = new Client({
+        connectionString: process.env.DATABASE_URL,
+        ssl: {
+            rejectUnauthorized: false
+        }
+    });
+    let activo = true;
+    const reintentar = (error) => {
+        if (!activo) return;
+        activo = false;
+        cambiosListenerActivo = false;
+        numerosCacheCargado = false;
+        invalidateConfiguracionCache();
+        console.error(`ERROR_CACHE_NUMEROS: Conexión de LISTEN no disponible (${error.message}). Reintentando en ${CAMBIOS_LISTENER_RETRY_MS / 1000}s.`);
+        listener.end().catch(() => {});
+        setTimeout(startCambiosListener, CAMBIOS_LISTENER_RETRY_MS);
+    };
+    listener.on('notification', (msg) => {
+        if (msg.channel === CONFIGURACION_NOTIFY_CHANNEL) {
+            if (msg.payload === TICKET_SEQUENCE_RESET_PAYLOAD) {
+                resetTicketSequenceBlocks(); // Otro proceso reinició la numeración de tickets (limpiar-datos)
+                return;
+            }
+            invalidateConfiguracionCache();
+            broadcastEstadoSorteo();
+            return;
+        }
+        if (msg.channel !== NUMEROS_NOTIFY_CHANNEL) return;
+        // Formato del aviso: 'version:numero,numero,...' o 'version:*'
+        const separador = msg.payload.indexOf(':');
+        const version = parseInt(msg.payload.slice(0, separador), 10) || 0;
+        const cambiados = msg.payload.slice(separador + 1);
+        queueNumerosCacheRefresh(cambiados === '*' ? null : cambiados.split(','), version);
+    });
+    listener.on('error', reintentar);
+    listener.on('end', () => reintentar(new Error('conexión cerrada')));
+
+    try {
+        await listener.connect();
+        await listener.query(`LISTEN ${NUMEROS_NOTIFY_CHANNEL}`);
+        await listener.query(`LISTEN ${CONFIGURACION_NOTIFY_CHANNEL}`);
+        cambiosListenerActivo = true;
+        await queueNumerosCacheRefresh(null); // Recarga completa: cubre lo que cambió mientras no se escuchaba
+        console.log(`DEBUG_CACHE_NUMEROS: Caché de números cargada y escuchando el canal "${NUMEROS_NOTIFY_CHANNEL}".`);
+    } catch (error) {
+        reintentar(error);
+    }
+}
+
+/**
+ * Recarga completa periódica: corrige cualquier diferencia por avisos perdidos.
+ */
+async function reconcileNumerosCache() {
+    if (!cambiosListenerActivo) return; // Se recarga al reconectar
+    await queueNumerosCacheRefresh(null);
+}
+
+/**
+ * Aplica en la caché un cambio de 'comprado' ya confirmado en la DB por este proceso.
+ * El NOTIFY de la misma transacción llegará después y releerá esos números igualmente.
+ * @param {Array<string>} numeros - Números afectados.
+ * @param {boolean} comprado - Nuevo estado.
+ * @param {number|null} originalDrawNumber - Sorteo asociado.
+ */
+function markNumerosInCache(numeros, comprado, originalDrawNumber) {
+    const tocados = [];
+    for (const numero of numeros) {
+        const i = numeroToIndex(numero, numerosCache.espacio);
+        if (i < 0) continue;
+        applyNumeroRowToCache(numerosCache, { numero, comprado, originalDrawNumber });
+        tocados.push(i);
+    }
+    broadcastNumerosIndices(tocados);
+}
+
+/**
+ * Aplica en la caché una reserva ya confirmada en la DB: los números indicados pasan a la reserva
+ * y todos los números de la reserva toman el nuevo vencimiento.
+ * @param {string} token - Token de la reserva.
+ * @param {Array<string>} numeros - Números reservados en esta operación.
+ * @param {string|Date} expiresAt - Nuevo vencimiento.
+ */
+function setHoldInCache(token, numeros, expiresAt) {
+    const vence = new Date(expiresAt).getTime();
+    const tocados = [];
+    for (const numero of numeros) {
+        const i = numeroToIndex(numero, numerosCache.espacio);
+        if (i >= 0) {
+            numerosCache.reservas.set(i, { token, vence });
+            actualizarLibreEnCache(numerosCache, i);
+        }
+    }
+    for (const [i, reserva] of numerosCache.reservas) {
+        if (reserva.token === token) {
+            reserva.vence = vence;
+            tocados.push(i);
+        }
+    }
+    broadcastNumerosIndices(tocados);
+}
+
+/**
+ * Quita de la caché todos los números de una reserva (liberada o canjeada en una compra).
+ * @param {string} token - Token de la reserva.
+ */
+function clearHoldInCache(token) {
+    const tocados = [];
+    for (const [i, reserva] of numerosCache.reservas) {
+        if (reserva.token === token) {
+            numerosCache.reservas.delete(i);
+            actualizarLibreEnCache(numerosCache, i);
+            tocados.push(i);
+        }
+    }
+    broadcastNumerosIndices(tocados);
+}
+
+/**
+ * Verifica contra la caché si los números solicitados están libres para el comprador.
+ * Es solo un filtro rápido: la compra sigue validándose en la DB con las filas bloqueadas.
+ * @param {Array<string>} numerosSolicitados - Números solicitados.
+ * @param {string|null} [token] - Token de reserva del comprador (sus números no cuentan como conflicto).
+ * @returns {{conflictos: Array<string>, invalidos: Array<string>}|null} null si la caché no está disponible.
+ *          'invalidos' son los que no pertenecen al espacio de números del sorteo.
+ */
+function checkNumerosInCache(numerosSolicitados, token = null) {
+    if (!numerosCacheCargado) return null;
+    const ahora = Date.now();
+    const conflictos = [];
+    const invalidos = [];
+    for (const numero of new Set(numerosSolicitados.map(n => String(n)))) {
+        const i = numeroToIndex(numero, numerosCache.espacio);
+        if (i < 0) {
+            invalidos.push(numero);
+            continue;
+        }
+        const reserva = reservaVigente(numerosCache, i, ahora);
+        if (numerosCache.comprados.has(i) || (reserva && reserva.token !== token)) {
+            conflictos.push(numero);
+        }
+    }
+    return { conflictos: conflictos.sort(), invalidos: invalidos.sort() };
+}
+
+/**
+ * Elige al azar (con probabilidad uniforme) números libres de la caché para la selección automática.
+ * Cuesta O(cantidad) sin importar cuántos números queden libres. Es solo una propuesta:
+ * la reserva se valida después en la DB con las filas bloqueadas.
+ * @param {number} cantidad - Cantidad de números a elegir.
+ * @param {Set<string>} [descartados] - Números que no deben elegirse (ej. los que fallaron en un intento anterior).
+ * @returns {Array<string>|null} null si la caché no está disponible; menos de 'cantidad' si no quedan suficientes.
+ */
+function pickNumerosLibresFromCache(cantidad, descartados = new Set()) {
+    if (!numerosCacheCargado) return null;
+    const espacio = numerosCache.espacio;
+    const excluir = new Set(Array.from(descartados).map(n => numeroToIndex(n, espacio)).filter(i => i >= 0));
+    return numerosCache.libres.sample(cantidad, excluir)
+        .sort((a, b) => a - b)
+        .map(i => indexToNumero(i, espacio));
+}
+
+/**
+ * Construye la grilla de números desde la caché, con el mismo formato que getNumerosFromDB.
+ * @returns {Array|null} null si la caché no está disponible.
+ */
+function getNumerosFromCache() {
+    if (!numerosCacheCargado) return null;
+    const ahora = Date.now();
+    const numeros = new Array(numerosCache.espacio.total);
+    for (let i = 0; i < numerosCache.espacio.total; i++) {
+        numeros[i] = filaNumeroEnCache(i, ahora);
+    }
+    return numeros;
+}
+
+/**
+ * @param {number} i - Posición del número en la caché.
+ * @param {number} ahora - Momento de referencia en ms.
+ * @returns {object} La fila del número con el formato de getNumerosFromDB.
+ */
+function filaNumeroEnCache(i, ahora) {
+    const comprado = numerosCache.comprados.has(i);
+    const reservado = reservaVigente(numerosCache, i, ahora) !== null;
+    return {
+        numero: indexToNumero(i, numerosCache.espacio),
+        comprado,
+        originalDrawNumber: comprado && numerosCache.drawNumbers.has(i) ? numerosCache.drawNumbers.get(i) : null,
+        reservado,
+        disponible: !comprado && !reservado
+    };
+}
+
+/**
+ * Estado de la grilla como conjuntos de bits, desde la caché o (si no está disponible) desde la DB.
+ * @returns {Promise<{version: number, espacio: object, existentes: Bitset, comprados: Bitset, reservados: Bitset}>}
+ */
+async function getNumerosBitsets() {
+    const { version, state } = numerosCacheCargado
+        ? { version: numerosCacheVersion, state: numerosCache }
+        : await readNumerosStateFromDB();
+    const ahora = Date.now();
+    const reservados = new Bitset(state.espacio.total);
+    for (const [i, reserva] of state.reservas) {
+        if (reserva.vence > ahora) reservados.set(i);
+    }
+    return { version, espacio: state.espacio, existentes: state.existentes, comprados: state.comprados, reservados };
+}
+
+/**
+ * @returns {number} Cantidad de reservas vigentes en la caché. Dentro de una misma versión las reservas
+ *          solo pueden vencer (crear o cambiar una reserva sube la versión), así que versión + versiones
+ *          aplicadas sobre un hueco + este conteo identifican el contenido de la grilla.
+ */
+function countActiveHoldsInCache() {
+    const ahora = Date.now();
+    let activas = 0;
+    for (const reserva of numerosCache.reservas.values()) {
+        if (reserva.vence > ahora) activas++;
+    }
+    return activas;
+}
+
+// Consultas incrementales de la grilla (GET /api/numeros?since=<version>)
+const NUMEROS_DELTA_MAX_CAMBIOS = 300; // Con más números cambiados se responde la grilla completa
+const NUMEROS_LOG_RETENCION_VERSIONES = 20000;
+const NUMEROS_LOG_RETENCION_HORAS = 24;
+
+/**
+ * Devuelve solo los números que cambiaron después de 'since', o la grilla completa si el registro
+ * de cambios ya no cubre ese tramo (retención), hubo un cambio masivo o son demasiados.
+ * La versión devuelta nunca es mayor que la de los datos enviados.
+ * El vencimiento de una reserva no cambia la versión por sí solo: la versión sube cuando purgeExpiredHoldsInDB
+ * (cada minuto) borra la reserva, así que hasta entonces un cliente al día recibe 'cambios: []'. Por eso cada
+ * fila del delta trae 'reservadoHasta': el cliente debe tratar el número como libre desde ese momento.
+ * @param {number} since - Última versión que tiene el cliente.
+ * @returns {Promise<object>} { version, completo: false, cambios } o { version, completo: true, numeros }.
+ */
+async function getNumerosDelta(since) {
+    const desdeCache = numerosCacheCargado;
+    const version = desdeCache ? numerosCacheVersion : await getNumerosVersionFromDB();
+    if (since === version) {
+        return { version, completo: false, cambios: [] };
+    }
+    if (since < version) {
+        const logRes = await pool.query(
+            `SELECT (SELECT MIN(version) FROM numeros_cambios_log) AS minima,
+                    COALESCE(array_agg(DISTINCT numero), '{}') AS numeros
+             FROM numeros_cambios_log
+             WHERE version > $1 AND version <= $2`,
+            [since, version]
+        );
+        const { minima, numeros } = logRes.rows[0];
+        const cubierto = minima !== null && parseInt(minima, 10) <= since + 1;
+        if (cubierto && !numeros.includes('*') && numeros.length <= NUMEROS_DELTA_MAX_CAMBIOS) {
+            // Los números fuera del espacio del sorteo no forman parte de la grilla y se omiten
+            // (un cambio de espacio queda registrado como '*' y responde la grilla completa)
+            let cambios;
+            if (desdeCache && numerosCacheCargado) {
+                const ahora = Date.now();
+                cambios = numeros.map(numero => numeroToIndex(numero, numerosCache.espacio))
+                    .filter(i => i >= 0)
+                    .sort((a, b) => a - b)
+                    .map(i => {
+                        const reserva = reservaVigente(numerosCache, i, ahora);
+                        return { ...filaNumeroEnCache(i, ahora), reservadoHasta: reserva ? new Date(reserva.vence).toISOString() : null };
+                    });
+            } else {
+                cambios = await getNumerosFromDB(numeros);
+            }
+            return { version, completo: false, cambios };
+        }
+    }
+    const numeros = (desdeCache && getNumerosFromCache()) || await getNumerosFromDB();
+    return { version, completo: true, numeros };
+}
+
+/**
+ * Recorta el registro de cambios de la grilla: conserva como máximo las últimas
+ * NUMEROS_LOG_RETENCION_VERSIONES versiones y NUMEROS_LOG_RETENCION_HORAS horas.
+ * Los clientes con una versión más vieja reciben la grilla completa.
+ */
+async function purgeNumerosCambiosLog() {
+    try {
+        const res = await pool.query(
+            `DELETE FROM numeros_cambios_log
+             WHERE (version <= (SELECT last_value FROM numeros_version_seq) - $1
+                    OR created_at < NOW() - make_interval(hours => $2))
+               AND version < (SELECT MAX(version) FROM numeros_cambios_log)`, // La última versión sirve de referencia a numeros_version_confirmada
+            [NUMEROS_LOG_RETENCION_VERSIONES, NUMEROS_LOG_RETENCION_HORAS]
+        );
+        if (res.rowCount > 0) {
+            console.log(`DEBUG_CAMBIOS_NUMEROS: ${res.rowCount} entradas antiguas del registro de cambios eliminadas.`);
+        }
+    } catch (error) {
+        console.error('ERROR_CAMBIOS_NUMEROS: Error al recortar el registro de cambios de números:', error.message);
+    }
+}
+// FIN DE NUEVA LÓGICA: CACHÉ EN MEMORIA DE DISPONIBILIDAD DE NÚMEROS
+
+// INICIO DE NUEVA LÓGICA: CACHÉ DE CONFIGURACIÓN Y GET CONDICIONALES (ETAG)
+// La configuración pública se guarda ya serializada junto con su versión (versiones_estado 'configuracion',
+// que un trigger sube en cada escritura y avisa por NOTIFY). Solo se usa mientras la conexión de LISTEN
+// está activa; cualquier aviso o escritura local la descarta y la siguiente lectura la recarga.
+let configuracionCache = null; // { version, body }
+let configuracionCacheGeneracion = 0; // Evita guardar una lectura que empezó antes de una invalidación
+
+function invalidateConfiguracionCache() {
+    configuracionCache = null;
+    configuracionCacheGeneracion++;
+}
+
+/**
+ * Obtiene la configuración pública (sin credenciales) ya serializada, desde la caché si está vigente.
+ * La versión se lee antes que los datos, así los datos nunca son más viejos que la versión anunciada.
+ * @returns {Promise<{version: number, body: string}>}
+ */
+async function getConfiguracionPublica() {
+    if (configuracionCache) {
+        return configuracionCache;
+    }
+    const generacion = configuracionCacheGeneracion;
+    const versionRes = await pool.query("SELECT version FROM versiones_estado WHERE recurso = 'configuracion'");
+    const version = versionRes.rows.length > 0 ? parseInt(versionRes.rows[0].version, 10) : 0;
+    const configuracion = await getConfiguracionFromDB();
+    const configToSend = { ...configuracion };
+    delete configToSend.mail_config_pass; // No enviar credenciales sensibles
+    const entrada = { version, body: JSON.stringify(configToSend) };
+    if (cambiosListenerActivo && generacion === configuracionCacheGeneracion) {
+        configuracionCache = entrada;
+    }
+    return entrada;
+}
+
+/**
+ * Aplica un ETag fuerte a la respuesta y verifica If-None-Match.
+ * @param {object} req - Solicitud de Express.
+ * @param {object} res - Respuesta de Express.
+ * @param {string} etag - ETag entre comillas (ej. '"c12"').
+ * @returns {boolean} true si el cliente ya tiene esa versión (la respuesta debe ser 304).
+ */
+function applyETag(req, res, etag) {
+    res.set('ETag', etag);
+    res.set('Cache-Control', 'no-cache'); // El navegador guarda la copia pero revalida en cada consulta
+    const ifNoneMatch = req.get('If-None-Match');
+    if (!ifNoneMatch) return false;
+    return ifNoneMatch.split(',').some(valor => {
+        const candidato = valor.trim();
+        return candidato === '*' || candidato === etag || candidato === `W/${etag}`;
+    });
+}
+// FIN DE NUEVA LÓGICA: CACHÉ DE CONFIGURACIÓN Y GET CONDICIONALES (ETAG)
+
+// INICIO DE NUEVA LÓGICA: STREAM SSE DE CAMBIOS DE NÚMEROS Y ESTADO DEL SORTEO
+// Los navegadores conectados a /api/stream/numeros reciben un 'snapshot' inicial y luego solo deltas.
+// La única fuente de eventos es la caché de cada proceso (alimentada por LISTEN/NOTIFY), así que miles de
+// conexiones cuestan un aviso de la DB por cambio, no una consulta por conexión.
+// Si una conexión no drena su buffer (res.write devuelve false), sus deltas se acumulan fusionados por número;
+// si se acumulan demasiados se reemplazan por un nuevo snapshot, y si no drena a tiempo se cierra.
+const SSE_HEARTBEAT_MS = 25000;
+const SSE_MAX_CAMBIOS_PENDIENTES = 200;
+const SSE_DRAIN_TIMEOUT_MS = 30000;
+
+const sseClientes = new Set();
+let sseEstadoSorteo = null; // Último { pagina_bloqueada, block_reason_message } difundido
+
+function writeSSE(cliente, evento, data) {
+    const ok = cliente.res.write(`event: ${evento}\ndata: ${JSON.stringify(data)}\n\n`);
+    if (!ok && !cliente.congestionado) {
+        cliente.congestionado = true;
+        cliente.drainTimer = setTimeout(() => {
+            console.warn('WARN_SSE: Conexión sin drenar por demasiado tiempo; se cierra para que el cliente reconecte.');
+            cliente.res.end();
+        }, SSE_DRAIN_TIMEOUT_MS);
+    }
+    return ok;
+}
+
+/**
+ * Construye el snapshot completo de la grilla y del estado del sorteo desde la caché.
+ * @returns {Promise<object>}
+ */
+async function buildSnapshotSSE() {
+    const { body } = await getConfiguracionPublica();
+    const configuracion = JSON.parse(body);
+    const ahora = Date.now();
+    const reservas = Array.from(numerosCache.reservas.keys())
+        .filter(i => reservaVigente(numerosCache, i, ahora))
+        .sort((a, b) => a - b)
+        .map(i => estadoPublicoNumero(numerosCache, i, ahora))
+        .map(({ numero, reservadoHasta }) => ({ numero, reservadoHasta }));
+    return {
+        version: numerosCacheVersion,
+        total: numerosCache.espacio.total,
+        digitos: numerosCache.espacio.digitos,
+        existentes: numerosCache.existentes.toBase64(),
+        comprados: numerosCache.comprados.toBase64(),
+        reservas,
+        estado: {
+            pagina_bloqueada: configuracion.pagina_bloqueada,
+            block_reason_message: configuracion.block_reason_message
+        }
+    };
+}
+
+/**
+ * Envía lo acumulado mientras la conexión estaba congestionada, fusionado en el menor número de eventos.
+ * @param {object} cliente - Conexión SSE.
+ */
+async function flushSSEClient(cliente) {
+    if (cliente.snapshotPendiente) {
+        let snapshot;
+        try {
+            snapshot = await buildSnapshotSSE();
+        } catch (error) {
+            console.error('ERROR_SSE: No se pudo construir el snapshot:', error.message);
+            cliente.res.end();
+            return;
+        }
+        // El snapshot ya incluye los cambios de números ocurridos mientras se construía
+        cliente.snapshotPendiente = false;
+        cliente.cambiosPendientes.clear();
+        if (!writeSSE(cliente, 'snapshot', snapshot)) return;
+    }
+    if (cliente.cambiosPendientes.size > 0) {
+        const cambios = Array.from(cliente.cambiosPendientes.values());
+        cliente.cambiosPendientes.clear();
+        if (!writeSSE(cliente, 'numeros', { version: numerosCacheVersion, cambios })) return;
+    }
+    if (cliente.estadoPendiente) {
+        const estado = cliente.estadoPendiente;
+        cliente.estadoPendiente = null;
+        writeSSE(cliente, 'estado', estado);
+    }
+}
+
+/**
+ * Difunde a todas las conexiones los números cuyo estado visible cambió.
+ * @param {Array<object>} cambios - Resultado de estadoPublicoNumero para cada número cambiado.
+ */
+function broadcastNumerosCambios(cambios) {
+    if (cambios.length === 0 || sseClientes.size === 0) return;
+    if (cambios.length > SSE_MAX_CAMBIOS_PENDIENTES) {
+        // Cambios masivos (reinicio de números, recarga tras reconectar): un snapshot pesa menos que el delta
+        broadcastNumerosSnapshot();
+        return;
+    }
+    const data = { version: numerosCacheVersion, cambios };
+    for (const cliente of sseClientes) {
+        if (cliente.congestionado || cliente.snapshotPendiente) {
+            if (cliente.snapshotPendiente) continue;
+            cambios.forEach(cambio => cliente.cambiosPendientes.set(cambio.numero, cambio));
+            if (cliente.cambiosPendientes.size > SSE_MAX_CAMBIOS_PENDIENTES) {
+                cliente.cambiosPendientes.clear();
+                cliente.snapshotPendiente = true;
+            }
+        } else {
+            writeSSE(cliente, 'numeros', data);
+        }
+    }
+}
+
+/**
+ * Envía un snapshot nuevo a todas las conexiones (cambio masivo o de espacio de números).
+ */
+function broadcastNumerosSnapshot() {
+    for (const cliente of sseClientes) {
+        if (cliente.snapshotPendiente) continue;
+        cliente.snapshotPendiente = true;
+        if (!cliente.congestionado) flushSSEClient(cliente);
+    }
+}
+
+/**
+ * Difunde el estado actual de las posiciones indicadas (cambios locales ya confirmados).
+ * @param {Array<number>} indices - Posiciones en la caché.
+ */
+function broadcastNumerosIndices(indices) {
+    if (indices.length === 0 || sseClientes.size === 0) return;
+    const ahora = Date.now();
+    broadcastNumerosCambios(indices.map(i => estadoPublicoNumero(numerosCache, i, ahora)));
+}
+
+/**
+ * Tras un aviso de cambio en 'configuracion', difunde pagina_bloqueada / block_reason_message si cambiaron.
+ * Se lee la configuración una vez por proceso, sin importar cuántas conexiones haya.
+ */
+async function broadcastEstadoSorteo() {
+    if (sseClientes.size === 0) {
+        sseEstadoSorteo = null;
+        return;
+    }
+    try {
+        const configuracion = JSON.parse((await getConfiguracionPublica()).body);
+        const estado = {
+            pagina_bloqueada: configuracion.pagina_bloqueada,
+            block_reason_message: configuracion.block_reason_message
+        };
+        if (sseEstadoSorteo &&
+            sseEstadoSorteo.pagina_bloqueada === estado.pagina_bloqueada &&
+            sseEstadoSorteo.block_reason_message === estado.block_reason_message) {
+            return;
+        }
+        sseEstadoSorteo = estado;
+        for (const cliente of sseClientes) {
+            if (cliente.congestionado || cliente.snapshotPendiente) {
+                cliente.estadoPendiente = estado;
+            } else {
+                writeSSE(cliente, 'estado', estado);
+            }
+        }
+    } catch (error) {
+        console.error('ERROR_SSE: Error al difundir el estado del sorteo:', error.message);
+    }
+}
+
+// Un solo temporizador mantiene vivas todas las conexiones (proxies cierran conexiones inactivas)
+setInterval(() => {
+    for (const cliente of sseClientes) {
+        if (!cliente.congestionado) cliente.res.write(': ping\n\n');
+    }
+}, SSE_HEARTBEAT_MS).unref();
+// FIN DE NUEVA LÓGICA: STREAM SSE DE CAMBIOS DE NÚMEROS Y ESTADO DEL SORTEO
+
+const NUMEROS_UPSERT_LOTE = 5000; // Filas por sentencia en las escrituras masivas de 'numeros'
+
+/**
+ * Inserta o actualiza múltiples números de rifa con sentencias de varias filas (unnest de arrays),
+ * en lotes de NUMEROS_UPSERT_LOTE dentro de una transacción: una grilla de 1000 números es una sola sentencia.
+ * Las filas que no cambian no se reescriben (ni generan avisos de cambio).
+ * @param {Array<Object>} numerosArray - Array de objetos de números { numero, comprado, originalDrawNumber }.
+ * @param {object|null} [client] - Cliente de pg con una transacción activa; si no se pasa, se abre una propia.
+ */
+async function upsertNumerosInDB(numerosArray, client = null) {
+    // Si un número viene repetido se aplica la última aparición (ON CONFLICT no admite duplicados en una sentencia)
+    const porNumero = new Map();
+    for (const item of numerosArray) {
+        porNumero.set(String(item.numero), item);
+    }
+    const items = Array.from(porNumero.values());
+
+    const upsertLotes = async (client) => {
+        for (let inicio = 0; inicio < items.length; inicio += NUMEROS_UPSERT_LOTE) {
+            const lote = items.slice(inicio, inicio + NUMEROS_UPSERT_LOTE);
             await client.query(
                 `INSERT INTO numeros (numero, comprado, "originalDrawNumber")
-                 VALUES ($1, $2, $3)
+                 SELECT * FROM unnest($1::text[], $2::boolean[], $3::integer[])
                  ON CONFLICT (numero) DO UPDATE SET
                     comprado = EXCLUDED.comprado,
-                    "originalDrawNumber" = EXCLUDED."originalDrawNumber"`, // Added quotes for consistency
-                [item.numero, item.comprado, item.originalDrawNumber]
+                    "originalDrawNumber" = EXCLUDED."originalDrawNumber"
+                 WHERE numeros.comprado IS DISTINCT FROM EXCLUDED.comprado
+                    OR numeros."originalDrawNumber" IS DISTINCT FROM EXCLUDED."originalDrawNumber"`,
+                [
+                    lote.map(item => String(item.numero)),
+                    lote.map(item => item.comprado === true || item.comprado === 'true'), // El string 'false' no cuenta como comprado
+                    lote.map(item => (item.originalDrawNumber === null || item.originalDrawNumber === undefined) ? null : parseInt(item.originalDrawNumber, 10))
+                ]
             );
         }
+    };
+
+    if (client) {
+        return upsertLotes(client);
+    }
+    client = await pool.connect();
+    try {
+        await client.query('BEGIN'); // Iniciar transacción
+        await upsertLotes(client);
         await client.query('COMMIT'); // Confirmar transacción
     } catch (e) {
         await client.query('ROLLBACK'); // Revertir en caso de error
@@ -183,29 +1344,452 @@ async function upsertNumerosInDB(numerosArray) {
  * Obtiene las ventas desde la base de datos.
  * @returns {Promise<Array>} Array de objetos de ventas.
  */
-async function getVentasFromDB() {
-    const client = await pool.connect();
-    try {
-        // INICIO DE MODIFICACIÓN: Incluir campos de vendedor en la consulta
-        const res = await client.query('SELECT *, "sellerId", "sellerName", "sellerAgency" FROM ventas');
-        // FIN DE MODIFICACIÓN: Incluir campos de vendedor en la consulta
-        // Asegurarse de que el campo 'numbers' (JSONB) sea un array de JS
+async function getVentasFromDB() {
+    const client = await pool.connect();
+    try {
+        // SELECT * ya incluye los campos de vendedor
+        const res = await client.query('SELECT * FROM ventas');
+        // Asegurarse de que el campo 'numbers' (JSONB) sea un array de JS, sin copiar cada fila
+        for (const row of res.rows) {
+            if (typeof row.numbers === 'string') row.numbers = JSON.parse(row.numbers);
+        }
+        return res.rows;
+    } finally {
+        client.release();
+    }
+}
+
+// Consultas paginadas de ventas (GET /api/ventas). Columnas que se pueden pedir con ?campos=.
+const VENTAS_COLUMNAS = [
+    'id', 'purchaseDate', 'drawDate', 'drawTime', 'drawNumber', 'ticketNumber', 'buyerName', 'buyerPhone',
+    'numbers', 'valueUSD', 'valueBs', 'paymentMethod', 'paymentReference', 'voucherURL', 'validationStatus',
+    'voidedReason', 'voidedAt', 'closedReason', 'closedAt', 'sellerId', 'sellerName', 'sellerAgency'
+];
+const VENTAS_PAGINA_DEFECTO = 50;
+const VENTAS_PAGINA_MAXIMA = 500;
+
+/**
+ * Interpreta los filtros y la proyección de columnas de una consulta de ventas.
+ * Filtros: drawDate (YYYY-MM-DD), drawNumber, validationStatus (lista separada por comas), sellerId,
+ * paymentMethod y q (texto en comprador, teléfono, ticket o referencia, o un número jugado exacto).
+ * @param {object} query - Parámetros de la consulta (req.query).
+ * @returns {{error: string}|{filtros: object, columnas: Array<string>}}
+ */
+function parseVentasConsulta(query) {
+    const filtros = {};
+    if (query.drawDate !== undefined) {
+        if (!moment(String(query.drawDate), 'YYYY-MM-DD', true).isValid()) {
+            return { error: 'El parámetro "drawDate" debe tener el formato YYYY-MM-DD.' };
+        }
+        filtros.drawDate = String(query.drawDate);
+    }
+    if (query.drawNumber !== undefined) {
+        if (!/^\d+$/.test(String(query.drawNumber))) {
+            return { error: 'El parámetro "drawNumber" debe ser numérico.' };
+        }
+        filtros.drawNumber = parseInt(query.drawNumber, 10);
+    }
+    if (query.validationStatus !== undefined) {
+        filtros.validationStatus = String(query.validationStatus).split(',').map(estado => estado.trim()).filter(Boolean);
+    }
+    if (query.sellerId !== undefined) filtros.sellerId = String(query.sellerId);
+    if (query.paymentMethod !== undefined) filtros.paymentMethod = String(query.paymentMethod);
+    if (query.q !== undefined && String(query.q).trim() !== '') filtros.q = String(query.q).trim();
+
+    let columnas = VENTAS_COLUMNAS;
+    if (query.campos !== undefined) {
+        columnas = Array.from(new Set(String(query.campos).split(',').map(campo => campo.trim()).filter(Boolean)));
+        const desconocidas = columnas.filter(campo => !VENTAS_COLUMNAS.includes(campo));
+        if (columnas.length === 0 || desconocidas.length > 0) {
+            return { error: `Campos no válidos: ${desconocidas.join(', ') || '(vacío)'}. Campos disponibles: ${VENTAS_COLUMNAS.join(', ')}.` };
+        }
+    }
+    return { filtros, columnas };
+}
+
+/**
+ * Arma las condiciones WHERE de los filtros de ventas, agregando sus valores a 'params'.
+ * @param {object} filtros - Resultado de parseVentasConsulta.
+ * @param {Array} params - Parámetros de la consulta (se modifican).
+ * @returns {Array<string>} Condiciones a unir con AND.
+ */
+function buildVentasCondiciones(filtros, params) {
+    const condiciones = [];
+    if (filtros.drawDate) condiciones.push(`"drawDate" = $${params.push(filtros.drawDate)}::date`);
+    if (filtros.drawNumber !== undefined) condiciones.push(`"drawNumber" = $${params.push(filtros.drawNumber)}`);
+    if (filtros.validationStatus) condiciones.push(`"validationStatus" = ANY($${params.push(filtros.validationStatus)}::text[])`);
+    if (filtros.sellerId) condiciones.push(`"sellerId" = $${params.push(filtros.sellerId)}`);
+    if (filtros.paymentMethod) condiciones.push(`"paymentMethod" = $${params.push(filtros.paymentMethod)}`);
+    if (filtros.q) {
+        const patron = params.push(`%${filtros.q.replace(/[\\%_]/g, caracter => '\\' + caracter)}%`);
+        const numero = params.push(filtros.q);
+        condiciones.push(`("buyerName" ILIKE $${patron} OR "buyerPhone" ILIKE $${patron} OR "ticketNumber" ILIKE $${patron}
+            OR "paymentReference" ILIKE $${patron} OR numbers @> jsonb_build_array($${numero}::text))`);
+    }
+    return condiciones;
+}
+
+function encodeVentasCursor(purchaseDate, id) {
+    return Buffer.from(JSON.stringify([purchaseDate, id])).toString('base64url');
+}
+
+/**
+ * @param {string} cursor - Cursor devuelto como 'nextCursor' por una página anterior.
+ * @returns {{purchaseDate: string, id: string}|null} null si el cursor no es válido.
+ */
+function decodeVentasCursor(cursor) {
+    try {
+        const [purchaseDate, id] = JSON.parse(Buffer.from(String(cursor), 'base64url').toString('utf8'));
+        if (typeof purchaseDate !== 'string' || !moment(purchaseDate).isValid() || !/^\d+$/.test(String(id))) return null;
+        return { purchaseDate, id: String(id) };
+    } catch (e) {
+        return null;
+    }
+}
+
+/**
+ * Obtiene una página de ventas, de la más reciente a la más antigua, con paginación por clave
+ * ("purchaseDate", id): cada página es un recorrido del índice desde el cursor, sin OFFSET,
+ * así que cuesta lo mismo la primera página que la última.
+ * @param {object} filtros - Filtros (ver parseVentasConsulta).
+ * @param {Array<string>} columnas - Columnas a devolver.
+ * @param {number|null} limite - Tamaño de la página; null devuelve todas las ventas que cumplan los filtros.
+ * @param {{purchaseDate: string, id: string}|null} [cursor] - Última venta de la página anterior.
+ * @returns {Promise<{ventas: Array, nextCursor: string|null}>}
+ */
+async function getVentasPageFromDB(filtros, columnas, limite, cursor = null) {
+    const params = [];
+    const condiciones = buildVentasCondiciones(filtros, params);
+    if (cursor) {
+        // purchaseDate viaja como texto para no perder los microsegundos al pasar por Date de JS
+        condiciones.push(`("purchaseDate", id) < ($${params.push(cursor.purchaseDate)}::timestamptz, $${params.push(cursor.id)}::bigint)`);
+    }
+    const res = await pool.query(
+        `SELECT ${columnas.map(columna => `"${columna}"`).join(', ')}, "purchaseDate"::text AS "_cursorFecha", id AS "_cursorId"
+         FROM ventas
+         ${condiciones.length > 0 ? `WHERE ${condiciones.join(' AND ')}` : ''}
+         ORDER BY "purchaseDate" DESC, id DESC
+         ${limite === null ? '' : `LIMIT $${params.push(limite + 1)}`}`,
+        params
+    );
+    const hayMas = limite !== null && res.rows.length > limite;
+    const ventas = hayMas ? res.rows.slice(0, limite) : res.rows;
+    const ultima = ventas[ventas.length - 1];
+    const nextCursor = hayMas ? encodeVentasCursor(ultima._cursorFecha, ultima._cursorId) : null;
+    for (const venta of ventas) {
+        delete venta._cursorFecha;
+        delete venta._cursorId;
+        if (typeof venta.numbers === 'string') venta.numbers = JSON.parse(venta.numbers);
+    }
+    return { ventas, nextCursor };
+}
+
+// Exportación de ventas en streaming (GET /api/ventas/export)
+const VENTAS_EXPORT_LOTE = 1000; // Filas por FETCH del cursor
+const VENTAS_EXPORT_FORMATOS = {
+    ndjson: 'application/x-ndjson; charset=utf-8',
+    csv: 'text/csv; charset=utf-8'
+};
+
+/**
+ * Convierte un valor de una venta en un campo CSV (RFC 4180).
+ * Los textos que una planilla interpretaría como fórmula se prefijan con un apóstrofo. Los valores
+ * puramente numéricos (NUMERIC y BIGINT llegan de pg como texto, ej. '-5.00') se exportan tal cual.
+ * @param {*} valor - Valor de la columna.
+ * @returns {string}
+ */
+function csvValor(valor) {
+    if (valor === null || valor === undefined) return '';
+    let texto;
+    if (valor instanceof Date) {
+        texto = valor.toISOString();
+    } else if (Array.isArray(valor)) {
+        texto = valor.join(' ');
+    } else if (typeof valor === 'object') {
+        texto = JSON.stringify(valor);
+    } else {
+        texto = String(valor);
+    }
+    if (typeof valor === 'string' && /^[=+\-@\t\r]/.test(texto) && !/^[+-]?\d+(\.\d+)?$/.test(texto)) {
+        texto = `'${texto}`;
+    }
+    return /[",\r\n]/.test(texto) ? `"${texto.replace(/"/g, '""')}"` : texto;
+}
+
+/**
+ * Espera a que la respuesta pueda recibir más datos ('drain') o a que el cliente se desconecte.
+ * Si la respuesta ya está cerrada, 'close' ya se emitió y 'drain' no llegará: resuelve de inmediato.
+ * @param {object} res - Respuesta de Express.
+ * @returns {Promise<void>}
+ */
+function esperarDrenaje(res) {
+    return new Promise(resolve => {
+        if (res.destroyed || res.writableEnded) {
+            resolve();
+            return;
+        }
+        const listo = () => {
+            res.off('drain', listo);
+            res.off('close', listo);
+            resolve();
+        };
+        res.on('drain', listo);
+        res.on('close', listo);
+    });
+}
+
+/**
+ * Escribe en la respuesta las ventas que cumplen los filtros, leyéndolas por lotes de un cursor de
+ * PostgreSQL (DECLARE/FETCH dentro de una transacción de solo lectura). Solo hay un lote en memoria
+ * a la vez y no se pide el siguiente hasta que la respuesta drena, así que la memoria no depende del
+ * tamaño de la tabla y un cliente lento frena la lectura en lugar de acumular datos.
+ * @param {object} res - Respuesta de Express, con los encabezados aún sin enviar (se detecta si el cliente se desconecta).
+ * @param {object} filtros - Filtros (ver parseVentasConsulta).
+ * @param {Array<string>} columnas - Columnas a exportar.
+ * @param {string} formato - 'ndjson' o 'csv'.
+ * @returns {Promise<number>} Cantidad de ventas escritas.
+ */
+async function streamVentasExport(res, filtros, columnas, formato) {
+    const params = [];
+    const condiciones = buildVentasCondiciones(filtros, params);
+    let cerrado = false;
+    res.on('close', () => {
+        cerrado = true;
+    });
+
+    const client = await pool.connect();
+    let escritas = 0;
+    try {
+        await client.query('BEGIN READ ONLY');
+        await client.query(
+            `DECLARE ventas_export NO SCROLL CURSOR FOR
+             SELECT ${columnas.map(columna => `"${columna}"`).join(', ')} FROM ventas
+             ${condiciones.length > 0 ? `WHERE ${condiciones.join(' AND ')}` : ''}
+             ORDER BY "purchaseDate", id`,
+            params
+        );
+
+        res.status(200).type(VENTAS_EXPORT_FORMATOS[formato]);
+        res.set('Content-Disposition', `attachment; filename="ventas_${moment().tz(CARACAS_TIMEZONE).format('YYYYMMDD_HHmmss')}.${formato}"`);
+        if (formato === 'csv' && !cerrado && !res.write(columnas.join(',') + '\r\n')) {
+            await esperarDrenaje(res);
+        }
+
+        while (!cerrado) {
+            const lote = await client.query(`FETCH ${VENTAS_EXPORT_LOTE} FROM ventas_export`);
+            if (lote.rows.length === 0) break;
+            let bloque = '';
+            for (const venta of lote.rows) {
+                if (typeof venta.numbers === 'string') venta.numbers = JSON.parse(venta.numbers);
+                bloque += formato === 'csv'
+                    ? columnas.map(columna => csvValor(venta[columna])).join(',') + '\r\n'
+                    : JSON.stringify(venta) + '\n';
+            }
+            // El cliente pudo desconectarse durante el FETCH: no se escribe en un socket destruido
+            if (cerrado) break;
+            escritas += lote.rows.length;
+            if (!res.write(bloque)) {
+                await esperarDrenaje(res);
+            }
+            if (lote.rows.length < VENTAS_EXPORT_LOTE) break;
+        }
+        await client.query('CLOSE ventas_export');
+        await client.query('COMMIT');
+    } catch (error) {
+        await client.query('ROLLBACK').catch(() => {});
+        throw error;
+    } finally {
+        client.release();
+    }
+    if (!cerrado) res.end();
+    return escritas;
+}
+
+/**
+ * Normaliza una fecha de sorteo (string o Date devuelto por pg para columnas DATE) a 'YYYY-MM-DD'.
+ * @param {string|Date} fecha - Fecha del sorteo.
+ * @returns {string} Fecha en formato YYYY-MM-DD.
+ */
+function toDrawDateString(fecha) {
+    return typeof fecha === 'string' ? fecha.slice(0, 10) : moment(fecha).format('YYYY-MM-DD');
+}
+
+/**
+ * Obtiene las ventas de una fecha de sorteo filtradas por estado, sin leer el resto de la tabla.
+ * @param {string|Date} drawDate - Fecha del sorteo.
+ * @param {Array<string>} estados - Estados de validación a incluir.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<Array>} Array de objetos de ventas.
+ */
+async function getVentasByDrawDateFromDB(drawDate, estados, client = null) {
+    return withDBClient(client, async (client) => {
+        const res = await client.query(
+            'SELECT * FROM ventas WHERE "drawDate" = $1::date AND "validationStatus" = ANY($2::text[])',
+            [toDrawDateString(drawDate), estados]
+        );
+        return res.rows.map(row => ({
+            ...row,
+            numbers: typeof row.numbers === 'string' ? JSON.parse(row.numbers) : row.numbers
+        }));
+    });
+}
+
+/**
+ * Formas en que un resultado de lotería puede aparecer en las ventas: relleno con ceros a los dígitos
+ * de cada espacio de números permitido (ej. '27' -> '027', '0027', '00027').
+ * @param {string|number} numero - Número tal como viene en el resultado.
+ * @returns {Array<string>}
+ */
+function variantesNumeroVendido(numero) {
+    const texto = String(numero).trim();
+    const digitos = ESPACIOS_NUMEROS_PERMITIDOS.map(total => createNumerosEspacio(total).digitos);
+    return Array.from(new Set(digitos.filter(d => d >= texto.length).map(d => texto.padStart(d, '0'))));
+}
+
+/**
+ * Obtiene las ventas de un sorteo que tienen alguno de los números indicados. Cada número se resuelve
+ * con el índice de 'ventas_numeros' ((draw_number, numero) -> venta), sin recorrer 'ventas'.
+ * @param {number} drawNumber - Número (correlativo) del sorteo.
+ * @param {Array<string>} numeros - Números tal como se vendieron (ej. ['007', '427']).
+ * @param {string|Date|null} [drawDate] - Si se indica, solo ventas de esa fecha de sorteo.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<Array>} Array de objetos de ventas, por fecha de compra.
+ */
+async function getVentasByNumerosFromDB(drawNumber, numeros, drawDate = null, client = null) {
+    return withDBClient(client, async (client) => {
+        const res = await client.query(
+            `SELECT v.* FROM ventas v
+             WHERE v.id IN (SELECT venta_id FROM ventas_numeros WHERE draw_number = $1 AND numero = ANY($2::text[]))
+               AND ($3::date IS NULL OR v."drawDate" = $3::date)
+             ORDER BY v."purchaseDate", v.id`,
+            [drawNumber, numeros.map(n => String(n)), drawDate ? toDrawDateString(drawDate) : null]
+        );
+        for (const row of res.rows) {
+            if (typeof row.numbers === 'string') row.numbers = JSON.parse(row.numbers);
+        }
+        return res.rows;
+    });
+}
+
+/**
+ * Obtiene en una sola consulta las ventas de un sorteo que tienen alguno de los números ganadores.
+ * Cada número se resuelve con el índice de 'ventas_numeros', así que el costo depende de la cantidad
+ * de ganadores y no del tamaño de 'ventas'.
+ * @param {number} drawNumber - Número (correlativo) del sorteo.
+ * @param {string|Date} drawDate - Fecha del sorteo.
+ * @param {Array<string>} numeros - Números ganadores tal como se venden (ver variantesNumeroVendido).
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<Array>} Ventas ganadoras, por fecha de compra, cada una con 'aciertos' (sus números ganadores).
+ */
+async function getVentasGanadorasFromDB(drawNumber, drawDate, numeros, client = null) {
+    if (numeros.length === 0) return [];
+    return withDBClient(client, async (client) => {
+        const res = await client.query(VENTAS_GANADORAS_SQL, [drawNumber, toDrawDateString(drawDate), numeros]);
+        for (const row of res.rows) {
+            if (typeof row.numbers === 'string') row.numbers = JSON.parse(row.numbers);
+        }
+        return res.rows;
+    });
+}
+
+/**
+ * Libera en 'numeros' los números de una venta, salvo los que ya no le pertenecen: los que están
+ * asociados a otro sorteo (se revendieron tras avanzar el correlativo) o que otra venta del mismo
+ * sorteo que no sea 'Falso' tiene. Ambas verificaciones usan 'ventas_numeros'.
+ * Debe ejecutarse en la transacción que cambia el estado de la venta.
+ * @param {string|number} ventaId - ID de la venta.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @returns {Promise<Array<string>>} Los números liberados.
+ */
+async function releaseNumerosDeVentaInDB(ventaId, client) {
+    const res = await client.query(
+        `UPDATE numeros n SET comprado = FALSE, "originalDrawNumber" = NULL
+         FROM ventas_numeros vn
+         WHERE vn.venta_id = $1 AND n.numero = vn.numero AND n."originalDrawNumber" = vn.draw_number
+           AND NOT EXISTS (
+               SELECT 1 FROM ventas_numeros otro JOIN ventas v ON v.id = otro.venta_id
+               WHERE otro.draw_number = vn.draw_number AND otro.numero = vn.numero
+                 AND otro.venta_id <> vn.venta_id AND v."validationStatus" IS DISTINCT FROM 'Falso'
+           )
+         RETURNING n.numero`,
+        [ventaId]
+    );
+    return res.rows.map(row => row.numero).sort();
+}
+
+// Filas por (fecha, estado) en 'contadores_ventas'; cada venta suma en la ranura id % CONTADORES_VENTAS_RANURAS
+const CONTADORES_VENTAS_RANURAS = 16;
+
+/**
+ * Lee los contadores incrementales de ventas de una fecha de sorteo (tabla 'contadores_ventas').
+ * Los contadores los mantiene un trigger sobre 'ventas' en la misma transacción de cada venta o
+ * cambio de estado, así que la lectura suma unas pocas filas por clave primaria (una por ranura),
+ * sin recorrer 'ventas'.
+ * @param {string|Date} drawDate - Fecha del sorteo.
+ * @param {Array<string>} [estados] - Estados de validación a sumar (por defecto Confirmado y Pendiente).
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<{tickets: number, numeros: number, totalUSD: number, totalBs: number}>}
+ */
+async function getSalesTotalsFromDB(drawDate, estados = ESTADOS_VENTA_ACTIVOS, client = null) {
+    return withDBClient(client, async (client) => {
+        const res = await client.query(
+            `SELECT COALESCE(SUM(tickets), 0)::int AS tickets,
+                    COALESCE(SUM(numeros), 0)::int AS numeros,
+                    COALESCE(SUM(total_usd), 0) AS total_usd,
+                    COALESCE(SUM(total_bs), 0) AS total_bs
+             FROM contadores_ventas
+             WHERE draw_date = $1::date AND validation_status = ANY($2::text[])`,
+            [toDrawDateString(drawDate), estados]
+        );
+        const row = res.rows[0];
+        return {
+            tickets: row.tickets,
+            numeros: row.numeros,
+            totalUSD: parseFloat(row.total_usd) || 0,
+            totalBs: parseFloat(row.total_bs) || 0
+        };
+    });
+}
+
+/**
+ * Cambia en una sola sentencia el estado de todas las ventas de una fecha de sorteo que estén en ciertos estados.
+ * @param {string|Date} drawDate - Fecha del sorteo.
+ * @param {Array<string>} estadosActuales - Solo se actualizan las ventas en estos estados.
+ * @param {string} validationStatus - Nuevo estado de validación.
+ * @param {string|null} voidedReason - Razón de anulación (si aplica).
+ * @param {string|null} voidedAt - Timestamp de anulación (si aplica).
+ * @param {string|null} closedReason - Razón de cierre (si aplica).
+ * @param {string|null} closedAt - Timestamp de cierre (si aplica).
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<Array>} Las ventas actualizadas.
+ */
+async function updateVentasStatusByDrawInDB(drawDate, estadosActuales, validationStatus, voidedReason, voidedAt, closedReason, closedAt, client = null) {
+    return withDBClient(client, async (client) => {
+        const res = await client.query(
+            `UPDATE ventas SET
+                "validationStatus" = $3,
+                "voidedReason" = $4,
+                "voidedAt" = $5,
+                "closedReason" = $6,
+                "closedAt" = $7
+             WHERE "drawDate" = $1::date AND "validationStatus" = ANY($2::text[])
+             RETURNING *;`,
+            [toDrawDateString(drawDate), estadosActuales, validationStatus, voidedReason, voidedAt, closedReason, closedAt]
+        );
         return res.rows.map(row => ({
             ...row,
             numbers: typeof row.numbers === 'string' ? JSON.parse(row.numbers) : row.numbers
         }));
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Inserta una nueva venta en la base de datos.
  * @param {object} ventaData - Los datos de la venta a insertar.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function insertVentaInDB(ventaData) {
-    const client = await pool.connect();
-    try {
+async function insertVentaInDB(ventaData, client = null) {
+    return withDBClient(client, async (client) => {
         // INICIO DE MODIFICACIÓN: Añadir campos de vendedor a la inserción
         const query = `
             INSERT INTO ventas (
@@ -216,15 +1800,13 @@ async function insertVentaInDB(ventaData) {
         `;
         const values = [
             ventaData.id, ventaData.purchaseDate, ventaData.drawDate, ventaData.drawTime, ventaData.drawNumber, ventaData.ticketNumber,
-            ventaData.buyerName, venta.buyerPhone, JSON.stringify(ventaData.numbers), ventaData.valueUSD, ventaData.valueBs, ventaData.paymentMethod,
+            ventaData.buyerName, ventaData.buyerPhone, JSON.stringify(ventaData.numbers), ventaData.valueUSD, ventaData.valueBs, ventaData.paymentMethod,
             ventaData.paymentReference, ventaData.voucherURL, ventaData.validationStatus,
             ventaData.sellerId, ventaData.sellerName, ventaData.sellerAgency // NUEVOS CAMPOS
         ];
         // FIN DE MODIFICACIÓN: Añadir campos de vendedor a la inserción
         await client.query(query, values);
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
@@ -235,11 +1817,11 @@ async function insertVentaInDB(ventaData) {
  * @param {string|null} voidedAt - Timestamp de anulación (si aplica).
  * @param {string|null} closedReason - Razón de cierre (si aplica).
  * @param {string|null} closedAt - Timestamp de cierre (si aplica).
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  * @returns {Promise<object|null>} La venta actualizada o null si no se encontró.
  */
-async function updateVentaStatusInDB(ventaId, validationStatus, voidedReason = null, voidedAt = null, closedReason = null, closedAt = null) {
-    const client = await pool.connect();
-    try {
+async function updateVentaStatusInDB(ventaId, validationStatus, voidedReason = null, voidedAt = null, closedReason = null, closedAt = null, client = null) {
+    return withDBClient(client, async (client) => {
         const query = `
             UPDATE ventas SET
                 "validationStatus" = $1,
@@ -252,32 +1834,28 @@ async function updateVentaStatusInDB(ventaId, validationStatus, voidedReason = n
         `;
         const res = await client.query(query, [validationStatus, voidedReason, voidedAt, closedReason, closedAt, ventaId]);
         return res.rows[0] || null;
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Actualiza la URL del comprobante en una venta específica.
  * @param {number} ventaId - ID de la venta.
  * @param {string} voucherURL - La nueva URL del comprobante.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function updateVentaVoucherURLInDB(ventaId, voucherURL) {
-    const client = await pool.connect();
-    try {
+async function updateVentaVoucherURLInDB(ventaId, voucherURL, client = null) {
+    return withDBClient(client, async (client) => {
         await client.query('UPDATE ventas SET "voucherURL" = $1 WHERE id = $2', [voucherURL, ventaId]);
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Inserta un nuevo comprobante en la base de datos.
  * @param {object} comprobanteData - Los datos del comprobante a insertar.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function insertComprobanteInDB(comprobanteData) {
-    const client = await pool.connect();
-    try {
+async function insertComprobanteInDB(comprobanteData, client = null) {
+    return withDBClient(client, async (client) => {
         const query = `
             INSERT INTO comprobantes (
                 id, "ventaId", comprador, telefono, comprobante_nombre, comprobante_tipo, fecha_compra, url_comprobante
@@ -289,49 +1867,202 @@ async function insertComprobanteInDB(comprobanteData) {
             comprobanteData.url_comprobante
         ];
         await client.query(query, values);
-    } finally {
-        client.release();
+    });
+}
+
+// INICIO DE NUEVA LÓGICA: SECUENCIA DE TICKETS POR FECHA
+// El ticketNumber es 'YYYYMMDD-NNNNN' (fecha del sorteo y secuencial), así que la secuencia se lleva por ese
+// prefijo: dos sorteos con la misma fecha comparten fila y nunca se reparten el mismo rango.
+// Bloques de números de ticket ya reservados por este proceso, por prefijo de fecha: { siguiente, maximo, pendiente }.
+const ticketSequenceBlocks = new Map();
+// Sube al descartar los bloques (limpiar-datos): una reserva en vuelo de antes no se guarda
+let ticketSequenceGeneracion = 0;
+// Aviso en CONFIGURACION_NOTIFY_CHANNEL para que todos los procesos descarten sus bloques
+const TICKET_SEQUENCE_RESET_PAYLOAD = 'secuencia_tickets';
+
+/**
+ * Reserva en la DB un bloque de números de ticket para una fecha de ticket.
+ * Se ejecuta fuera de la transacción de la compra (autocommit), así que el bloqueo
+ * sobre la fila de la fecha en 'secuencia_tickets' dura solo esta sentencia y no toca 'configuracion'.
+ * @param {string} fechaPrefijo - Fecha del sorteo como aparece en el ticketNumber ('YYYYMMDD').
+ * @param {number} blockSize - Cantidad de números a reservar.
+ * @returns {Promise<{siguiente: number, maximo: number}>} Rango reservado (ambos inclusive).
+ */
+async function reserveTicketSequenceBlockInDB(fechaPrefijo, blockSize) {
+    const res = await pool.query(
+        `INSERT INTO secuencia_tickets (fecha_prefijo, ultimo_asignado)
+         VALUES ($1, $2)
+         ON CONFLICT (fecha_prefijo) DO UPDATE SET
+             ultimo_asignado = secuencia_tickets.ultimo_asignado + $2
+         RETURNING ultimo_asignado;`,
+        [fechaPrefijo, blockSize]
+    );
+    const maximo = res.rows[0].ultimo_asignado;
+    return { siguiente: maximo - blockSize + 1, maximo };
+}
+
+/**
+ * Entrega el siguiente número secuencial de ticket para una fecha, usando el bloque
+ * reservado en memoria y pidiendo uno nuevo a la DB solo cuando se agota.
+ * @param {string} fechaPrefijo - Fecha del sorteo como aparece en el ticketNumber ('YYYYMMDD').
+ * @returns {Promise<number>} Número secuencial a usar en el ticketNumber.
+ */
+async function nextTicketSequenceNumber(fechaPrefijo) {
+    let block = ticketSequenceBlocks.get(fechaPrefijo);
+    while (!block || block.siguiente > block.maximo) {
+        if (block && block.pendiente) {
+            await block.pendiente; // Otra solicitud ya está reservando el siguiente bloque
+        } else {
+            const generacion = ticketSequenceGeneracion;
+            const pendiente = reserveTicketSequenceBlockInDB(fechaPrefijo, TICKET_SEQUENCE_BLOCK_SIZE);
+            ticketSequenceBlocks.set(fechaPrefijo, { siguiente: 1, maximo: 0, pendiente });
+            try {
+                const reservado = await pendiente;
+                // Si los bloques se descartaron mientras tanto, este rango es de antes del reseteo: se pide otro
+                if (generacion === ticketSequenceGeneracion) {
+                    ticketSequenceBlocks.set(fechaPrefijo, { ...reservado, pendiente: null });
+                }
+            } catch (error) {
+                if (generacion === ticketSequenceGeneracion) ticketSequenceBlocks.delete(fechaPrefijo);
+                throw error;
+            }
+        }
+        block = ticketSequenceBlocks.get(fechaPrefijo);
+    }
+    return block.siguiente++;
+}
+
+/**
+ * Descarta los bloques de tickets reservados por este proceso (tras reiniciar 'secuencia_tickets').
+ */
+function resetTicketSequenceBlocks() {
+    ticketSequenceGeneracion++;
+    ticketSequenceBlocks.clear();
+}
+// FIN DE NUEVA LÓGICA: SECUENCIA DE TICKETS POR FECHA
+
+// INICIO DE NUEVA LÓGICA: GENERADOR DE IDS PARA VENTAS Y COMPROBANTES
+const ID_NODE_LEASE_SECONDS = 120; // Duración del arriendo de un ID de nodo en 'id_generador_nodos'
+let idGenerator = null;
+
+/**
+ * Obtiene el ID de nodo de este proceso para el generador de IDs.
+ * Si la variable de entorno ID_GENERATOR_NODE_ID está definida se usa tal cual; si no,
+ * se arrienda un nodo libre (o vencido) en la tabla 'id_generador_nodos' y se renueva
+ * periódicamente, para que varios procesos de Node nunca compartan el mismo nodo.
+ * @returns {Promise<number>} El ID de nodo asignado (0-1023).
+ */
+async function acquireIdGeneratorNodeId() {
+    if (process.env.ID_GENERATOR_NODE_ID !== undefined) {
+        return parseInt(process.env.ID_GENERATOR_NODE_ID, 10);
+    }
+    const owner = `${require('os').hostname()}:${process.pid}:${crypto.randomBytes(4).toString('hex')}`;
+    for (let intento = 0; intento < 5; intento++) {
+        const res = await pool.query(
+            `INSERT INTO id_generador_nodos (node_id, owner, lease_until)
+             SELECT n, $1, NOW() + make_interval(secs => $2)
+             FROM generate_series(0, $3::int) AS n
+             WHERE NOT EXISTS (
+                 SELECT 1 FROM id_generador_nodos x WHERE x.node_id = n AND x.lease_until > NOW()
+             )
+             ORDER BY n
+             LIMIT 1
+             ON CONFLICT (node_id) DO UPDATE SET
+                 owner = EXCLUDED.owner,
+                 lease_until = EXCLUDED.lease_until
+             WHERE id_generador_nodos.lease_until <= NOW()
+             RETURNING node_id;`,
+            [owner, ID_NODE_LEASE_SECONDS, MAX_NODE_ID]
+        );
+        if (res.rows.length > 0) {
+            const nodeId = res.rows[0].node_id;
+            // Renovar el arriendo mientras el proceso siga vivo
+            setInterval(() => {
+                pool.query(
+                    'UPDATE id_generador_nodos SET lease_until = NOW() + make_interval(secs => $1) WHERE node_id = $2 AND owner = $3',
+                    [ID_NODE_LEASE_SECONDS, nodeId, owner]
+                ).catch(error => console.error('ERROR_ID_GENERATOR: Fallo al renovar el arriendo del ID de nodo:', error.message));
+            }, (ID_NODE_LEASE_SECONDS * 1000) / 3).unref();
+            return nodeId;
+        }
+        // Otro proceso tomó el mismo nodo al mismo tiempo; reintentar con el siguiente libre
+    }
+    throw new Error('No hay IDs de nodo libres para el generador de IDs.');
+}
+
+/**
+ * Inicializa el generador de IDs del proceso. Debe llamarse al arrancar, después de ensureTablesExist.
+ */
+async function initIdGenerator() {
+    const nodeId = await acquireIdGeneratorNodeId();
+    idGenerator = createIdGenerator(nodeId);
+    console.log(`DEBUG_ID_GENERATOR: Generador de IDs inicializado con el nodo ${nodeId}.`);
+}
+
+/**
+ * Genera un ID único, monotónico y ordenado por tiempo para 'ventas' y 'comprobantes'.
+ * @returns {string} El ID como string decimal (columna BIGINT).
+ */
+function generateId() {
+    if (!idGenerator) {
+        throw new Error('El generador de IDs no ha sido inicializado.');
     }
+    return idGenerator.nextId();
 }
+// FIN DE NUEVA LÓGICA: GENERADOR DE IDS PARA VENTAS Y COMPROBANTES
 
 /**
  * Obtiene los horarios de Zulia desde la base de datos.
- * @returns {Promise<object>} Objeto con horarios de zulia y chance.
+ * @returns {Promise<object>} Horas por tipo de lotería ({ zulia: [...], chance: [...], ... }), en el orden guardado.
  */
 async function getHorariosZuliaFromDB() {
     const client = await pool.connect();
     try {
-        const res = await client.query('SELECT hora FROM horarios_zulia');
-        // Asumiendo que solo hay una columna 'hora' y que los tipos 'zulia' y 'chance' se manejan en el frontend
-        // o si hay una columna 'tipo' en la DB, se debería filtrar por ella.
-        // Por la estructura original, asumimos que 'horarios_zulia' solo almacena las horas de Zulia.
-        return { zulia: res.rows.map(row => row.hora), chance: [] }; // Adaptar al formato esperado por el frontend
+        const res = await client.query('SELECT tipo_loteria, hora FROM horarios_zulia ORDER BY id');
+        const horarios = { zulia: [], chance: [] }; // Tipos que el frontend espera siempre
+        res.rows.forEach(row => {
+            (horarios[row.tipo_loteria] || (horarios[row.tipo_loteria] = [])).push(row.hora);
+        });
+        return horarios;
     } finally {
         client.release();
     }
 }
 
 /**
- * Actualiza los horarios de Zulia en la base de datos.
- * @param {string} tipo - Tipo de lotería ('zulia' o 'chance').
- * @param {Array<string>} horarios - Array de strings de horarios.
+ * Reemplaza los horarios de un tipo de lotería. Cada horario puede indicar la clave de 'premios' que le
+ * corresponde ({ hora, premio }); si solo se envía la hora, conserva la clave que esa hora ya tenía.
+ * En la misma transacción encola el recálculo completo de los ganadores que dependen de estas reglas
+ * (ver encolarRecalculoGanadores); llamar a kickJobWorker después.
+ * @param {string} tipo - Tipo de lotería (ej. 'zulia' o 'chance').
+ * @param {Array<string|{hora: string, premio: string}>} horarios - Horarios en orden.
+ * @returns {Promise<number>} Cantidad de recálculos de ganadores encolados.
  */
 async function updateHorariosInDB(tipo, horarios) {
     const client = await pool.connect();
     try {
         await client.query('BEGIN');
-        // Si la tabla horarios_zulia solo tiene 'hora', asumimos que 'tipo' no se almacena en la DB.
-        // Si 'tipo' fuera una columna, la lógica sería diferente.
-        // Para este caso, truncamos y reinsertamos si es 'zulia'.
-        if (tipo === 'zulia') {
-            await client.query('TRUNCATE TABLE horarios_zulia RESTART IDENTITY;');
-            for (const hora of horarios) {
-                await client.query('INSERT INTO horarios_zulia (hora) VALUES ($1)', [hora]);
-            }
-        }
-        // Si tuvieras una tabla 'horarios_chance' o una columna 'tipo' en 'horarios_zulia',
-        // la lógica para 'chance' iría aquí.
+        const anteriores = await client.query('SELECT hora, premio_clave FROM horarios_zulia WHERE tipo_loteria = $1', [tipo]);
+        const premioAnterior = new Map(anteriores.rows.map(row => [normalizarHoraSorteo(row.hora), row.premio_clave]));
+        const horas = horarios.map(h => (typeof h === 'string' ? h : h.hora).trim());
+        const premios = horarios.map((h, i) =>
+            (typeof h === 'object' && h.premio) ? h.premio : (premioAnterior.get(normalizarHoraSorteo(horas[i])) || null)
+        );
+        await client.query('DELETE FROM horarios_zulia WHERE tipo_loteria = $1', [tipo]);
+        // Una sola sentencia; WITH ORDINALITY conserva el orden recibido en los IDs
+        await client.query(
+            `INSERT INTO horarios_zulia (tipo_loteria, hora, premio_clave)
+             SELECT $1, hora, premio FROM unnest($2::text[], $3::text[]) WITH ORDINALITY AS h(hora, premio, orden)
+             ORDER BY orden`,
+            [tipo, horas, premios]
+        );
+        // Las reglas de 'zulia' también aplican a los tipos que no definen las suyas
+        const encolados = await encolarRecalculoGanadores(client, {
+            tipoLoteria: tipo === 'zulia' ? null : tipo,
+            desde: moment().tz(CARACAS_TIMEZONE).subtract(GANADORES_RECALCULO_HORARIOS_DIAS, 'days').format('YYYY-MM-DD')
+        });
         await client.query('COMMIT');
+        return encolados;
     } catch (e) {
         await client.query('ROLLBACK'); // Revertir en caso de error
         throw e;
@@ -340,32 +2071,51 @@ async function updateHorariosInDB(tipo, horarios) {
     }
 }
 
+/**
+ * Reglas de premios por hora de sorteo de un tipo de lotería: qué clave de 'premios' (ej. 'sorteo12PM')
+ * paga los resultados de cada hora. Las horas que el tipo no define toman la regla de 'zulia'.
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<Map<string, string>>} Hora normalizada -> clave de 'premios'.
+ */
+async function getReglasPremiosFromDB(tipoLoteria, client = null) {
+    return withDBClient(client, async (client) => {
+        const res = await client.query(
+            `SELECT hora, premio_clave, tipo_loteria = $1 AS propia FROM horarios_zulia
+             WHERE premio_clave IS NOT NULL AND tipo_loteria IN ($1, 'zulia')
+             ORDER BY propia, id`,
+            [tipoLoteria]
+        );
+        // Las reglas propias del tipo van al final y reemplazan a las de 'zulia'
+        return new Map(res.rows.map(row => [normalizarHoraSorteo(row.hora), row.premio_clave]));
+    });
+}
+
 /**
  * Obtiene los resultados de Zulia desde la base de datos.
  * @param {string} fecha - Fecha de los resultados.
  * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @param {boolean} [bloquear] - Si se bloquea la fila (FOR UPDATE) hasta el fin de la transacción del cliente.
  * @returns {Promise<Array>} Array de objetos de resultados.
  */
-async function getResultadosZuliaFromDB(fecha, tipoLoteria) {
-    const client = await pool.connect();
-    try {
+async function getResultadosZuliaFromDB(fecha, tipoLoteria, client = null, bloquear = false) {
+    return withDBClient(client, async (client) => {
         const res = await client.query(
-            'SELECT data FROM resultados_zulia WHERE (data->>\'fecha\')::text = $1 AND (data->>\'tipoLoteria\')::text = $2',
+            `SELECT data FROM resultados_zulia WHERE (data->>'fecha')::text = $1 AND (data->>'tipoLoteria')::text = $2${bloquear ? ' FOR UPDATE' : ''}`,
             [fecha, tipoLoteria]
         );
         return res.rows.map(row => row.data); // 'data' es JSONB, así que ya viene parseado por el driver
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Inserta o actualiza resultados de sorteo en la base de datos.
  * @param {object} resultData - Los datos del resultado a insertar/actualizar.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function upsertResultadosZuliaInDB(resultData) {
-    const client = await pool.connect();
-    try {
+async function upsertResultadosZuliaInDB(resultData, client = null) {
+    return withDBClient(client, async (client) => {
         const query = `
             INSERT INTO resultados_zulia (data)
             VALUES ($1)
@@ -374,37 +2124,33 @@ async function upsertResultadosZuliaInDB(resultData) {
         `;
         const values = [JSON.stringify(resultData)]; // Stringify the whole object for JSONB
         await client.query(query, values);
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Obtiene los premios desde la base de datos para una fecha específica.
  * @param {string} fecha - Fecha de los premios.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  * @returns {Promise<object>} Objeto con los premios para la fecha.
  */
-async function getPremiosFromDB(fecha) {
-    const client = await pool.connect();
-    try {
+async function getPremiosFromDB(fecha, client = null) {
+    return withDBClient(client, async (client) => {
         // Asumiendo que la tabla 'premios' almacena un objeto JSONB completo por fecha
         const res = await client.query('SELECT data FROM premios WHERE (data->>\'fechaSorteo\')::text = $1 LIMIT 1', [fecha]);
         if (res.rows.length > 0) {
             return res.rows[0].data; // 'data' es JSONB, ya viene parseado
         }
         return null;
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
  * Inserta o actualiza premios en la base de datos.
  * @param {object} premiosData - Los datos de los premios a insertar/actualizar.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function upsertPremiosInDB(premiosData) {
-    const client = await pool.connect();
-    try {
+async function upsertPremiosInDB(premiosData, client = null) {
+    return withDBClient(client, async (client) => {
         const query = `
             INSERT INTO premios (data)
             VALUES ($1)
@@ -414,41 +2160,35 @@ async function upsertPremiosInDB(premiosData) {
         // Asumiendo que premiosData tiene una propiedad 'fechaSorteo' para el ON CONFLICT
         const values = [JSON.stringify(premiosData)]; // Stringify the whole object for JSONB
         await client.query(query, values);
-    } finally {
-        client.release();
-    }
+    });
 }
 
 /**
- * Obtiene los ganadores desde la base de datos.
+ * Obtiene la cabecera de ganadores de un sorteo procesado (fecha de proceso, detalle por hora, total).
+ * Los tickets ganadores están en 'ganadores_tickets'.
  * @param {string} fecha - Fecha del sorteo.
  * @param {number} numeroSorteo - Número de sorteo.
  * @param {string} tipoLoteria - Tipo de lotería.
- * @returns {Promise<Array>} Array de objetos de ganadores.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<object|null>} La cabecera guardada o null si el sorteo no se ha procesado.
  */
-async function getGanadoresFromDB(fecha, numeroSorteo, tipoLoteria) {
-    const client = await pool.connect();
-    try {
+async function getGanadoresEntryFromDB(fecha, numeroSorteo, tipoLoteria, client = null) {
+    return withDBClient(client, async (client) => {
         const res = await client.query(
             'SELECT data FROM ganadores WHERE (data->>\'drawDate\')::text = $1 AND (data->>\'drawNumber\')::int = $2 AND (data->>\'lotteryType\')::text = $3 LIMIT 1',
             [fecha, numeroSorteo, tipoLoteria]
         );
-        if (res.rows.length > 0 && res.rows[0].data && res.rows[0].data.winners) {
-            return res.rows[0].data.winners;
-        }
-        return [];
-    } finally {
-        client.release();
-    }
+        return res.rows.length > 0 ? res.rows[0].data : null;
+    });
 }
 
 /**
- * Inserta o actualiza ganadores en la base de datos.
- * @param {object} ganadoresEntry - La entrada de ganadores a insertar/actualizar.
+ * Inserta o actualiza la cabecera de ganadores de un sorteo en la base de datos.
+ * @param {object} ganadoresEntry - La cabecera a insertar/actualizar ({ drawDate, drawNumber, lotteryType, ... }).
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
  */
-async function upsertGanadoresInDB(ganadoresEntry) {
-    const client = await pool.connect();
-    try {
+async function upsertGanadoresInDB(ganadoresEntry, client = null) {
+    return withDBClient(client, async (client) => {
         const query = `
             INSERT INTO ganadores (data)
             VALUES ($1)
@@ -457,9 +2197,217 @@ async function upsertGanadoresInDB(ganadoresEntry) {
         `;
         const values = [JSON.stringify(ganadoresEntry)]; // Stringify the whole object for JSONB
         await client.query(query, values);
-    } finally {
-        client.release();
+    });
+}
+
+// Tickets ganadores (ganadores_tickets): una fila por ticket y sorteo, con su estado de pago.
+// 'anulado' lo pone el cálculo de ganadores a un ticket pagado que dejó de ganar (no se puede asignar a mano).
+const GANADORES_ESTADOS_PAGO = ['pendiente', 'pagado'];
+const GANADORES_ESTADOS_CONSULTA = [...GANADORES_ESTADOS_PAGO, 'anulado'];
+const GANADORES_PAGINA_DEFECTO = 50;
+const GANADORES_PAGINA_MAXIMA = 500;
+
+/**
+ * Convierte una fila de 'ganadores_tickets' al formato de ganador de la API.
+ * @param {object} row - Fila de 'ganadores_tickets'.
+ * @returns {object}
+ */
+function ganadorFromRow(row) {
+    return {
+        ventaId: row.venta_id,
+        ticketNumber: row.ticket_number,
+        buyerName: row.buyer_name,
+        buyerPhone: row.buyer_phone,
+        numbers: row.numbers,
+        drawDate: toDrawDateString(row.draw_date),
+        drawNumber: row.draw_number,
+        lotteryType: row.lottery_type,
+        purchaseDate: row.purchase_date,
+        coincidentNumbers: row.coincident_numbers,
+        totalPotentialPrizeUSD: parseFloat(row.premio_usd),
+        totalPotentialPrizeBs: parseFloat(row.premio_bs),
+        detalleHoras: row.detalle_horas,
+        estadoPago: row.estado_pago,
+        pagadoAt: row.pagado_at,
+        pagoReferencia: row.pago_referencia,
+        premioPagadoUSD: row.premio_usd_pagado === null ? null : parseFloat(row.premio_usd_pagado)
+    };
+}
+
+/**
+ * @param {string} purchaseDate - Fecha de compra del último ganador de la página (texto de timestamptz).
+ * @param {string} ticketNumber - Ticket del último ganador de la página.
+ * @returns {string} Cursor opaco para pedir la página siguiente.
+ */
+function encodeGanadoresCursor(purchaseDate, ticketNumber) {
+    return Buffer.from(JSON.stringify([purchaseDate, ticketNumber])).toString('base64url');
+}
+
+/**
+ * @param {string} cursor - Cursor devuelto como 'nextCursor' por una página anterior.
+ * @returns {{purchaseDate: string, ticketNumber: string}|null} null si el cursor no es válido.
+ */
+function decodeGanadoresCursor(cursor) {
+    try {
+        const [purchaseDate, ticketNumber] = JSON.parse(Buffer.from(String(cursor), 'base64url').toString('utf8'));
+        if (typeof purchaseDate !== 'string' || !moment(purchaseDate).isValid() || typeof ticketNumber !== 'string') return null;
+        return { purchaseDate, ticketNumber };
+    } catch (e) {
+        return null;
+    }
+}
+
+/**
+ * Obtiene una página de los ganadores de un sorteo por fecha de compra, con paginación por clave
+ * (purchase_date, ticket_number) sobre idx_ganadores_tickets_sorteo_compra.
+ * @param {string} fecha - Fecha del sorteo.
+ * @param {number} numeroSorteo - Número de sorteo.
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {object} [opciones] - { limite (null = todos), cursor, estadoPago }.
+ * @returns {Promise<{ganadores: Array, nextCursor: string|null}>}
+ */
+async function getGanadoresPageFromDB(fecha, numeroSorteo, tipoLoteria, { limite = null, cursor = null, estadoPago = null } = {}) {
+    const params = [fecha, numeroSorteo, tipoLoteria];
+    const condiciones = ['draw_date = $1::date', 'draw_number = $2', 'lottery_type = $3'];
+    if (estadoPago) condiciones.push(`estado_pago = $${params.push(estadoPago)}`);
+    if (cursor) {
+        // purchase_date viaja como texto para no perder los microsegundos al pasar por Date de JS
+        condiciones.push(`(purchase_date, ticket_number) > ($${params.push(cursor.purchaseDate)}::timestamptz, $${params.push(cursor.ticketNumber)})`);
     }
+    const res = await pool.query(
+        `SELECT *, purchase_date::text AS _cursor_fecha FROM ganadores_tickets
+         WHERE ${condiciones.join(' AND ')}
+         ORDER BY purchase_date, ticket_number
+         ${limite === null ? '' : `LIMIT $${params.push(limite + 1)}`}`,
+        params
+    );
+    const hayMas = limite !== null && res.rows.length > limite;
+    const filas = hayMas ? res.rows.slice(0, limite) : res.rows;
+    const ultima = filas[filas.length - 1];
+    return {
+        ganadores: filas.map(ganadorFromRow),
+        nextCursor: hayMas ? encodeGanadoresCursor(ultima._cursor_fecha, ultima.ticket_number) : null
+    };
+}
+
+/**
+ * Obtiene los premios más recientes de un comprador (por idx_ganadores_tickets_buyer_phone).
+ * @param {string} buyerPhone - Teléfono del comprador.
+ * @param {number} limite - Máximo de ganadores a devolver.
+ * @returns {Promise<Array>} Ganadores, del sorteo más reciente al más antiguo.
+ */
+async function getGanadoresByPhoneFromDB(buyerPhone, limite) {
+    const res = await pool.query(
+        'SELECT * FROM ganadores_tickets WHERE buyer_phone = $1 ORDER BY draw_date DESC, purchase_date DESC LIMIT $2',
+        [buyerPhone, limite]
+    );
+    return res.rows.map(ganadorFromRow);
+}
+
+/**
+ * Inserta o actualiza tickets ganadores de un sorteo en una sola sentencia. El estado de pago de los
+ * tickets que ya existían no se toca, salvo un ticket 'anulado' que vuelve a ganar, que regresa a 'pagado'.
+ * premio_usd siempre refleja el cálculo actual; premio_usd_pagado conserva lo que se pagó.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @param {string} fecha - Fecha del sorteo.
+ * @param {number} numeroSorteo - Número de sorteo.
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {Array<object>} ganadores - Ganadores con el formato de armarGanador.
+ * @returns {Promise<Array<{ticketNumber: string, premioUSD: number, premioPagadoUSD: number}>>} Tickets pagados
+ *          cuyo premio calculado ya no coincide con el monto pagado.
+ */
+async function upsertGanadoresTicketsInDB(client, fecha, numeroSorteo, tipoLoteria, ganadores) {
+    if (ganadores.length === 0) return [];
+    const res = await client.query(
+        `WITH guardados AS (
+         INSERT INTO ganadores_tickets (draw_date, draw_number, lottery_type, ticket_number, venta_id, buyer_name, buyer_phone,
+                                        numbers, purchase_date, coincident_numbers, detalle_horas, premio_usd, premio_bs, processed_at)
+         SELECT $1::date, $2, $3, g."ticketNumber", g."ventaId", g."buyerName", g."buyerPhone", COALESCE(g.numbers, '[]'::jsonb),
+                g."purchaseDate", g."coincidentNumbers", g."detalleHoras",
+                COALESCE(g."totalPotentialPrizeUSD", 0), COALESCE(g."totalPotentialPrizeBs", 0), NOW()
+         FROM jsonb_to_recordset($4::jsonb) AS g(
+             "ticketNumber" text, "ventaId" bigint, "buyerName" text, "buyerPhone" text, numbers jsonb,
+             "purchaseDate" timestamptz, "coincidentNumbers" jsonb, "detalleHoras" jsonb,
+             "totalPotentialPrizeUSD" numeric, "totalPotentialPrizeBs" numeric
+         )
+         ON CONFLICT (draw_date, draw_number, lottery_type, ticket_number) DO UPDATE SET
+             venta_id = EXCLUDED.venta_id,
+             buyer_name = EXCLUDED.buyer_name,
+             buyer_phone = EXCLUDED.buyer_phone,
+             numbers = EXCLUDED.numbers,
+             purchase_date = EXCLUDED.purchase_date,
+             coincident_numbers = EXCLUDED.coincident_numbers,
+             detalle_horas = EXCLUDED.detalle_horas,
+             premio_usd = EXCLUDED.premio_usd,
+             premio_bs = EXCLUDED.premio_bs,
+             estado_pago = CASE WHEN ganadores_tickets.estado_pago = 'anulado' THEN 'pagado' ELSE ganadores_tickets.estado_pago END,
+             processed_at = EXCLUDED.processed_at
+         RETURNING ticket_number, estado_pago, premio_usd, premio_usd_pagado
+         )
+         SELECT ticket_number, premio_usd, premio_usd_pagado FROM guardados
+         WHERE estado_pago = 'pagado' AND premio_usd IS DISTINCT FROM premio_usd_pagado`,
+        [fecha, numeroSorteo, tipoLoteria, JSON.stringify(ganadores)]
+    );
+    return res.rows.map(row => ({
+        ticketNumber: row.ticket_number,
+        premioUSD: parseFloat(row.premio_usd),
+        premioPagadoUSD: row.premio_usd_pagado === null ? null : parseFloat(row.premio_usd_pagado)
+    }));
+}
+
+/**
+ * Quita de 'ganadores_tickets' los tickets de un sorteo que dejaron de ganar. Los que ya estaban pagados
+ * no se borran: quedan 'anulado' con premio 0 (conservando la fecha, referencia y monto del pago) para
+ * que se revisen.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @param {string} fecha - Fecha del sorteo.
+ * @param {number} numeroSorteo - Número de sorteo.
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {object} filtro - { quitar } tickets a quitar, o { conservar } tickets que siguen ganando (se quita el resto).
+ * @returns {Promise<Array<string>>} Tickets pagados que quedaron anulados en esta llamada.
+ */
+async function quitarGanadoresTicketsInDB(client, fecha, numeroSorteo, tipoLoteria, { quitar = null, conservar = null }) {
+    const params = [fecha, numeroSorteo, tipoLoteria, quitar || conservar];
+    const condicion = `draw_date = $1::date AND draw_number = $2 AND lottery_type = $3
+                       AND ${quitar ? 'ticket_number = ANY($4::text[])' : 'ticket_number <> ALL($4::text[])'}`;
+    const anulados = await client.query(
+        `UPDATE ganadores_tickets SET
+             estado_pago = 'anulado',
+             coincident_numbers = '[]'::jsonb,
+             detalle_horas = '{}'::jsonb,
+             premio_usd = 0,
+             premio_bs = 0,
+             processed_at = NOW()
+         WHERE ${condicion} AND estado_pago = 'pagado'
+         RETURNING ticket_number`,
+        params
+    );
+    await client.query(`DELETE FROM ganadores_tickets WHERE ${condicion} AND estado_pago = 'pendiente'`, params);
+    return anulados.rows.map(row => row.ticket_number);
+}
+
+/**
+ * Marca el pago de un ticket ganador (solo se reescribe su fila).
+ * @param {string} fecha - Fecha del sorteo.
+ * @param {number} numeroSorteo - Número de sorteo.
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {string} ticketNumber - Ticket ganador.
+ * @param {string} estadoPago - 'pendiente' o 'pagado'.
+ * @param {string|null} referencia - Referencia del pago.
+ * @returns {Promise<object|null>} El ganador actualizado o null si no existe.
+ */
+async function updateGanadorPagoInDB(fecha, numeroSorteo, tipoLoteria, ticketNumber, estadoPago, referencia) {
+    const res = await pool.query(
+        `UPDATE ganadores_tickets SET
+             estado_pago = $5,
+             pagado_at = CASE WHEN $5 = 'pagado' THEN COALESCE(pagado_at, NOW()) END,
+             premio_usd_pagado = CASE WHEN $5 = 'pagado' THEN COALESCE(premio_usd_pagado, premio_usd) END,
+             pago_referencia = $6
+         WHERE draw_date = $1::date AND draw_number = $2 AND lottery_type = $3 AND ticket_number = $4
+         RETURNING *`,
+        [fecha, numeroSorteo, tipoLoteria, ticketNumber, estadoPago, referencia]
+    );
+    return res.rows.length > 0 ? ganadorFromRow(res.rows[0]) : null;
 }
 
 // INICIO DE NUEVA LÓGICA: FUNCIONES AUXILIARES PARA VENDEDORES
@@ -535,6 +2483,150 @@ async function deleteSellerFromDB(sellerId) {
 }
 // FIN DE NUEVA LÓGICA: FUNCIONES AUXILIARES PARA VENDEDORES
 
+// INICIO DE NUEVA LÓGICA: CLAVES DE IDEMPOTENCIA
+const IDEMPOTENCY_TTL_HOURS = 24; // Tiempo que se conserva la respuesta de una clave
+const IDEMPOTENCY_LEASE_MINUTES = 5; // Vigencia de una clave 'en_proceso' (si el proceso muere, otra solicitud la retoma)
+const IDEMPOTENCY_WAIT_MS = 10000; // Espera máxima por una solicitud idéntica que aún está en proceso
+const IDEMPOTENCY_POLL_MS = 250;
+
+/**
+ * Calcula una huella de la solicitud para detectar una misma clave reutilizada con otro contenido.
+ * @param {object} req - Objeto de solicitud de Express.
+ * @returns {string} Hash SHA-256 en hexadecimal.
+ */
+function hashIdempotentRequest(req) {
+    const hash = crypto.createHash('sha256');
+    hash.update(`${req.method} ${req.originalUrl}\n`);
+    hash.update(JSON.stringify(req.body || {}));
+    if (req.files) {
+        Object.keys(req.files).sort().forEach(field => {
+            const file = req.files[field];
+            hash.update(`\n${field}:${file.name}:${file.size}:${file.md5}`);
+        });
+    }
+    return hash.digest('hex');
+}
+
+/**
+ * Middleware de Express que hace idempotente una ruta mediante la cabecera 'Idempotency-Key'.
+ * - La primera solicitud con una clave se ejecuta y su respuesta (status + JSON) se guarda en 'idempotency_keys'.
+ * - Una repetición de una solicitud ya completada devuelve la respuesta guardada sin volver a ejecutar la ruta.
+ * - Una repetición de una solicitud en curso espera a que termine (hasta IDEMPOTENCY_WAIT_MS) o responde 409.
+ * - Las respuestas 5xx no se guardan: la transacción se revirtió y el cliente puede reintentar con la misma clave.
+ * - La respuesta se guarda al llamar a res.json, aunque el cliente se haya desconectado antes de recibirla.
+ * - Una clave 'en_proceso' vence tras IDEMPOTENCY_LEASE_MINUTES: si el proceso murió antes de responder
+ *   (la transacción se revirtió), la siguiente repetición la retoma en lugar de recibir 409 todo el día.
+ * Las claves completadas vencen tras IDEMPOTENCY_TTL_HOURS y se eliminan con purgeExpiredIdempotencyKeysInDB.
+ * Sin la cabecera, la ruta se ejecuta normalmente.
+ * @returns {function} Middleware de Express.
+ */
+function idempotency() {
+    return async (req, res, next) => {
+        const rawKey = req.get('Idempotency-Key');
+        if (!rawKey) {
+            return next();
+        }
+        if (rawKey.length > 255) {
+            return res.status(400).json({ message: 'La cabecera Idempotency-Key no puede superar 255 caracteres.' });
+        }
+        const key = `${req.method} ${req.baseUrl}${req.path}:${rawKey}`;
+        const requestHash = hashIdempotentRequest(req);
+
+        try {
+            const claimRes = await pool.query(
+                `INSERT INTO idempotency_keys (key, request_hash, estado, expires_at)
+                 VALUES ($1, $2, 'en_proceso', NOW() + make_interval(mins => $3))
+                 ON CONFLICT (key) DO UPDATE SET
+                     request_hash = EXCLUDED.request_hash,
+                     estado = EXCLUDED.estado,
+                     response_status = NULL,
+                     response_body = NULL,
+                     expires_at = EXCLUDED.expires_at
+                 WHERE idempotency_keys.expires_at <= NOW()
+                 RETURNING key;`,
+                [key, requestHash, IDEMPOTENCY_LEASE_MINUTES]
+            );
+
+            if (claimRes.rows.length === 0) {
+                // La clave ya existe: devolver la respuesta guardada o esperar a la solicitud en curso
+                const deadline = Date.now() + IDEMPOTENCY_WAIT_MS;
+                for (;;) {
+                    const storedRes = await pool.query(
+                        'SELECT request_hash, estado, response_status, response_body FROM idempotency_keys WHERE key = $1',
+                        [key]
+                    );
+                    const stored = storedRes.rows[0];
+                    if (!stored) {
+                        // La solicitud original falló (5xx) y liberó la clave: reintentar desde el principio
+                        return idempotency()(req, res, next);
+                    }
+                    if (stored.request_hash !== requestHash) {
+                        return res.status(422).json({ message: 'La Idempotency-Key ya fue usada con una solicitud distinta.' });
+                    }
+                    if (stored.estado === 'completado') {
+                        res.set('Idempotent-Replayed', 'true');
+                        return res.status(stored.response_status).json(stored.response_body);
+                    }
+                    if (Date.now() >= deadline) {
+                        res.set('Retry-After', '1');
+                        return res.status(409).json({ message: 'Una solicitud con esta Idempotency-Key aún está en proceso. Intenta de nuevo en unos segundos.' });
+                    }
+                    await new Promise(resolve => setTimeout(resolve, IDEMPOTENCY_POLL_MS));
+                }
+            }
+        } catch (error) {
+            console.error('ERROR_IDEMPOTENCY: Error al registrar la Idempotency-Key:', error.message);
+            return res.status(500).json({ message: 'Error interno del servidor al procesar la Idempotency-Key.', error: error.message });
+        }
+
+        // Guardar el resultado en cuanto la ruta responde con res.json, sin esperar a que la respuesta
+        // llegue al cliente: si el cliente se desconecta antes, 'finish' no se emite y la clave quedaría
+        // 'en_proceso' hasta vencer, aunque la operación ya se haya confirmado.
+        let guardada = false;
+        const guardarResultado = (status, body) => {
+            if (guardada) return;
+            guardada = true;
+            const save = status >= 500 || body === undefined
+                ? pool.query('DELETE FROM idempotency_keys WHERE key = $1', [key])
+                : pool.query(
+                    `UPDATE idempotency_keys SET estado = 'completado', response_status = $2, response_body = $3,
+                         expires_at = NOW() + make_interval(hours => $4)
+                     WHERE key = $1`,
+                    [key, status, JSON.stringify(body), IDEMPOTENCY_TTL_HOURS]
+                );
+            save.catch(error => console.error('ERROR_IDEMPOTENCY: Error al guardar la respuesta de la Idempotency-Key:', error.message));
+        };
+        const originalJson = res.json.bind(res);
+        res.json = (body) => {
+            guardarResultado(res.statusCode, body);
+            return originalJson(body);
+        };
+        // Respuestas que no pasan por res.json: sin cuerpo que repetir, la clave se libera para reintentar.
+        // Si el cliente se desconecta mientras la ruta sigue en curso, la clave se resuelve cuando la ruta responda.
+        const alTerminar = () => {
+            if (res.writableEnded) guardarResultado(res.statusCode, undefined);
+        };
+        res.on('finish', alTerminar);
+        res.on('close', alTerminar);
+        next();
+    };
+}
+
+/**
+ * Elimina las claves de idempotencia vencidas usando el índice sobre expires_at.
+ */
+async function purgeExpiredIdempotencyKeysInDB() {
+    try {
+        const res = await pool.query('DELETE FROM idempotency_keys WHERE expires_at <= NOW()');
+        if (res.rowCount > 0) {
+            console.log(`DEBUG_IDEMPOTENCY: ${res.rowCount} claves de idempotencia vencidas eliminadas.`);
+        }
+    } catch (error) {
+        console.error('ERROR_IDEMPOTENCY: Error al eliminar claves de idempotencia vencidas:', error.message);
+    }
+}
+// FIN DE NUEVA LÓGICA: CLAVES DE IDEMPOTENCIA
+
 
 // Función para asegurar que las tablas existan
 async function ensureTablesExist() {
@@ -565,18 +2657,219 @@ async function ensureTablesExist() {
                 block_reason_message TEXT DEFAULT ''
             );
         `);
-        console.log('DB: Tabla "configuracion" verificada/creada.');
+        // Tamaño del espacio de números del sorteo (1000, 10000 o 100000)
+        await client.query(`ALTER TABLE configuracion ADD COLUMN IF NOT EXISTS total_numeros INTEGER NOT NULL DEFAULT ${TOTAL_RAFFLE_NUMBERS};`);
+        console.log('DB: Tabla "configuracion" verificada/creada.');
+
+        // Tabla de números (numeros)
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS numeros (
+                id SERIAL PRIMARY KEY,
+                numero VARCHAR(10) UNIQUE NOT NULL,
+                comprado BOOLEAN DEFAULT FALSE,
+                "originalDrawNumber" INTEGER
+            );
+        `);
+        console.log('DB: Tabla "numeros" verificada/creada.');
+
+        // Estado vendido "efectivo" de un número: 'comprado' solo cuenta si su sorteo sigue vigente
+        // respecto del correlativo actual. Las filas de sorteos viejos se limpian luego en segundo plano.
+        await client.query(`
+            CREATE OR REPLACE FUNCTION numero_vendido(comprado BOOLEAN, draw_number INTEGER) RETURNS BOOLEAN AS $$
+                SELECT COALESCE(comprado, FALSE) AND (
+                    draw_number IS NULL OR
+                    draw_number > COALESCE((SELECT numero_sorteo_correlativo FROM configuracion LIMIT 1), 0) - ${NUMEROS_GENERACIONES_VIGENTES}
+                );
+            $$ LANGUAGE sql STABLE;
+        `);
+
+        // Tabla de reservas temporales de números (reservas_numeros)
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS reservas_numeros (
+                numero VARCHAR(10) PRIMARY KEY,
+                token VARCHAR(64) NOT NULL,
+                expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+            );
+        `);
+        // Tablas creadas con números de 3 dígitos: ampliar la columna (sin reescribir la tabla) para 4 y 5 dígitos
+        for (const tabla of ['numeros', 'reservas_numeros']) {
+            const checkColumn = await client.query(`
+                SELECT character_maximum_length FROM information_schema.columns
+                WHERE table_name = '${tabla}' AND column_name = 'numero';
+            `);
+            if (checkColumn.rows.length > 0 && checkColumn.rows[0].character_maximum_length < 10) {
+                await client.query(`ALTER TABLE ${tabla} ALTER COLUMN numero TYPE VARCHAR(10);`);
+                console.log(`DEBUG: Columna "numero" de la tabla "${tabla}" ampliada a VARCHAR(10).`);
+            }
+        }
+        await client.query('CREATE INDEX IF NOT EXISTS idx_reservas_numeros_token ON reservas_numeros (token);');
+        await client.query('CREATE INDEX IF NOT EXISTS idx_reservas_numeros_expires_at ON reservas_numeros (expires_at);');
+        console.log('DB: Tabla "reservas_numeros" verificada/creada (y sus índices).');
+
+        // Versión de estado por recurso (versiones_estado). Solo crece. La de 'numeros' ya no se usa (sus
+        // versiones salen de numeros_version_seq); se conserva como punto de partida de la secuencia.
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS versiones_estado (
+                recurso VARCHAR(50) PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            );
+        `);
+        await client.query("INSERT INTO versiones_estado (recurso, version) VALUES ('numeros', 0), ('configuracion', 0) ON CONFLICT (recurso) DO NOTHING;");
+        console.log('DB: Tabla "versiones_estado" verificada/creada.');
+
+        // Cualquier escritura en 'configuracion' sube su versión y avisa a las cachés de los demás procesos
+        await client.query(`
+            CREATE OR REPLACE FUNCTION notificar_cambios_configuracion() RETURNS trigger AS $$
+            DECLARE
+                nueva_version BIGINT;
+            BEGIN
+                UPDATE versiones_estado SET version = version + 1 WHERE recurso = 'configuracion' RETURNING version INTO nueva_version;
+                PERFORM pg_notify('${CONFIGURACION_NOTIFY_CHANNEL}', nueva_version::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
+        await client.query('DROP TRIGGER IF EXISTS trg_configuracion_notificar ON configuracion;');
+        await client.query(`
+            CREATE TRIGGER trg_configuracion_notificar
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON configuracion
+            FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambios_configuracion();
+        `);
+
+        // Registro de cambios de la grilla por versión (numeros_cambios_log), para GET /api/numeros?since=.
+        // numero = '*' marca un cambio masivo (TRUNCATE o lista demasiado larga): obliga a enviar la grilla completa.
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS numeros_cambios_log (
+                version BIGINT NOT NULL,
+                numero VARCHAR(10) NOT NULL,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                PRIMARY KEY (version, numero)
+            );
+        `);
+        console.log('DB: Tabla "numeros_cambios_log" verificada/creada.');
+
+        // Las versiones de 'numeros' salen de una secuencia: nextval no bloquea ni se revierte, así que las
+        // escrituras concurrentes en la grilla no se esperan entre sí. Al crearla continúa desde la versión
+        // que había en versiones_estado.
+        const secuenciaVersionExistia = (await client.query("SELECT to_regclass('numeros_version_seq') IS NOT NULL AS existe")).rows[0].existe;
+        await client.query('CREATE SEQUENCE IF NOT EXISTS numeros_version_seq;');
+        if (!secuenciaVersionExistia) {
+            await client.query(`
+                SELECT setval('numeros_version_seq', GREATEST(v, 1), v > 0)
+                FROM (SELECT GREATEST(
+                    (SELECT version FROM versiones_estado WHERE recurso = 'numeros'),
+                    (SELECT MAX(version) FROM numeros_cambios_log), 0) AS v) AS actual;
+            `);
+        }
+        // Versión confirmada: la mayor versión tal que todas las anteriores están en el registro o se
+        // abandonaron. Una versión sin registro se da por abandonada (transacción revertida) cuando ya hay
+        // versiones posteriores registradas hace más de 'espera'.
+        await client.query(`
+            CREATE OR REPLACE FUNCTION numeros_version_confirmada(espera INTERVAL) RETURNS BIGINT AS $$
+            DECLARE
+                ultima BIGINT;
+                piso BIGINT;
+                hueco BIGINT;
+            BEGIN
+                SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END INTO ultima FROM numeros_version_seq;
+                SELECT MAX(version) INTO piso FROM numeros_cambios_log WHERE created_at < NOW() - espera;
+                IF piso IS NULL THEN
+                    SELECT MIN(version) - 1 INTO piso FROM numeros_cambios_log;
+                END IF;
+                SELECT MIN(s.v) INTO hueco
+                FROM generate_series(COALESCE(piso, ultima) + 1, ultima) AS s(v)
+                WHERE NOT EXISTS (SELECT 1 FROM numeros_cambios_log l WHERE l.version = s.v);
+                RETURN COALESCE(hueco - 1, ultima);
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
+        // Vuelve a registrar y avisar con una versión nueva los cambios de una versión que se confirmó
+        // después de darse por abandonada (ver adoptarVersionesNumeros)
+        await client.query(`
+            CREATE OR REPLACE FUNCTION reanunciar_version_numeros(anterior BIGINT) RETURNS BIGINT AS $$
+            DECLARE
+                cambiados TEXT;
+                nueva_version BIGINT;
+            BEGIN
+                SELECT string_agg(numero, ',') INTO cambiados FROM numeros_cambios_log WHERE version = anterior;
+                IF cambiados IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                nueva_version := nextval('numeros_version_seq');
+                INSERT INTO numeros_cambios_log (version, numero)
+                SELECT nueva_version, numero FROM numeros_cambios_log WHERE version = anterior;
+                PERFORM pg_notify('${NUMEROS_NOTIFY_CHANNEL}', nueva_version || ':' || cambiados);
+                RETURN nueva_version;
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
 
-        // Tabla de números (numeros)
+        // Avisos de cambios en 'numeros' y 'reservas_numeros' para la caché en memoria de cada proceso.
+        // Triggers por sentencia: cada sentencia toma una versión de numeros_version_seq, la registra en
+        // numeros_cambios_log y emite un NOTIFY
+        // 'version:numeros' (o 'version:*' si la lista es muy larga), que PostgreSQL entrega solo si la
+        // transacción se confirma. Las versiones pueden confirmarse fuera de orden; los lectores solo
+        // anuncian versiones sin huecos anteriores (numeros_version_confirmada, adoptarVersionesNumeros).
         await client.query(`
-            CREATE TABLE IF NOT EXISTS numeros (
-                id SERIAL PRIMARY KEY,
-                numero VARCHAR(3) UNIQUE NOT NULL,
-                comprado BOOLEAN DEFAULT FALSE,
-                "originalDrawNumber" INTEGER
-            );
+            CREATE OR REPLACE FUNCTION notificar_cambios_numeros() RETURNS trigger AS $$
+            DECLARE
+                cambiados TEXT;
+                nueva_version BIGINT;
+            BEGIN
+                IF TG_OP = 'TRUNCATE' THEN
+                    cambiados := '*';
+                ELSIF TG_OP = 'DELETE' THEN
+                    SELECT string_agg(DISTINCT numero, ',') INTO cambiados FROM filas_antiguas;
+                ELSE
+                    SELECT string_agg(DISTINCT numero, ',') INTO cambiados FROM filas_nuevas;
+                END IF;
+                IF cambiados IS NOT NULL THEN
+                    IF length(cambiados) > 7000 THEN
+                        cambiados := '*';
+                    END IF;
+                    nueva_version := nextval('numeros_version_seq');
+                    INSERT INTO numeros_cambios_log (version, numero)
+                    SELECT nueva_version, unnest(string_to_array(cambiados, ','));
+                    PERFORM pg_notify('${NUMEROS_NOTIFY_CHANNEL}', nueva_version || ':' || cambiados);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
+        for (const tabla of ['numeros', 'reservas_numeros']) {
+            await client.query(`DROP TRIGGER IF EXISTS trg_${tabla}_notificar_insert ON ${tabla};`);
+            await client.query(`DROP TRIGGER IF EXISTS trg_${tabla}_notificar_update ON ${tabla};`);
+            await client.query(`DROP TRIGGER IF EXISTS trg_${tabla}_notificar_delete ON ${tabla};`);
+            await client.query(`DROP TRIGGER IF EXISTS trg_${tabla}_notificar_truncate ON ${tabla};`);
+            await client.query(`CREATE TRIGGER trg_${tabla}_notificar_insert AFTER INSERT ON ${tabla} REFERENCING NEW TABLE AS filas_nuevas FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambios_numeros();`);
+            await client.query(`CREATE TRIGGER trg_${tabla}_notificar_update AFTER UPDATE ON ${tabla} REFERENCING NEW TABLE AS filas_nuevas FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambios_numeros();`);
+            await client.query(`CREATE TRIGGER trg_${tabla}_notificar_delete AFTER DELETE ON ${tabla} REFERENCING OLD TABLE AS filas_antiguas FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambios_numeros();`);
+            await client.query(`CREATE TRIGGER trg_${tabla}_notificar_truncate AFTER TRUNCATE ON ${tabla} FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambios_numeros();`);
+        }
+        console.log('DB: Triggers de aviso de cambios en números verificados/creados.');
+
+        // Al cambiar el correlativo o el espacio de números del sorteo cambia toda la grilla sin tocar 'numeros':
+        // se sube su versión y se avisa un cambio masivo para que cachés y clientes recarguen la grilla.
+        await client.query(`
+            CREATE OR REPLACE FUNCTION avanzar_generacion_numeros() RETURNS trigger AS $$
+            DECLARE
+                nueva_version BIGINT;
+            BEGIN
+                nueva_version := nextval('numeros_version_seq');
+                INSERT INTO numeros_cambios_log (version, numero) VALUES (nueva_version, '*');
+                PERFORM pg_notify('${NUMEROS_NOTIFY_CHANNEL}', nueva_version || ':*');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
+        await client.query('DROP TRIGGER IF EXISTS trg_configuracion_generacion_numeros ON configuracion;');
+        await client.query(`
+            CREATE TRIGGER trg_configuracion_generacion_numeros
+            AFTER UPDATE OF numero_sorteo_correlativo, total_numeros ON configuracion
+            FOR EACH ROW WHEN (OLD.numero_sorteo_correlativo IS DISTINCT FROM NEW.numero_sorteo_correlativo
+                            OR OLD.total_numeros IS DISTINCT FROM NEW.total_numeros)
+            EXECUTE FUNCTION avanzar_generacion_numeros();
         `);
-        console.log('DB: Tabla "numeros" verificada/creada.');
 
         // Tabla de ventas (ventas)
         await client.query(`
@@ -616,6 +2909,141 @@ async function ensureTablesExist() {
         `);
         console.log('DB: Columnas de vendedor en tabla "ventas" verificadas/añadidas.');
 
+        // Contadores incrementales de ventas por fecha de sorteo y estado (contadores_ventas)
+        // Los mantiene un trigger sobre 'ventas' dentro de la misma transacción de cada escritura.
+        // Cada (fecha, estado) se reparte en CONTADORES_VENTAS_RANURAS filas (ranura = id % N) que se suman
+        // al leer: ventas concurrentes actualizan filas distintas en vez de esperar el bloqueo de una sola.
+        await client.query('BEGIN');
+        const contadoresExistian = (await client.query("SELECT to_regclass('contadores_ventas') IS NOT NULL AS existe")).rows[0].existe;
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS contadores_ventas (
+                draw_date DATE NOT NULL,
+                validation_status VARCHAR(50) NOT NULL,
+                ranura SMALLINT NOT NULL DEFAULT 0,
+                tickets INTEGER NOT NULL DEFAULT 0,
+                numeros INTEGER NOT NULL DEFAULT 0,
+                total_usd NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                total_bs NUMERIC(16, 2) NOT NULL DEFAULT 0,
+                PRIMARY KEY (draw_date, validation_status, ranura)
+            );
+        `);
+        const tieneRanura = (await client.query(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'contadores_ventas' AND column_name = 'ranura'"
+        )).rows.length > 0;
+        if (!tieneRanura) {
+            // Tabla creada antes de repartir los contadores: las filas existentes quedan en la ranura 0
+            await client.query('ALTER TABLE contadores_ventas ADD COLUMN ranura SMALLINT NOT NULL DEFAULT 0;');
+            await client.query('ALTER TABLE contadores_ventas DROP CONSTRAINT IF EXISTS contadores_ventas_pkey;');
+            await client.query('ALTER TABLE contadores_ventas ADD PRIMARY KEY (draw_date, validation_status, ranura);');
+        }
+        // Las restas también se insertan (con valores negativos) si la fila no existe, así la suma es
+        // correcta aunque cambie la cantidad de ranuras. Las ventas sin fecha de sorteo no se cuentan.
+        await client.query(`
+            CREATE OR REPLACE FUNCTION actualizar_contadores_ventas() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') AND OLD."drawDate" IS NOT NULL THEN
+                    INSERT INTO contadores_ventas (draw_date, validation_status, ranura, tickets, numeros, total_usd, total_bs)
+                    VALUES (
+                        OLD."drawDate", COALESCE(OLD."validationStatus", 'Pendiente'), OLD.id % ${CONTADORES_VENTAS_RANURAS}, -1,
+                        -(CASE WHEN jsonb_typeof(OLD.numbers) = 'array' THEN jsonb_array_length(OLD.numbers) ELSE 0 END),
+                        -COALESCE(OLD."valueUSD", 0), -COALESCE(OLD."valueBs", 0)
+                    )
+                    ON CONFLICT (draw_date, validation_status, ranura) DO UPDATE SET
+                        tickets = contadores_ventas.tickets + EXCLUDED.tickets,
+                        numeros = contadores_ventas.numeros + EXCLUDED.numeros,
+                        total_usd = contadores_ventas.total_usd + EXCLUDED.total_usd,
+                        total_bs = contadores_ventas.total_bs + EXCLUDED.total_bs;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW."drawDate" IS NOT NULL THEN
+                    INSERT INTO contadores_ventas (draw_date, validation_status, ranura, tickets, numeros, total_usd, total_bs)
+                    VALUES (
+                        NEW."drawDate", COALESCE(NEW."validationStatus", 'Pendiente'), NEW.id % ${CONTADORES_VENTAS_RANURAS}, 1,
+                        CASE WHEN jsonb_typeof(NEW.numbers) = 'array' THEN jsonb_array_length(NEW.numbers) ELSE 0 END,
+                        COALESCE(NEW."valueUSD", 0), COALESCE(NEW."valueBs", 0)
+                    )
+                    ON CONFLICT (draw_date, validation_status, ranura) DO UPDATE SET
+                        tickets = contadores_ventas.tickets + EXCLUDED.tickets,
+                        numeros = contadores_ventas.numeros + EXCLUDED.numeros,
+                        total_usd = contadores_ventas.total_usd + EXCLUDED.total_usd,
+                        total_bs = contadores_ventas.total_bs + EXCLUDED.total_bs;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
+        await client.query('DROP TRIGGER IF EXISTS trg_contadores_ventas ON ventas;');
+        await client.query(`
+            CREATE TRIGGER trg_contadores_ventas
+            AFTER INSERT OR DELETE OR UPDATE OF "drawDate", "validationStatus", numbers, "valueUSD", "valueBs" ON ventas
+            FOR EACH ROW EXECUTE FUNCTION actualizar_contadores_ventas();
+        `);
+        if (!contadoresExistian) {
+            // Primera vez: calcular los contadores a partir de las ventas existentes
+            await client.query(`
+                INSERT INTO contadores_ventas (draw_date, validation_status, ranura, tickets, numeros, total_usd, total_bs)
+                SELECT "drawDate", COALESCE("validationStatus", 'Pendiente'), id % ${CONTADORES_VENTAS_RANURAS}, COUNT(*),
+                       SUM(CASE WHEN jsonb_typeof(numbers) = 'array' THEN jsonb_array_length(numbers) ELSE 0 END),
+                       COALESCE(SUM("valueUSD"), 0), COALESCE(SUM("valueBs"), 0)
+                FROM ventas
+                WHERE "drawDate" IS NOT NULL
+                GROUP BY "drawDate", COALESCE("validationStatus", 'Pendiente'), id % ${CONTADORES_VENTAS_RANURAS};
+            `);
+            console.log('DB: Contadores de ventas calculados a partir de las ventas existentes.');
+        }
+        await client.query('COMMIT');
+        console.log('DB: Tabla "contadores_ventas" y su trigger verificados/creados.');
+
+        // Índice normalizado de números vendidos: (draw_number, numero) -> venta (ventas_numeros).
+        // Lo mantiene un trigger sobre 'ventas'; al borrar una venta sus filas se borran en cascada.
+        // Varias ventas del mismo sorteo pueden tener el mismo número (ej. una marcada 'Falso' y su reventa).
+        await client.query('BEGIN');
+        const ventasNumerosExistia = (await client.query("SELECT to_regclass('ventas_numeros') IS NOT NULL AS existe")).rows[0].existe;
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS ventas_numeros (
+                draw_number INTEGER NOT NULL,
+                numero VARCHAR(10) NOT NULL,
+                venta_id BIGINT NOT NULL REFERENCES ventas(id) ON DELETE CASCADE,
+                PRIMARY KEY (draw_number, numero, venta_id)
+            );
+        `);
+        await client.query('CREATE INDEX IF NOT EXISTS idx_ventas_numeros_venta_id ON ventas_numeros (venta_id);');
+        await client.query(`
+            CREATE OR REPLACE FUNCTION actualizar_ventas_numeros() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE' THEN
+                    DELETE FROM ventas_numeros WHERE venta_id = OLD.id;
+                END IF;
+                IF jsonb_typeof(NEW.numbers) = 'array' THEN
+                    INSERT INTO ventas_numeros (draw_number, numero, venta_id)
+                    SELECT DISTINCT NEW."drawNumber", numero, NEW.id
+                    FROM jsonb_array_elements_text(NEW.numbers) AS numero
+                    ON CONFLICT DO NOTHING;
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        `);
+        await client.query('DROP TRIGGER IF EXISTS trg_ventas_numeros ON ventas;');
+        await client.query(`
+            CREATE TRIGGER trg_ventas_numeros
+            AFTER INSERT OR UPDATE OF "drawNumber", numbers ON ventas
+            FOR EACH ROW EXECUTE FUNCTION actualizar_ventas_numeros();
+        `);
+        if (!ventasNumerosExistia) {
+            // Primera vez: indexar los números de las ventas existentes
+            await client.query(`
+                INSERT INTO ventas_numeros (draw_number, numero, venta_id)
+                SELECT DISTINCT v."drawNumber", numero, v.id
+                FROM ventas v CROSS JOIN LATERAL jsonb_array_elements_text(
+                    CASE WHEN jsonb_typeof(v.numbers) = 'array' THEN v.numbers ELSE '[]'::jsonb END
+                ) AS numero
+                ON CONFLICT DO NOTHING;
+            `);
+            console.log('DB: Números de las ventas existentes indexados en "ventas_numeros".');
+        }
+        await client.query('COMMIT');
+        console.log('DB: Tabla "ventas_numeros" y su trigger verificados/creados.');
+
 
         // Tabla de comprobantes (comprobantes)
         await client.query(`
@@ -632,6 +3060,86 @@ async function ensureTablesExist() {
         `);
         console.log('DB: Tabla "comprobantes" verificada/creada.');
 
+        // Tabla de secuencia de tickets por fecha del ticketNumber (secuencia_tickets)
+        const secuenciaTicketsPorFecha = (await client.query(
+            `SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                            WHERE table_name = 'secuencia_tickets' AND column_name = 'fecha_prefijo') AS existe`
+        )).rows[0].existe;
+        if (!secuenciaTicketsPorFecha) {
+            // Antes la secuencia era por número de sorteo: se reemplaza por la de fecha
+            await client.query('DROP TABLE IF EXISTS secuencia_tickets;');
+        }
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS secuencia_tickets (
+                fecha_prefijo VARCHAR(8) PRIMARY KEY,
+                ultimo_asignado INTEGER NOT NULL DEFAULT 0
+            );
+        `);
+        if (!secuenciaTicketsPorFecha) {
+            // Cada fecha continúa desde el mayor ticket ya vendido con su prefijo
+            await client.query(`
+                INSERT INTO secuencia_tickets (fecha_prefijo, ultimo_asignado)
+                SELECT split_part("ticketNumber", '-', 1), MAX(split_part("ticketNumber", '-', 2)::int)
+                FROM ventas
+                WHERE "ticketNumber" ~ '^[0-9]{8}-[0-9]{1,9}$'
+                GROUP BY 1
+                ON CONFLICT (fecha_prefijo) DO UPDATE SET
+                    ultimo_asignado = GREATEST(secuencia_tickets.ultimo_asignado, EXCLUDED.ultimo_asignado);
+            `);
+        }
+        console.log('DB: Tabla "secuencia_tickets" verificada/creada.');
+
+        // Tabla de arriendos de ID de nodo para el generador de IDs (id_generador_nodos)
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS id_generador_nodos (
+                node_id INTEGER PRIMARY KEY,
+                owner TEXT NOT NULL,
+                lease_until TIMESTAMP WITH TIME ZONE NOT NULL
+            );
+        `);
+        console.log('DB: Tabla "id_generador_nodos" verificada/creada.');
+
+        // Tabla de claves de idempotencia (idempotency_keys)
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key VARCHAR(512) PRIMARY KEY,
+                request_hash VARCHAR(64) NOT NULL,
+                estado VARCHAR(20) NOT NULL,
+                response_status INTEGER,
+                response_body JSONB,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+            );
+        `);
+        await client.query('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at);');
+        // Claves 'en_proceso' reclamadas con la vigencia de 24 horas anterior: pasan a la vigencia corta
+        await client.query(
+            `UPDATE idempotency_keys SET expires_at = NOW() + make_interval(mins => $1)
+             WHERE estado = 'en_proceso' AND expires_at > NOW() + make_interval(mins => $1)`,
+            [IDEMPOTENCY_LEASE_MINUTES]
+        );
+        console.log('DB: Tabla "idempotency_keys" verificada/creada (y su índice).');
+
+        // Tabla de la cola de tareas en segundo plano (tareas_pendientes)
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS tareas_pendientes (
+                id BIGSERIAL PRIMARY KEY,
+                tipo VARCHAR(100) NOT NULL,
+                payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+                estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                locked_until TIMESTAMP WITH TIME ZONE,
+                last_error TEXT,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        `);
+        await client.query(`
+            CREATE INDEX IF NOT EXISTS idx_tareas_pendientes_disponibles
+            ON tareas_pendientes (estado, run_after) WHERE estado IN ('pendiente', 'en_proceso');
+        `);
+        console.log('DB: Tabla "tareas_pendientes" verificada/creada (y su índice).');
+
         // Tabla de horarios_zulia (horarios_zulia)
         await client.query(`
             CREATE TABLE IF NOT EXISTS horarios_zulia (
@@ -639,6 +3147,39 @@ async function ensureTablesExist() {
                 hora VARCHAR(50) NOT NULL UNIQUE
             );
         `);
+        // Horarios por tipo de lotería, cada uno con la clave de 'premios' que paga sus resultados.
+        // La misma hora puede existir en varios tipos: la unicidad pasa de (hora) a (tipo_loteria, hora).
+        await client.query(`
+            ALTER TABLE horarios_zulia
+            ADD COLUMN IF NOT EXISTS tipo_loteria VARCHAR(50) NOT NULL DEFAULT 'zulia',
+            ADD COLUMN IF NOT EXISTS premio_clave VARCHAR(50);
+        `);
+        await client.query('ALTER TABLE horarios_zulia DROP CONSTRAINT IF EXISTS horarios_zulia_hora_key;');
+        await client.query('CREATE UNIQUE INDEX IF NOT EXISTS unique_horarios_zulia_tipo_hora ON horarios_zulia (tipo_loteria, hora);');
+        // Horas que antes estaban fijas en el código: conservan sus premios. Se comparan como lo hacía ese
+        // código (ver premioClaveHoraAnterior), así '4:45 pm' o 'Zulia 12:45 PM' también se reconocen.
+        const sinClave = await client.query('SELECT id, hora FROM horarios_zulia WHERE premio_clave IS NULL');
+        const backfill = sinClave.rows
+            .map(row => ({ id: row.id, premio: premioClaveHoraAnterior(row.hora) }))
+            .filter(row => row.premio);
+        if (backfill.length > 0) {
+            await client.query(
+                `UPDATE horarios_zulia h SET premio_clave = r.premio
+                 FROM unnest($1::int[], $2::text[]) AS r(id, premio)
+                 WHERE h.id = r.id`,
+                [backfill.map(row => row.id), backfill.map(row => row.premio)]
+            );
+        }
+        // Si 'zulia' sigue sin ninguna regla (tabla vacía u horas que no eran las anteriores), se agregan las
+        // tres horas anteriores para que sus resultados no queden pagando 0
+        await client.query(
+            `INSERT INTO horarios_zulia (tipo_loteria, hora, premio_clave)
+             SELECT 'zulia', r.hora, r.premio FROM unnest($1::text[], $2::text[]) WITH ORDINALITY AS r(hora, premio, orden)
+             WHERE NOT EXISTS (SELECT 1 FROM horarios_zulia WHERE tipo_loteria = 'zulia' AND premio_clave IS NOT NULL)
+             ORDER BY orden
+             ON CONFLICT (tipo_loteria, hora) DO NOTHING`,
+            [Object.keys(PREMIOS_CLAVES_HORAS_ANTERIORES), Object.values(PREMIOS_CLAVES_HORAS_ANTERIORES)]
+        );
         console.log('DB: Tabla "horarios_zulia" verificada/creada.');
 
         // Tabla de resultados_zulia (resultados_zulia)
@@ -684,6 +3225,65 @@ async function ensureTablesExist() {
         `).catch(e => console.warn(`Advertencia: El índice unique_ganadores_drawdata ya existe o hubo un error al añadirlo: ${e.message}`));
         console.log('DB: Tabla "ganadores" verificada/creada (y su índice).');
 
+        // Un ticket ganador por fila (ganadores_tickets), con su estado de pago. 'ganadores' queda como
+        // cabecera del sorteo procesado (processedAt, detallePorHora, totalGanadores).
+        await client.query('BEGIN');
+        const ganadoresTicketsExistia = (await client.query("SELECT to_regclass('ganadores_tickets') IS NOT NULL AS existe")).rows[0].existe;
+        await client.query(`
+            CREATE TABLE IF NOT EXISTS ganadores_tickets (
+                draw_date DATE NOT NULL,
+                draw_number INTEGER NOT NULL,
+                lottery_type VARCHAR(50) NOT NULL,
+                ticket_number VARCHAR(255) NOT NULL,
+                venta_id BIGINT,
+                buyer_name VARCHAR(255),
+                buyer_phone VARCHAR(255),
+                numbers JSONB NOT NULL DEFAULT '[]'::jsonb,
+                purchase_date TIMESTAMP WITH TIME ZONE NOT NULL,
+                coincident_numbers JSONB NOT NULL DEFAULT '[]'::jsonb,
+                detalle_horas JSONB NOT NULL DEFAULT '{}'::jsonb,
+                premio_usd NUMERIC(14, 2) NOT NULL DEFAULT 0,
+                premio_bs NUMERIC(16, 2) NOT NULL DEFAULT 0,
+                estado_pago VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+                pagado_at TIMESTAMP WITH TIME ZONE,
+                pago_referencia TEXT,
+                premio_usd_pagado NUMERIC(14, 2),
+                processed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (draw_date, draw_number, lottery_type, ticket_number)
+            );
+        `);
+        // Monto que se pagó, para detectar recálculos que cambian el premio de un ticket ya pagado
+        if (ganadoresTicketsExistia) {
+            await client.query('ALTER TABLE ganadores_tickets ADD COLUMN IF NOT EXISTS premio_usd_pagado NUMERIC(14, 2);');
+            await client.query(`UPDATE ganadores_tickets SET premio_usd_pagado = premio_usd WHERE estado_pago = 'pagado' AND premio_usd_pagado IS NULL;`);
+        }
+        // Páginas de un sorteo por fecha de compra y búsqueda de los premios de un comprador
+        await client.query('CREATE INDEX IF NOT EXISTS idx_ganadores_tickets_sorteo_compra ON ganadores_tickets (draw_date, draw_number, lottery_type, purchase_date, ticket_number);');
+        await client.query('CREATE INDEX IF NOT EXISTS idx_ganadores_tickets_buyer_phone ON ganadores_tickets (buyer_phone, draw_date);');
+        if (!ganadoresTicketsExistia) {
+            // Primera vez: pasar a filas los ganadores guardados como arreglo JSONB en 'ganadores'
+            await client.query(`
+                INSERT INTO ganadores_tickets (draw_date, draw_number, lottery_type, ticket_number, venta_id, buyer_name, buyer_phone,
+                                               numbers, purchase_date, coincident_numbers, detalle_horas, premio_usd, premio_bs, processed_at)
+                SELECT (g.data->>'drawDate')::date, (g.data->>'drawNumber')::int, g.data->>'lotteryType', w->>'ticketNumber',
+                       CASE WHEN w->>'ventaId' ~ '^[0-9]+$' THEN (w->>'ventaId')::bigint END, w->>'buyerName', w->>'buyerPhone',
+                       COALESCE(w->'numbers', '[]'::jsonb),
+                       COALESCE((w->>'purchaseDate')::timestamptz, (g.data->>'processedAt')::timestamptz, (g.data->>'drawDate')::date),
+                       COALESCE(w->'coincidentNumbers', '[]'::jsonb), COALESCE(w->'detalleHoras', '{}'::jsonb),
+                       COALESCE((w->>'totalPotentialPrizeUSD')::numeric, 0), COALESCE((w->>'totalPotentialPrizeBs')::numeric, 0),
+                       COALESCE((g.data->>'processedAt')::timestamptz, NOW())
+                FROM ganadores g
+                CROSS JOIN LATERAL jsonb_array_elements(
+                    CASE WHEN jsonb_typeof(g.data->'winners') = 'array' THEN g.data->'winners' ELSE '[]'::jsonb END
+                ) AS w
+                WHERE w->>'ticketNumber' IS NOT NULL
+                ON CONFLICT DO NOTHING;
+            `);
+            console.log('DB: Ganadores existentes copiados a "ganadores_tickets".');
+        }
+        await client.query('COMMIT');
+        console.log('DB: Tabla "ganadores_tickets" verificada/creada (y sus índices).');
+
         // INICIO DE NUEVA LÓGICA: CREACIÓN DE LA TABLA 'sellers'
         await client.query(`
             CREATE TABLE IF NOT EXISTS sellers (
@@ -716,6 +3316,10 @@ async function ensureTablesExist() {
             }
         }
 
+        // Índices secundarios (dbIndexes.js): se crean con CONCURRENTLY para no bloquear las ventas
+        // y se reconstruyen si una creación anterior quedó a medias.
+        await ensureIndexesInDB(client);
+
     } catch (error) {
         console.error('ERROR_DB_INIT: Error al asegurar que las tablas existan:', error.message);
         throw error; // Re-lanzar para detener la inicialización si la DB no está lista
@@ -745,7 +3349,7 @@ async function loadInitialData() {
         client = await pool.connect();
 
         // --- Cargar/Inicializar Configuración ---
-        let configuracion = await getConfiguracionFromDB();
+        let configuracion = await getConfiguracionFromDB(client);
         let configId = null; // To store the ID of the config row
 
 
@@ -766,7 +3370,8 @@ async function loadInitialData() {
                 raffleNumbersInitialized: false,
                 last_sales_notification_count: 0,
                 sales_notification_threshold: 20,
-                block_reason_message: ""
+                block_reason_message: "",
+                total_numeros: TOTAL_RAFFLE_NUMBERS
             };
             const insertQuery = `
                 INSERT INTO configuracion (
@@ -775,8 +3380,9 @@ async function loadInitialData() {
                     admin_whatsapp_numbers, admin_email_for_reports,
                     mail_config_host, mail_config_port, mail_config_secure,
                     mail_config_user, mail_config_pass, mail_config_sender_name,
-                    raffleNumbersInitialized, last_sales_notification_count, sales_notification_threshold, block_reason_message
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19) RETURNING id;
+                    raffleNumbersInitialized, last_sales_notification_count, sales_notification_threshold, block_reason_message,
+                    total_numeros
+                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20) RETURNING id;
             `;
             const insertValues = [
                 default_config.pagina_bloqueada, default_config.fecha_sorteo, default_config.precio_ticket,
@@ -788,7 +3394,8 @@ async function loadInitialData() {
                 default_config.mail_config_host, default_config.mail_config_port, default_config.mail_config_secure,
                 default_config.mail_config_user, default_config.mail_config_pass, default_config.mail_config_sender_name,
                 default_config.raffleNumbersInitialized, default_config.last_sales_notification_count,
-                default_config.sales_notification_threshold, default_config.block_reason_message
+                default_config.sales_notification_threshold, default_config.block_reason_message,
+                default_config.total_numeros
             ];
             const res = await client.query(insertQuery, insertValues);
             configuracion = { id: res.rows[0].id, ...default_config };
@@ -802,6 +3409,7 @@ async function loadInitialData() {
             configuracion.last_sales_notification_count = configuracion.last_sales_notification_count !== undefined ? configuracion.last_sales_notification_count : 0;
             configuracion.sales_notification_threshold = configuracion.sales_notification_threshold !== undefined ? configuracion.sales_notification_threshold : 20;
             configuracion.block_reason_message = configuracion.block_reason_message !== undefined ? configuracion.block_reason_message : "";
+            configuracion.total_numeros = createNumerosEspacio(configuracion.total_numeros).total;
             configuracion.mail_config_host = configuracion.mail_config_host !== undefined ? configuracion.mail_config_host : "";
             configuracion.mail_config_port = configuracion.mail_config_port !== undefined ? configuracion.mail_config_port : 587;
             configuracion.mail_config_secure = configuracion.mail_config_secure !== undefined ? configuracion.mail_config_secure : false;
@@ -815,43 +3423,16 @@ async function loadInitialData() {
             console.log('DEBUG_INIT: Configuración después de asegurar propiedades:', JSON.stringify(configuracion, null, 2));
         }
 
-        // --- Inicializar Números de Rifa si no están (o si hay menos de 1000) ---
-        let numerosCountRes = await client.query('SELECT COUNT(*) FROM numeros');
-        const currentNumbersCount = parseInt(numerosCountRes.rows[0].count, 10);
-        console.log(`DEBUG_LOAD_INITIAL: currentNumbersCount en la tabla numeros: ${currentNumbersCount}`);
-
-
-        if (currentNumbersCount < TOTAL_RAFFLE_NUMBERS) {
-            console.warn(`DEBUG_LOAD_INITIAL: Se encontraron ${currentNumbersCount} números. Inicializando/completando hasta ${TOTAL_RAFFLE_NUMBERS}.`);
-            const existingNumbers = (await client.query('SELECT numero FROM numeros')).rows.map(row => row.numero);
-            console.log(`DEBUG_LOAD_INITIAL: Números existentes antes de upsert: ${existingNumbers.length}`);
-            const initialNumbersToInsert = [];
-            for (let i = 0; i < TOTAL_RAFFLE_NUMBERS; i++) {
-                const numStr = i.toString().padStart(3, '0');
-                if (!existingNumbers.includes(numStr)) {
-                    initialNumbersToInsert.push({ numero: numStr, comprado: false, originalDrawNumber: null });
-                }
-            }
-            if (initialNumbersToInsert.length > 0) {
-                console.log(`DEBUG_LOAD_INITIAL: Preparando para insertar/actualizar ${initialNumbersToInsert.length} números.`);
-                await upsertNumerosInDB(initialNumbersToInsert);
-                console.log(`DEBUG_LOAD_INITIAL: Insertados/actualizados ${initialNumbersToInsert.length} números iniciales.`);
-            } else {
-                console.log('DEBUG_LOAD_INITIAL: No se necesitan insertar números adicionales. La tabla ya tiene todos los números esperados.');
-            }
-            if (!configuracion.raffleNumbersInitialized) { // Check again after potential initial insert
-                configuracion.raffleNumbersInitialized = true;
-                // Use the configId to update the specific row
-                await updateConfiguracionInDB({ ...configuracion, id: configId });
-                console.log('DEBUG_LOAD_INITIAL: raffleNumbersInitialized actualizado a true en configuración.');
-            }
-        } else if (!configuracion.raffleNumbersInitialized) {
+        // --- Números de Rifa ---
+        // 'numeros' solo guarda filas de los números usados (se crean al reservarlos o comprarlos), así que
+        // no hace falta sembrar la grilla: cualquier número del espacio del sorteo sin fila está disponible.
+        const espacio = createNumerosEspacio(configuracion.total_numeros);
+        console.log(`DEBUG_LOAD_INITIAL: Espacio de números del sorteo: ${espacio.total} números de ${espacio.digitos} dígitos.`);
+        if (!configuracion.raffleNumbersInitialized) {
             configuracion.raffleNumbersInitialized = true;
             // Use the configId to update the specific row
-            await updateConfiguracionInDB({ ...configuracion, id: configId });
-            console.log('DEBUG_LOAD_INITIAL: raffleNumbersInitialized actualizado a true en configuración (ya tenía 1000 números).');
-        } else {
-            console.log('DEBUG_LOAD_INITIAL: La tabla numeros ya tiene 1000 números y raffleNumbersInitialized es true.');
+            await updateConfiguracionInDB({ ...configuracion, id: configId }, client);
+            console.log('DEBUG_LOAD_INITIAL: raffleNumbersInitialized actualizado a true en configuración.');
         }
 
         console.log('DEBUG_INIT: Datos iniciales cargados o asegurados en la base de datos.');
@@ -955,17 +3536,12 @@ async function sendWhatsappNotification(messageText) {
 async function sendSalesSummaryNotifications() {
     console.log('[sendSalesSummaryNotifications] Iniciando notificación de resumen de ventas.');
     let configuracion = await getConfiguracionFromDB(); // Obtener la configuración más reciente
-    let ventas = await getVentasFromDB(); // Obtener las ventas más recientes
+    const totales = await getSalesTotalsFromDB(configuracion.fecha_sorteo); // Contadores incrementales del sorteo
 
     const now = moment().tz(CARACAS_TIMEZONE);
 
-    const ventasParaFechaSorteo = ventas.filter(venta =>
-        venta.drawDate === configuracion.fecha_sorteo &&
-        (venta.validationStatus === 'Confirmado' || venta.validationStatus === 'Pendiente')
-    );
-
-    const totalVentas = ventasParaFechaSorteo.length;
-    const totalPossibleTickets = TOTAL_RAFFLE_NUMBERS;
+    const totalVentas = totales.tickets;
+    const totalPossibleTickets = createNumerosEspacio(configuracion.total_numeros).total;
     const soldPercentage = (totalVentas / totalPossibleTickets) * 100;
 
     const whatsappMessageText = `*Actualización de Ventas Lotería:*\n\n` +
@@ -979,6 +3555,8 @@ async function sendSalesSummaryNotifications() {
     try {
         if (configuracion.admin_email_for_reports && configuracion.admin_email_for_reports.length > 0) {
             console.log('[sendSalesSummaryNotifications] Generando reporte Excel para correo...');
+            // El detalle del Excel solo necesita las ventas del sorteo activo, no la tabla completa
+            const ventasParaFechaSorteo = await getVentasByDrawDateFromDB(configuracion.fecha_sorteo, ESTADOS_VENTA_ACTIVOS);
             const { excelFilePath, excelFileName } = await generateGenericSalesExcelReport(
                 ventasParaFechaSorteo,
                 configuracion,
@@ -990,8 +3568,8 @@ async function sendSalesSummaryNotifications() {
             const emailSubject = `Reporte de Ventas Periódico - ${now.format('YYYY-MM-DD HH:mm')}`;
             const emailHtmlContent = `
                 <p>Se ha generado un reporte de ventas periódico para el sorteo del día <strong>${configuracion.fecha_sorteo}</strong>.</p>
-                <p><b>Total de Ventas USD:</b> $${ventasParaFechaSorteo.reduce((sum, venta) => sum + (parseFloat(venta.valueUSD) || 0), 0).toFixed(2)}</p>
-                <p><b>Total de Ventas Bs:</b> Bs ${ventasParaFechaSorteo.reduce((sum, venta) => sum + (parseFloat(venta.valueBs) || 0), 0).toFixed(2)}</p>
+                <p><b>Total de Ventas USD:</b> $${totales.totalUSD.toFixed(2)}</p>
+                <p><b>Total de Ventas Bs:</b> Bs ${totales.totalBs.toFixed(2)}</p>
                 <p><b>Porcentaje de Tickets Vendidos:</b> ${soldPercentage.toFixed(2)}%</p>
                 <p>Adjunto encontrarás el detalle completo en formato Excel.</p>
                 <p>Última actualización: ${now.format('DD/MM/YYYY HH:mm:ss')}</p>
@@ -1018,6 +3596,509 @@ async function sendSalesSummaryNotifications() {
 }
 
 
+/**
+ * Envía a los administradores el correo con un comprobante de pago recién subido.
+ * @param {object} datos - { ventaData, fileName, filePath, mimetype } tal como se encolaron en la subida.
+ */
+async function sendComprobanteUploadedEmail({ ventaData, fileName, filePath, mimetype }) {
+    const configuracion = await getConfiguracionFromDB(); // Obtener la configuración más reciente
+    if (configuracion.admin_email_for_reports && configuracion.admin_email_for_reports.length > 0) {
+        const subject = `Nuevo Comprobante de Pago para Venta #${ventaData.ticketNumber}`;
+        const htmlContent = `
+            <p>Se ha subido un nuevo comprobante de pago para la venta con Ticket Nro. <strong>${ventaData.ticketNumber}</strong>.</p>
+            <p><b>Comprador:</b> ${ventaData.buyerName}</p>
+            <p><b>Teléfono:</b> ${ventaData.buyerPhone}</p>
+            <p><b>Números:</b> ${ventaData.numbers.join(', ')}</p>
+            <p><b>Monto USD:</b> $${(parseFloat(ventaData.valueUSD) || 0).toFixed(2)}</p>
+            <p><b>Monto Bs:</b> Bs ${(parseFloat(ventaData.valueBs) || 0).toFixed(2)}</p>
+            <p><b>Método de Pago:</b> ${ventaData.paymentMethod}</p>
+            <p><b>Referencia:</b> ${ventaData.paymentReference}</p>
+            <p>Haz clic <a href="${API_BASE_URL}/uploads/comprobantes/${fileName}" target="_blank">aquí</a> para ver el comprobante.</p>
+            <p>También puedes verlo en el panel de administración.</p>
+        `;
+        const attachments = [
+            {
+                filename: fileName,
+                path: filePath,
+                contentType: mimetype
+            }
+        ];
+        const emailSent = await sendEmail(configuracion.admin_email_for_reports, subject, htmlContent, attachments);
+        if (!emailSent) {
+            throw new Error('Fallo al enviar el correo con el comprobante.');
+        }
+    }
+}
+
+/**
+ * Verifica si las ventas del sorteo actual cruzaron un nuevo múltiplo del umbral de notificación
+ * y, en ese caso, envía el resumen de ventas (WhatsApp + Excel por correo).
+ * El nuevo contador se reclama con un UPDATE condicional y el envío se encola como tarea
+ * 'resumen_ventas' en la misma transacción: dos ejecuciones concurrentes nunca envían el mismo
+ * resumen dos veces, y si el envío falla se reintenta como su propia tarea.
+ */
+async function checkSalesNotificationThreshold() {
+    const configuracion = await getConfiguracionFromDB(); // Recargar la más reciente
+    const { tickets: currentTotalSales } = await getSalesTotalsFromDB(configuracion.fecha_sorteo);
+
+    const prevNotifiedCount = configuracion.last_sales_notification_count || 0;
+    const notificationThreshold = configuracion.sales_notification_threshold || 20;
+
+    const currentMultiple = Math.floor(currentTotalSales / notificationThreshold);
+    const prevMultiple = Math.floor(prevNotifiedCount / notificationThreshold);
+
+    if (currentMultiple > prevMultiple) {
+        const nuevoContador = currentMultiple * notificationThreshold;
+        const client = await pool.connect();
+        try {
+            await client.query('BEGIN');
+            const claimRes = await client.query(
+                'UPDATE configuracion SET last_sales_notification_count = $1 WHERE id = $2 AND COALESCE(last_sales_notification_count, 0) < $1',
+                [nuevoContador, configuracion.id]
+            );
+            if (claimRes.rowCount === 0) {
+                await client.query('ROLLBACK');
+                console.log('[WhatsApp Notificación Resumen] Otro proceso ya envió la notificación para este múltiplo del umbral.');
+                return;
+            }
+            await enqueueJob('resumen_ventas', { contador: nuevoContador }, client);
+            await client.query('COMMIT');
+        } catch (error) {
+            await client.query('ROLLBACK');
+            throw error;
+        } finally {
+            client.release();
+        }
+        kickJobWorker();
+        console.log(`[WhatsApp Notificación Resumen] Ventas actuales (${currentTotalSales}) han cruzado un nuevo múltiplo (${nuevoContador}) del umbral (${notificationThreshold}). Notificación de resumen encolada; contador actualizado en DB.`);
+    } else {
+        console.log(`[WhatsApp Notificación Resumen Check] Ventas actuales (${currentTotalSales}) no han cruzado un nuevo múltiplo del umbral (${notificationThreshold}). Último contador notificado: ${prevNotifiedCount}. No se envió notificación de resumen.`);
+    }
+}
+
+
+// INICIO DE NUEVA LÓGICA: CÁLCULO DE GANADORES
+// Los ganadores de cada sorteo se guardan en 'ganadores' con el detalle de aciertos por hora de resultado
+// ('detalleHoras'), así un cambio en los resultados de una hora recalcula solo esa hora. Al guardar
+// resultados se encola la tarea 'calcular_ganadores' con las horas cambiadas; al guardar premios u
+// horarios, un recálculo completo (los montos de todas las horas pueden cambiar). GET /api/tickets/ganadores
+// solo lee lo ya calculado.
+// Qué premio paga cada hora lo define 'horarios_zulia' (premio_clave por tipo de lotería y hora): agregar
+// una hora o un tipo de lotería no requiere cambios de código.
+
+// Claves de 'premios' de las horas que antes estaban fijas en el código; se copian a 'horarios_zulia'
+const PREMIOS_CLAVES_HORAS_ANTERIORES = {
+    '12:45 PM': 'sorteo12PM',
+    '04:45 PM': 'sorteo3PM',
+    '07:05 PM': 'sorteo5PM'
+};
+
+/**
+ * Clave de 'premios' que el código anterior asignaba a una hora, o null si no es una de esas horas.
+ * Compara por subcadena como lo hacía ese código ('Zulia 12:45 PM' paga 'sorteo12PM'), sobre la hora tal
+ * cual y normalizada ('4:45 pm' paga 'sorteo3PM').
+ * @param {string} hora - Hora de un horario o de un resultado.
+ * @returns {string|null}
+ */
+function premioClaveHoraAnterior(hora) {
+    const texto = String(hora || '');
+    const normalizada = normalizarHoraSorteo(hora);
+    const anterior = Object.keys(PREMIOS_CLAVES_HORAS_ANTERIORES).find(h => texto.includes(h) || normalizada.includes(h));
+    return anterior ? PREMIOS_CLAVES_HORAS_ANTERIORES[anterior] : null;
+}
+
+/**
+ * Forma canónica de una hora de sorteo ('4:45 pm' -> '04:45 PM'), para comparar horarios y resultados.
+ * @param {string} hora - Hora tal como se guardó.
+ * @returns {string}
+ */
+function normalizarHoraSorteo(hora) {
+    const texto = String(hora || '').trim().toUpperCase().replace(/\s+/g, ' ');
+    const parsed = moment(texto, ['hh:mm A', 'h:mm A'], true);
+    return parsed.isValid() ? parsed.format('hh:mm A') : texto;
+}
+
+/**
+ * Compila las reglas de premios para los resultados de una corrida en una tabla por número: cada número
+ * ganador (en las formas de variantesNumeroVendido) apunta a los pagos que le corresponden. Los montos se
+ * leen una sola vez aquí; evaluar un ticket es una búsqueda por cada número acertado.
+ * Las horas sin regla en 'horarios_zulia' usan la clave que les daba el código anterior
+ * (premioClaveHoraAnterior); un acierto en una hora sin ninguna de las dos cuenta como ganador con premio 0.
+ * @param {Array<object>} resultados - Resultados a evaluar ([{ hora, tripleA, tripleB }]).
+ * @param {Map<string, string>} reglas - Hora normalizada -> clave de 'premios' (getReglasPremiosFromDB).
+ * @param {object} premiosDelDia - Premios de la fecha (tabla 'premios').
+ * @returns {Map<string, Array<{hora: string, tipo: string, premioUSD: number}>>}
+ */
+function compilarTablaPremios(resultados, reglas, premiosDelDia) {
+    const tabla = new Map();
+    for (const r of resultados) {
+        if (!r || !r.hora) continue;
+        const clave = reglas.get(normalizarHoraSorteo(r.hora)) || premioClaveHoraAnterior(r.hora);
+        const config = premiosDelDia[clave] || null;
+        [['A', r.tripleA, config && config.valorTripleA], ['B', r.tripleB, config && config.valorTripleB]].forEach(([tipo, triple, valor]) => {
+            if (triple === null || triple === undefined || !/^\d+$/.test(String(triple).trim())) return;
+            const pago = { hora: r.hora, tipo, premioUSD: parseFloat(valor) || 0 };
+            variantesNumeroVendido(triple).forEach(numero => {
+                if (!tabla.has(numero)) tabla.set(numero, []);
+                tabla.get(numero).push(pago);
+            });
+        });
+    }
+    return tabla;
+}
+
+/**
+ * Horas cuyos triples cambiaron entre dos listas de resultados (agregadas, quitadas o modificadas).
+ * @param {Array<object>} anteriores - Resultados guardados antes ([{ hora, tripleA, tripleB }]).
+ * @param {Array<object>} nuevos - Resultados nuevos.
+ * @returns {Array<string>} Horas cambiadas, ordenadas.
+ */
+function horasConResultadosCambiados(anteriores, nuevos) {
+    const triple = valor => (valor === null || valor === undefined ? null : String(valor).trim());
+    const porHora = lista => new Map((lista || [])
+        .filter(r => r && r.hora)
+        .map(r => [r.hora, JSON.stringify([triple(r.tripleA), triple(r.tripleB)])]));
+    const antes = porHora(anteriores);
+    const despues = porHora(nuevos);
+    const horas = new Set();
+    for (const [hora, valor] of antes) if (despues.get(hora) !== valor) horas.add(hora);
+    for (const [hora, valor] of despues) if (antes.get(hora) !== valor) horas.add(hora);
+    return Array.from(horas).sort();
+}
+
+/**
+ * Calcula los aciertos de un sorteo con una tabla de premios compilada, agrupados por venta y por hora.
+ * @param {string} fecha - Fecha del sorteo (YYYY-MM-DD).
+ * @param {number} drawNumber - Número (correlativo) del sorteo.
+ * @param {Map<string, Array<object>>} tablaPremios - Tabla de compilarTablaPremios.
+ * @param {object|null} [client] - Cliente de pg existente para reutilizar su conexión/transacción.
+ * @returns {Promise<Map<string, {venta: object, detalleHoras: object}>>} Por ID de venta; 'detalleHoras' es
+ *          { [hora]: { numeros: Array<number>, tipos: Array<string>, premioUSD: number } }.
+ */
+async function calcularAciertosPorHora(fecha, drawNumber, tablaPremios, client = null) {
+    const ventas = await getVentasGanadorasFromDB(drawNumber, fecha, Array.from(tablaPremios.keys()), client);
+    const porVenta = new Map();
+    for (const venta of ventas) {
+        const detalleHoras = {};
+        for (const numeroAcertado of venta.aciertos) {
+            const numero = parseInt(numeroAcertado, 10);
+            for (const pago of tablaPremios.get(numeroAcertado) || []) {
+                const detalle = detalleHoras[pago.hora] || (detalleHoras[pago.hora] = { numeros: [], tipos: [], premioUSD: 0 });
+                if (!detalle.numeros.includes(numero)) detalle.numeros.push(numero);
+                if (detalle.tipos.includes(pago.tipo)) continue; // Cada triple paga una vez por hora
+                detalle.tipos.push(pago.tipo);
+                detalle.premioUSD += pago.premioUSD;
+            }
+        }
+        porVenta.set(String(venta.id), { venta, detalleHoras });
+    }
+    return porVenta;
+}
+
+/**
+ * Arma el registro de un ganador con sus totales a partir de su detalle por hora.
+ * @param {object} base - Venta (o ganador ya guardado) de la que se toman los datos del ticket.
+ * @param {object} detalleHoras - Aciertos por hora (ver calcularAciertosPorHora).
+ * @param {number} tasaDolar - Tasa para el total en Bs.
+ * @returns {object} Ganador con el formato de upsertGanadoresTicketsInDB.
+ */
+function armarGanador(base, detalleHoras, tasaDolar) {
+    const detalles = Object.values(detalleHoras);
+    const totalPotentialPrizeUSD = detalles.reduce((sum, detalle) => sum + detalle.premioUSD, 0);
+    return {
+        ventaId: base.ventaId != null ? String(base.ventaId) : (base.id != null ? String(base.id) : null),
+        ticketNumber: base.ticketNumber,
+        buyerName: base.buyerName,
+        buyerPhone: base.buyerPhone,
+        numbers: Array.isArray(base.numbers) ? base.numbers : [],
+        drawDate: toDrawDateString(base.drawDate),
+        drawNumber: base.drawNumber,
+        purchaseDate: base.purchaseDate,
+        coincidentNumbers: Array.from(new Set(detalles.flatMap(detalle => detalle.numeros))),
+        totalPotentialPrizeUSD,
+        totalPotentialPrizeBs: totalPotentialPrizeUSD * tasaDolar,
+        detalleHoras
+    };
+}
+
+/**
+ * Calcula y guarda los ganadores de un sorteo. Con 'horas' solo se recalculan los aciertos de esas horas
+ * y se conservan los del resto; sin 'horas', o si la entrada guardada no tiene detalle por hora, se
+ * recalcula todo. Un bloqueo asesor por sorteo y lotería serializa los cálculos concurrentes.
+ * @param {string} fecha - Fecha del sorteo (YYYY-MM-DD).
+ * @param {number} drawNumber - Número (correlativo) del sorteo.
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {Array<string>|null} [horas] - Horas de resultado a recalcular (null = todas).
+ * @returns {Promise<{estado: string, totalGanadores?: number}>} estado: 'ok', 'sin_resultados' o 'sin_premios'.
+ */
+async function procesarGanadoresSorteo(fecha, drawNumber, tipoLoteria, horas = null) {
+    const client = await pool.connect();
+    try {
+        await client.query('BEGIN');
+        await client.query('SELECT pg_advisory_xact_lock(hashtext($1))', [`ganadores:${fecha}:${drawNumber}:${tipoLoteria}`]);
+
+        const resultadosDelDia = (await getResultadosZuliaFromDB(fecha, tipoLoteria, client)).find(r =>
+            r.fecha === fecha && r.tipoLoteria.toLowerCase() === tipoLoteria.toLowerCase()
+        );
+        if (!resultadosDelDia || !resultadosDelDia.resultados || resultadosDelDia.resultados.length === 0) {
+            await client.query('ROLLBACK');
+            return { estado: 'sin_resultados' };
+        }
+        const premiosDelDia = await getPremiosFromDB(fecha, client); // getPremiosFromDB ya devuelve el objeto para la fecha
+        if (!premiosDelDia) {
+            await client.query('ROLLBACK');
+            return { estado: 'sin_premios' };
+        }
+        const configuracion = await getConfiguracionFromDB(client);
+        const tasaDolar = configuracion.tasa_dolar[0]; // Acceder al valor numérico del array
+
+        const anterior = await getGanadoresEntryFromDB(fecha, drawNumber, tipoLoteria, client);
+        const incremental = Array.isArray(horas) && anterior !== null && anterior.detallePorHora === true;
+        const recalcular = incremental ? new Set(horas) : null;
+
+        const resultados = resultadosDelDia.resultados.filter(r => r && (!recalcular || recalcular.has(r.hora)));
+        // Reglas compiladas una vez por corrida: número -> pagos por hora y triple
+        const tablaPremios = compilarTablaPremios(resultados, await getReglasPremiosFromDB(tipoLoteria, client), premiosDelDia);
+        const nuevos = await calcularAciertosPorHora(fecha, drawNumber, tablaPremios, client);
+
+        // Ganadores por ticket: en modo incremental solo se leen las filas que tocan las horas cambiadas
+        // o los tickets con aciertos nuevos; el resto de 'ganadores_tickets' no se reescribe
+        const porTicket = new Map();
+        if (incremental) {
+            const afectados = await client.query(
+                `SELECT * FROM ganadores_tickets
+                 WHERE draw_date = $1::date AND draw_number = $2 AND lottery_type = $3
+                   AND (detalle_horas ?| $4::text[] OR ticket_number = ANY($5::text[]))
+                 FOR UPDATE`,
+                [fecha, drawNumber, tipoLoteria, horas, Array.from(nuevos.values()).map(({ venta }) => venta.ticketNumber)]
+            );
+            for (const row of afectados.rows) {
+                const ganador = ganadorFromRow(row);
+                const detalleHoras = {};
+                Object.entries(ganador.detalleHoras || {}).forEach(([hora, detalle]) => {
+                    if (!recalcular.has(hora)) detalleHoras[hora] = detalle;
+                });
+                porTicket.set(ganador.ticketNumber, { base: ganador, detalleHoras });
+            }
+        }
+        for (const { venta, detalleHoras } of nuevos.values()) {
+            const conservado = porTicket.get(venta.ticketNumber);
+            porTicket.set(venta.ticketNumber, { base: venta, detalleHoras: { ...(conservado ? conservado.detalleHoras : {}), ...detalleHoras } });
+        }
+
+        const winners = [];
+        const sinAciertos = [];
+        for (const [ticketNumber, { base, detalleHoras }] of porTicket) {
+            if (Object.keys(detalleHoras).length > 0) {
+                winners.push(armarGanador(base, detalleHoras, tasaDolar));
+            } else {
+                sinAciertos.push(ticketNumber);
+            }
+        }
+        const pagosDistintos = await upsertGanadoresTicketsInDB(client, fecha, drawNumber, tipoLoteria, winners);
+        let anulados = [];
+        if (incremental) {
+            if (sinAciertos.length > 0) {
+                anulados = await quitarGanadoresTicketsInDB(client, fecha, drawNumber, tipoLoteria, { quitar: sinAciertos });
+            }
+        } else {
+            anulados = await quitarGanadoresTicketsInDB(client, fecha, drawNumber, tipoLoteria, { conservar: winners.map(ganador => ganador.ticketNumber) });
+        }
+        pagosDistintos.forEach(({ ticketNumber, premioUSD, premioPagadoUSD }) => {
+            console.warn(`WARN_GANADORES: El ticket pagado ${ticketNumber} del sorteo ${drawNumber} de ${tipoLoteria} (${fecha}) ahora tiene premio ${premioUSD} USD; se pagaron ${premioPagadoUSD} USD.`);
+        });
+        if (anulados.length > 0) {
+            console.warn(`WARN_GANADORES: Tickets pagados que dejaron de ganar en el sorteo ${drawNumber} de ${tipoLoteria} (${fecha}), marcados como anulados: ${anulados.join(', ')}.`);
+        }
+        const totalGanadores = parseInt((await client.query(
+            `SELECT COUNT(*) AS total FROM ganadores_tickets WHERE draw_date = $1::date AND draw_number = $2 AND lottery_type = $3 AND estado_pago <> 'anulado'`,
+            [fecha, drawNumber, tipoLoteria]
+        )).rows[0].total, 10);
+
+        // La cabecera en 'ganadores' solo marca el sorteo como procesado; los tickets están en 'ganadores_tickets'
+        await upsertGanadoresInDB({
+            drawDate: fecha,
+            drawNumber,
+            lotteryType: tipoLoteria,
+            processedAt: moment().tz(CARACAS_TIMEZONE).toISOString(),
+            detallePorHora: true,
+            totalGanadores
+        }, client);
+        await client.query('COMMIT');
+        console.log(`[procesarGanadoresSorteo] Sorteo ${drawNumber} de ${tipoLoteria} del ${fecha}: ${totalGanadores} ganadores (${incremental ? `horas ${horas.join(', ')}, ${winners.length} tickets actualizados` : 'cálculo completo'}).`);
+        return { estado: 'ok', totalGanadores };
+    } catch (error) {
+        await client.query('ROLLBACK');
+        throw error;
+    } finally {
+        client.release();
+    }
+}
+
+/**
+ * Recalcula los ganadores de todos los sorteos con ventas en una fecha (tarea 'calcular_ganadores').
+ * @param {string} fecha - Fecha de los resultados (YYYY-MM-DD).
+ * @param {string} tipoLoteria - Tipo de lotería.
+ * @param {Array<string>|null} [horas] - Horas de resultado cambiadas (null = todas).
+ */
+async function procesarGanadoresDeFecha(fecha, tipoLoteria, horas = null) {
+    const res = await pool.query('SELECT DISTINCT "drawNumber" FROM ventas WHERE "drawDate" = $1::date ORDER BY "drawNumber"', [fecha]);
+    for (const row of res.rows) {
+        await procesarGanadoresSorteo(fecha, row.drawNumber, tipoLoteria, horas);
+    }
+}
+
+// Al cambiar las reglas de horarios se recalculan las fechas con resultados desde hace estos días; los
+// sorteos más viejos conservan los premios con los que se calcularon
+const GANADORES_RECALCULO_HORARIOS_DIAS = 1;
+
+/**
+ * Encola un recálculo completo (horas: null) de los ganadores de cada fecha y lotería con resultados
+ * guardados que cumpla el filtro. Lo usan los cambios de premios y de horarios, que alteran los montos
+ * de todas las horas ya calculadas. Debe ejecutarse en la transacción que guarda el cambio.
+ * @param {object} client - Cliente de pg con una transacción activa.
+ * @param {object} filtro - { fecha, tipoLoteria, desde }; los que se omiten no filtran.
+ * @returns {Promise<number>} Cantidad de tareas encoladas.
+ */
+async function encolarRecalculoGanadores(client, { fecha = null, tipoLoteria = null, desde = null } = {}) {
+    const res = await client.query(
+        `SELECT DISTINCT data->>'fecha' AS fecha, data->>'tipoLoteria' AS tipo_loteria
+         FROM resultados_zulia
+         WHERE ($1::text IS NULL OR (data->>'fecha') = $1)
+           AND ($2::text IS NULL OR lower(data->>'tipoLoteria') = lower($2))
+           AND ($3::text IS NULL OR (data->>'fecha') >= $3)`,
+        [fecha, tipoLoteria, desde]
+    );
+    for (const row of res.rows) {
+        await enqueueJob('calcular_ganadores', { fecha: row.fecha, tipoLoteria: row.tipo_loteria, horas: null }, client);
+    }
+    return res.rows.length;
+}
+// FIN DE NUEVA LÓGICA: CÁLCULO DE GANADORES
+
+
+// INICIO DE NUEVA LÓGICA: COLA DE TAREAS EN SEGUNDO PLANO
+// Las tareas se guardan en la tabla 'tareas_pendientes' (normalmente dentro de la misma transacción
+// que las origina) y un trabajador en el proceso las ejecuta con concurrencia limitada.
+// Si el proceso se reinicia, las tareas pendientes o interrumpidas se retoman al arrancar.
+const JOB_QUEUE_CONCURRENCY = Math.max(1, parseInt(process.env.JOB_QUEUE_CONCURRENCY, 10) || 2);
+const JOB_QUEUE_POLL_MS = 5000; // Respaldo por si se pierde un aviso (ej. tareas encoladas por otro proceso)
+const JOB_LOCK_SECONDS = 300; // Si un proceso muere con la tarea tomada, otro la retoma tras este tiempo
+const JOB_MAX_ATTEMPTS = 5;
+
+// Manejadores por tipo de tarea. Cada uno recibe el payload JSON guardado al encolar.
+const jobHandlers = {
+    notificacion_whatsapp: ({ mensaje }) => sendWhatsappNotification(mensaje),
+    verificar_umbral_ventas: () => checkSalesNotificationThreshold(),
+    resumen_ventas: () => sendSalesSummaryNotifications(),
+    correo_comprobante: (payload) => sendComprobanteUploadedEmail(payload),
+    calcular_ganadores: ({ fecha, tipoLoteria, horas }) => procesarGanadoresDeFecha(fecha, tipoLoteria, horas || null)
+};
+
+let activeJobs = 0;
+let jobWorkerScheduled = false;
+let jobWorkerStarted = false;
+
+/**
+ * Encola una tarea en segundo plano.
+ * @param {string} tipo - Tipo de tarea (clave de jobHandlers).
+ * @param {object} payload - Datos de la tarea (serializables a JSON).
+ * @param {object|null} [client] - Cliente de pg para encolarla dentro de la transacción del llamador.
+ */
+async function enqueueJob(tipo, payload, client = null) {
+    if (!jobHandlers[tipo]) {
+        throw new Error(`Tipo de tarea desconocido: ${tipo}`);
+    }
+    return withDBClient(client, async (client) => {
+        await client.query(
+            'INSERT INTO tareas_pendientes (tipo, payload) VALUES ($1, $2)',
+            [tipo, JSON.stringify(payload)]
+        );
+    });
+}
+
+/**
+ * Pide al trabajador que revise la cola cuanto antes (llamar después del COMMIT que encoló tareas).
+ */
+function kickJobWorker() {
+    if (!jobWorkerStarted || jobWorkerScheduled) return;
+    jobWorkerScheduled = true;
+    setImmediate(() => {
+        jobWorkerScheduled = false;
+        drainJobQueue().catch(error => console.error('ERROR_JOB_QUEUE: Error al procesar la cola de tareas:', error.message));
+    });
+}
+
+/**
+ * Toma tareas disponibles (sin exceder JOB_QUEUE_CONCURRENCY) y las ejecuta.
+ * FOR UPDATE SKIP LOCKED permite que varios procesos compartan la misma cola sin tomar la misma tarea.
+ */
+async function drainJobQueue() {
+    const libres = JOB_QUEUE_CONCURRENCY - activeJobs;
+    if (libres <= 0) return;
+
+    const res = await pool.query(
+        `UPDATE tareas_pendientes SET
+             estado = 'en_proceso',
+             intentos = intentos + 1,
+             locked_until = NOW() + make_interval(secs => $2)
+         WHERE id IN (
+             SELECT id FROM tareas_pendientes
+             WHERE (estado = 'pendiente' AND run_after <= NOW())
+                OR (estado = 'en_proceso' AND locked_until <= NOW())
+             ORDER BY id
+             LIMIT $1
+             FOR UPDATE SKIP LOCKED
+         )
+         RETURNING id, tipo, payload, intentos;`,
+        [libres, JOB_LOCK_SECONDS]
+    );
+
+    for (const job of res.rows) {
+        activeJobs++;
+        runJob(job).finally(() => {
+            activeJobs--;
+            kickJobWorker(); // Puede haber más tareas esperando un cupo
+        });
+    }
+}
+
+/**
+ * Ejecuta una tarea y registra su resultado: se elimina si termina bien, se reprograma con
+ * espera exponencial si falla, y queda como 'fallida' al agotar JOB_MAX_ATTEMPTS.
+ * @param {object} job - Fila de 'tareas_pendientes'.
+ */
+async function runJob(job) {
+    try {
+        await jobHandlers[job.tipo](job.payload || {});
+        await pool.query('DELETE FROM tareas_pendientes WHERE id = $1', [job.id]);
+    } catch (error) {
+        console.error(`ERROR_JOB_QUEUE: La tarea ${job.id} (${job.tipo}) falló en el intento ${job.intentos}:`, error.message);
+        const estado = job.intentos >= JOB_MAX_ATTEMPTS ? 'fallida' : 'pendiente';
+        await pool.query(
+            `UPDATE tareas_pendientes SET
+                 estado = $2,
+                 last_error = $3,
+                 locked_until = NULL,
+                 run_after = NOW() + make_interval(secs => $4)
+             WHERE id = $1`,
+            [job.id, estado, error.message, 10 * Math.pow(2, job.intentos)]
+        ).catch(updateError => console.error('ERROR_JOB_QUEUE: No se pudo reprogramar la tarea:', updateError.message));
+    }
+}
+
+/**
+ * Arranca el trabajador de la cola: procesa lo pendiente al iniciar y revisa periódicamente.
+ */
+function startJobWorker() {
+    jobWorkerStarted = true;
+    setInterval(kickJobWorker, JOB_QUEUE_POLL_MS).unref();
+    kickJobWorker();
+    console.log(`DEBUG_JOB_QUEUE: Trabajador de tareas iniciado (concurrencia ${JOB_QUEUE_CONCURRENCY}).`);
+}
+// FIN DE NUEVA LÓGICA: COLA DE TAREAS EN SEGUNDO PLANO
+
+
 // ===============================================
 // === ENDPOINTS DE LA API =======================
 // ===============================================
@@ -1040,7 +4121,8 @@ app.use(cors({
         return callback(null, true);
     },
     methods: ['GET', 'POST', 'PUT', 'DELETE'],
-    allowedHeaders: ['Content-Type', 'Authorization'],
+    allowedHeaders: ['Content-Type', 'Authorization', 'Idempotency-Key'],
+    exposedHeaders: ['X-Numeros-Version'],
     credentials: true
 }));
 
@@ -1051,10 +4133,15 @@ app.options('*', cors()); // Enable pre-flight across all routes
 // Obtener configuración
 app.get('/api/configuracion', async (req, res) => {
     try {
-        const configuracion = await getConfiguracionFromDB();
-        const configToSend = { ...configuracion };
-        delete configToSend.mail_config_pass; // No enviar credenciales sensibles
-        res.json(configToSend);
+        // Con la caché vigente, un cliente al día recibe 304 sin consultar la DB
+        if (configuracionCache && applyETag(req, res, `"c${configuracionCache.version}"`)) {
+            return res.status(304).end();
+        }
+        const { version, body } = await getConfiguracionPublica();
+        if (applyETag(req, res, `"c${version}"`)) {
+            return res.status(304).end();
+        }
+        res.type('json').send(body);
     } catch (error) {
         console.error('Error al obtener configuración:', error.message);
         res.status(500).json({ message: 'Error interno del servidor al obtener configuración.' });
@@ -1066,6 +4153,8 @@ app.put('/api/configuracion', async (req, res) => {
     const newConfig = req.body;
     try {
         let currentConfig = await getConfiguracionFromDB();
+        const espacioActual = createNumerosEspacio(currentConfig.total_numeros);
+        const fechaSorteoActual = currentConfig.fecha_sorteo;
 
         // Actualizar solo los campos que vienen en newConfig y que existen en currentConfig
         // Excluir campos de mail_config si se manejan por separado o no se deben actualizar directamente aquí
@@ -1103,6 +4192,20 @@ app.put('/api/configuracion', async (req, res) => {
         if (newConfig.block_reason_message !== undefined) {
             currentConfig.block_reason_message = newConfig.block_reason_message;
         }
+        if (newConfig.total_numeros !== undefined) {
+            const totalNumeros = parseInt(newConfig.total_numeros, 10);
+            if (!ESPACIOS_NUMEROS_PERMITIDOS.includes(totalNumeros)) {
+                return res.status(400).json({ message: `El total de números debe ser uno de: ${ESPACIOS_NUMEROS_PERMITIDOS.join(', ')}.` });
+            }
+            if (totalNumeros !== espacioActual.total) {
+                // El espacio de números es del sorteo: solo se cambia mientras el sorteo actual no tiene ventas
+                const { tickets } = await getSalesTotalsFromDB(fechaSorteoActual);
+                if (tickets > 0) {
+                    return res.status(409).json({ message: `No se puede cambiar el total de números: el sorteo del ${toDrawDateString(fechaSorteoActual)} ya tiene ${tickets} ventas.` });
+                }
+            }
+            currentConfig.total_numeros = totalNumeros;
+        }
 
         await updateConfiguracionInDB(currentConfig);
 
@@ -1114,9 +4217,63 @@ app.put('/api/configuracion', async (req, res) => {
 });
 
 
+// Formatos compactos de GET /api/numeros, elegidos con ?formato= o con el encabezado Accept.
+// 'bitmap': un bit por número (bit i = número i, el más significativo primero) en base64.
+// 'rangos': listas de rangos [inicio, fin] inclusivos.
+const NUMEROS_FORMATOS_COMPACTOS = {
+    bitmap: 'application/vnd.rifas.numeros-bitmap+json',
+    rangos: 'application/vnd.rifas.numeros-rangos+json'
+};
+
+function resolveNumerosFormato(req) {
+    if (typeof req.query.formato === 'string' && Object.hasOwn(NUMEROS_FORMATOS_COMPACTOS, req.query.formato)) {
+        return req.query.formato;
+    }
+    const accept = req.get('Accept') || '';
+    return Object.keys(NUMEROS_FORMATOS_COMPACTOS).find(formato => accept.includes(NUMEROS_FORMATOS_COMPACTOS[formato])) || null;
+}
+
 // Obtener estado de los números
 app.get('/api/numeros', async (req, res) => {
     try {
+        res.vary('Accept');
+        if (req.query.since !== undefined) {
+            // Consulta incremental: solo lo que cambió desde la versión que ya tiene el cliente
+            if (!/^\d+$/.test(String(req.query.since))) {
+                return res.status(400).json({ message: 'El parámetro "since" debe ser una versión numérica.' });
+            }
+            const delta = await getNumerosDelta(parseInt(req.query.since, 10));
+            res.set('X-Numeros-Version', String(delta.version));
+            res.set('Cache-Control', 'no-cache');
+            return res.json(delta);
+        }
+        const formato = resolveNumerosFormato(req);
+        // Con la caché cargada, un cliente al día recibe 304 sin consultar la DB ni serializar la grilla
+        if (numerosCacheCargado && applyETag(req, res, `"n${numerosCacheVersion}.${numerosVersionesAplicadas.size}.${countActiveHoldsInCache()}.${formato || 'json'}"`)) {
+            return res.status(304).end();
+        }
+        if (formato) {
+            const { version, espacio, existentes, comprados, reservados } = await getNumerosBitsets();
+            const codificar = formato === 'bitmap' ? (bits) => bits.toBase64() : (bits) => bits.ranges();
+            res.set('X-Numeros-Version', String(version));
+            res.type(NUMEROS_FORMATOS_COMPACTOS[formato]);
+            return res.send(JSON.stringify({
+                version,
+                formato,
+                total: espacio.total,
+                digitos: espacio.digitos,
+                existentes: codificar(existentes),
+                comprados: codificar(comprados),
+                reservados: codificar(reservados)
+            }));
+        }
+
+        const numerosEnCache = getNumerosFromCache();
+        if (numerosEnCache) {
+            res.set('X-Numeros-Version', String(numerosCacheVersion));
+            return res.json(numerosEnCache);
+        }
+        res.set('X-Numeros-Version', String(await getNumerosVersionFromDB()));
         const numeros = await getNumerosFromDB();
         console.log('DEBUG_BACKEND: Recibida solicitud GET /api/numeros. Enviando estado actual de numeros desde DB.');
         res.json(numeros);
@@ -1126,6 +4283,42 @@ app.get('/api/numeros', async (req, res) => {
     }
 });
 
+// Stream SSE de cambios: evento 'snapshot' al conectar, luego 'numeros' (deltas) y 'estado' (bloqueo de la página)
+app.get('/api/stream/numeros', async (req, res) => {
+    if (!numerosCacheCargado) {
+        res.set('Retry-After', '5');
+        return res.status(503).json({ message: 'El stream de números no está disponible en este momento. Intenta de nuevo en unos segundos.' });
+    }
+    res.set({
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no' // Evitar que un proxy intermedio acumule los eventos
+    });
+    res.flushHeaders();
+    res.write(`retry: ${CAMBIOS_LISTENER_RETRY_MS}\n\n`);
+
+    const cliente = {
+        res,
+        congestionado: false,
+        drainTimer: null,
+        cambiosPendientes: new Map(),
+        estadoPendiente: null,
+        snapshotPendiente: true // El primer evento siempre es un snapshot
+    };
+    sseClientes.add(cliente);
+    res.on('drain', () => {
+        clearTimeout(cliente.drainTimer);
+        cliente.congestionado = false;
+        flushSSEClient(cliente);
+    });
+    req.on('close', () => {
+        clearTimeout(cliente.drainTimer);
+        sseClientes.delete(cliente);
+    });
+    await flushSSEClient(cliente);
+});
+
 // Actualizar estado de los números (usado internamente o por admin)
 app.post('/api/numeros', async (req, res) => {
     const updatedNumbers = req.body; // Array de objetos de números
@@ -1140,11 +4333,154 @@ app.post('/api/numeros', async (req, res) => {
     }
 });
 
+// INICIO DE NUEVA LÓGICA: ENDPOINTS DE RESERVAS TEMPORALES DE NÚMEROS
+const HOLD_DEFAULT_MINUTES = 10;
+const HOLD_MAX_MINUTES = 30;
+const HOLD_AUTO_MAX_NUMEROS = 100; // Máximo de números por selección automática
+const HOLD_AUTO_INTENTOS = 3; // Reintentos de la selección automática cuando otro comprador se adelanta
+
+// Reservar números por unos minutos mientras el comprador completa el pago.
+// Devuelve un token que luego se envía como 'tokenReserva' en POST /api/comprar.
+app.post('/api/reservas', async (req, res) => {
+    const { numeros, minutos, tokenReserva } = req.body;
+
+    if (!Array.isArray(numeros) || numeros.length === 0) {
+        return res.status(400).json({ message: 'Se requiere un array "numeros" con al menos un número para reservar.' });
+    }
+    const duracion = Math.min(Math.max(parseInt(minutos, 10) || HOLD_DEFAULT_MINUTES, 1), HOLD_MAX_MINUTES);
+    const token = tokenReserva || crypto.randomUUID();
+
+    const chequeoCache = checkNumerosInCache(numeros, token);
+    if (chequeoCache && chequeoCache.conflictos.length > 0) {
+        return res.status(409).json({ message: `Los números ${chequeoCache.conflictos.join(', ')} ya han sido comprados o están reservados. Por favor, selecciona otros.`, conflictos: chequeoCache.conflictos });
+    }
+
+    let client;
+    try {
+        client = await pool.connect();
+        await client.query('BEGIN');
+
+        const configuracion = await getConfiguracionFromDB(client);
+        if (configuracion.pagina_bloqueada) {
+            await client.query('ROLLBACK');
+            return res.status(403).json({ message: 'La página está bloqueada para nuevas compras en este momento.' });
+        }
+
+        const { reservados, conflictos, invalidos, expiresAt } = await holdNumerosInDB(client, numeros, token, duracion);
+
+        if (invalidos.length > 0) {
+            await client.query('ROLLBACK');
+            return res.status(400).json({ message: `Los números ${invalidos.join(', ')} no son válidos para esta rifa.`, invalidos });
+        }
+        if (conflictos.length > 0) {
+            await client.query('ROLLBACK');
+            return res.status(409).json({ message: `Los números ${conflictos.join(', ')} ya han sido comprados o están reservados. Por favor, selecciona otros.`, conflictos });
+        }
+
+        await client.query('COMMIT');
+        setHoldInCache(token, reservados, expiresAt);
+        res.status(200).json({ message: 'Números reservados con éxito.', tokenReserva: token, numeros: reservados, expiresAt });
+    } catch (error) {
+        if (client) await client.query('ROLLBACK');
+        console.error('ERROR_RESERVAS: Error al reservar números:', error.message);
+        res.status(500).json({ message: 'Error interno del servidor al reservar números.', error: error.message });
+    } finally {
+        if (client) client.release();
+    }
+});
+
+// Selección automática: el servidor elige al azar 'cantidad' números libres y los reserva de una vez,
+// así el comprador no elige sobre una grilla vieja. La compra se completa igual que con una reserva normal,
+// enviando el token como 'tokenReserva' en POST /api/comprar.
+// Si otro comprador tomó alguno de los elegidos antes que la DB los bloqueara, se descartan y se vuelve a elegir.
+app.post('/api/reservas/auto', async (req, res) => {
+    const { cantidad, minutos, tokenReserva } = req.body;
+    const solicitados = parseInt(cantidad, 10);
+
+    if (!Number.isInteger(solicitados) || solicitados < 1 || solicitados > HOLD_AUTO_MAX_NUMEROS) {
+        return res.status(400).json({ message: `Se requiere una "cantidad" de números entre 1 y ${HOLD_AUTO_MAX_NUMEROS}.` });
+    }
+    const duracion = Math.min(Math.max(parseInt(minutos, 10) || HOLD_DEFAULT_MINUTES, 1), HOLD_MAX_MINUTES);
+    const token = tokenReserva || crypto.randomUUID();
+    const descartados = new Set();
+
+    let client;
+    try {
+        client = await pool.connect();
+        for (let intento = 0; intento < HOLD_AUTO_INTENTOS; intento++) {
+            const candidatos = pickNumerosLibresFromCache(solicitados, descartados);
+            if (!candidatos) {
+                res.set('Retry-After', '5');
+                return res.status(503).json({ message: 'La selección automática no está disponible en este momento. Intenta de nuevo en unos segundos.' });
+            }
+            if (candidatos.length < solicitados) break;
+
+            await client.query('BEGIN');
+            const configuracion = await getConfiguracionFromDB(client);
+            if (configuracion.pagina_bloqueada) {
+                await client.query('ROLLBACK');
+                return res.status(403).json({ message: 'La página está bloqueada para nuevas compras en este momento.' });
+            }
+
+            const { reservados, conflictos, invalidos, expiresAt } = await holdNumerosInDB(client, candidatos, token, duracion);
+            if (conflictos.length > 0 || invalidos.length > 0) {
+                await client.query('ROLLBACK');
+                [...conflictos, ...invalidos].forEach(numero => descartados.add(numero));
+                console.warn(`DEBUG_RESERVAS: Selección automática con conflictos (${conflictos.concat(invalidos).join(', ')}); intento ${intento + 1} de ${HOLD_AUTO_INTENTOS}.`);
+                continue;
+            }
+
+            await client.query('COMMIT');
+            setHoldInCache(token, reservados, expiresAt);
+            return res.status(200).json({ message: 'Números elegidos y reservados con éxito.', tokenReserva: token, numeros: reservados, expiresAt });
+        }
+        const disponibles = numerosCacheCargado ? numerosCache.libres.size : 0;
+        res.status(409).json({ message: `No hay ${solicitados} números disponibles en este momento (quedan ${disponibles}).`, disponibles });
+    } catch (error) {
+        if (client) await client.query('ROLLBACK');
+        console.error('ERROR_RESERVAS: Error en la selección automática de números:', error.message);
+        res.status(500).json({ message: 'Error interno del servidor al elegir números.', error: error.message });
+    } finally {
+        if (client) client.release();
+    }
+});
+
+// Liberar una reserva antes de que venza (ej. el comprador abandonó el pago)
+app.delete('/api/reservas/:tokenReserva', async (req, res) => {
+    try {
+        const liberados = await releaseHoldInDB(req.params.tokenReserva);
+        clearHoldInCache(req.params.tokenReserva);
+        res.status(200).json({ message: 'Reserva liberada.', numeros: liberados });
+    } catch (error) {
+        console.error('ERROR_RESERVAS: Error al liberar la reserva:', error.message);
+        res.status(500).json({ message: 'Error interno del servidor al liberar la reserva.', error: error.message });
+    }
+});
+// FIN DE NUEVA LÓGICA: ENDPOINTS DE RESERVAS TEMPORALES DE NÚMEROS
+
 // Ruta para obtener ventas
+// Con ?limit= o ?cursor= responde una página { ventas, nextCursor } (de la más reciente a la más antigua);
+// sin ellos responde el array completo como antes. Filtros y ?campos= (proyección) aplican en ambos casos.
 app.get('/api/ventas', async (req, res) => {
+    const consulta = parseVentasConsulta(req.query);
+    if (consulta.error) {
+        return res.status(400).json({ message: consulta.error });
+    }
+    const paginado = req.query.limit !== undefined || req.query.cursor !== undefined;
+    let cursor = null;
+    if (req.query.cursor !== undefined) {
+        cursor = decodeVentasCursor(req.query.cursor);
+        if (!cursor) {
+            return res.status(400).json({ message: 'El parámetro "cursor" no es válido.' });
+        }
+    }
+    const limite = Math.min(Math.max(parseInt(req.query.limit, 10) || VENTAS_PAGINA_DEFECTO, 1), VENTAS_PAGINA_MAXIMA);
     try {
-        const ventas = await getVentasFromDB();
+        const { ventas, nextCursor } = await getVentasPageFromDB(consulta.filtros, consulta.columnas, paginado ? limite : null, cursor);
         console.log('Enviando ventas al frontend desde DB:', ventas.length, 'ventas.');
+        if (paginado) {
+            return res.status(200).json({ ventas, nextCursor });
+        }
         res.status(200).json(ventas);
     } catch (error) {
         console.error('Error al obtener ventas desde DB:', error.message);
@@ -1152,6 +4488,28 @@ app.get('/api/ventas', async (req, res) => {
     }
 });
 
+// Exportar ventas en streaming: ?formato=ndjson (por defecto) o csv, con los mismos filtros y ?campos= que GET /api/ventas
+app.get('/api/ventas/export', async (req, res) => {
+    const formato = req.query.formato === undefined ? 'ndjson' : String(req.query.formato);
+    if (!Object.hasOwn(VENTAS_EXPORT_FORMATOS, formato)) {
+        return res.status(400).json({ message: `Formato no soportado. Usa uno de: ${Object.keys(VENTAS_EXPORT_FORMATOS).join(', ')}.` });
+    }
+    const consulta = parseVentasConsulta(req.query);
+    if (consulta.error) {
+        return res.status(400).json({ message: consulta.error });
+    }
+    try {
+        const escritas = await streamVentasExport(res, consulta.filtros, consulta.columnas, formato);
+        console.log(`DEBUG_EXPORT: Exportación de ventas (${formato}) finalizada: ${escritas} ventas.`);
+    } catch (error) {
+        console.error('ERROR_EXPORT: Error al exportar ventas:', error.message);
+        if (!res.headersSent) {
+            res.status(500).json({ message: 'Error interno del servidor al exportar ventas.', error: error.message });
+        } else {
+            res.destroy(error); // Ya se enviaron datos: cortar la conexión para que el cliente no tome el archivo como completo
+        }
+    }
+});
 
 // Manejar solicitudes GET inesperadas a /api/compra
 app.get('/api/compra', (req, res) => {
@@ -1163,29 +4521,35 @@ app.get('/api/compra', (req, res) => {
 
 
 // Ruta para la compra de tickets
-app.post('/api/comprar', async (req, res) => {
+app.post('/api/comprar', idempotency(), async (req, res) => {
     console.log('DEBUG_BACKEND: Recibida solicitud POST /api/comprar.');
     const {
         numerosSeleccionados, valorUsd, valorBs, metodoPago, referenciaPago,
         comprador, telefono, horaSorteo,
+        tokenReserva, // Opcional: token de una reserva creada con POST /api/reservas
         // INICIO DE NUEVA LÓGICA: CAMPOS DEL VENDEDOR EN LA COMPRA
         sellerId, sellerName, sellerAgency
         // FIN DE NUEVA LÓGICA: CAMPOS DEL VENDEDOR EN LA COMPRA
     } = req.body;
 
-    if (!numerosSeleccionados || numerosSeleccionados.length === 0 || !valorUsd || !valorBs || !metodoPago || !comprador || !telefono || !horaSorteo) {
+    if (!Array.isArray(numerosSeleccionados) || numerosSeleccionados.length === 0 || !valorUsd || !valorBs || !metodoPago || !comprador || !telefono || !horaSorteo) {
         console.error('DEBUG_BACKEND: Faltan datos requeridos para la compra.');
         return res.status(400).json({ message: 'Faltan datos requeridos para la compra (números, valor, método de pago, comprador, teléfono, hora del sorteo).' });
     }
 
+    // Descartar sin ir a la DB los números que la caché ya sabe comprados o reservados por otro
+    const chequeoCache = checkNumerosInCache(numerosSeleccionados, tokenReserva || null);
+    if (chequeoCache && chequeoCache.conflictos.length > 0) {
+        console.warn(`DEBUG_BACKEND: Conflicto de números (caché): ${chequeoCache.conflictos.join(', ')}.`);
+        return res.status(409).json({ message: `Los números ${chequeoCache.conflictos.join(', ')} ya han sido comprados o están reservados. Por favor, selecciona otros.`, conflictos: chequeoCache.conflictos });
+    }
+
     let client;
     try {
         client = await pool.connect();
         await client.query('BEGIN'); // Iniciar transacción
 
-        let configuracion = await getConfiguracionFromDB();
-        let numeros = await getNumerosFromDB();
-        let ventas = await getVentasFromDB();
+        const configuracion = await getConfiguracionFromDB(client);
 
         if (configuracion.pagina_bloqueada) {
             console.warn('DEBUG_BACKEND: Página bloqueada, denegando compra.');
@@ -1193,52 +4557,32 @@ app.post('/api/comprar', async (req, res) => {
             return res.status(403).json({ message: 'La página está bloqueada para nuevas compras en este momento.' });
         }
 
-        const conflictos = numerosSeleccionados.filter(n =>
-            numeros.find(numObj => numObj.numero === n && numObj.comprado)
-        );
+        // Reclamar todos los números en una sola sentencia: o se marcan todos o ninguno.
+        const { conflictos, invalidos } = await claimNumerosInDB(client, numerosSeleccionados, configuracion.numero_sorteo_correlativo, tokenReserva || null);
 
-        if (conflictos.length > 0) {
-            console.warn(`DEBUG_BACKEND: Conflicto de números: ${conflictos.join(', ')} ya comprados.`);
+        if (invalidos.length > 0) {
+            console.warn(`DEBUG_BACKEND: Números inválidos en la compra: ${invalidos.join(', ')}.`);
             await client.query('ROLLBACK');
-            return res.status(409).json({ message: `Los números ${conflictos.join(', ')} ya han sido comprados. Por favor, selecciona otros.` });
+            return res.status(400).json({ message: `Los números ${invalidos.join(', ')} no son válidos para esta rifa.`, invalidos });
         }
 
-        for (const numSel of numerosSeleccionados) {
-            const numObjInDB = numeros.find(n => n.numero === numSel);
-            if (numObjInDB) {
-                await client.query(
-                    'UPDATE numeros SET comprado = TRUE, "originalDrawNumber" = $1 WHERE numero = $2', // Added quotes for consistency
-                    [configuracion.numero_sorteo_correlativo, numSel]
-                );
-            } else {
-                // Esto no debería pasar si los números se inicializan correctamente
-                await client.query(
-                    'INSERT INTO numeros (numero, comprado, "originalDrawNumber") VALUES ($1, TRUE, $2)', // Added quotes for consistency
-                    [numSel, configuracion.numero_sorteo_correlativo]
-                );
-            }
+        if (conflictos.length > 0) {
+            console.warn(`DEBUG_BACKEND: Conflicto de números: ${conflictos.join(', ')} ya comprados.`);
+            await client.query('ROLLBACK');
+            return res.status(409).json({ message: `Los números ${conflictos.join(', ')} ya han sido comprados o están reservados. Por favor, selecciona otros.`, conflictos });
         }
         console.log('DEBUG_BACKEND: Números actualizados en DB.');
 
         const now = moment().tz("America/Caracas");
         
-        // --- INICIO DE LA CORRECCIÓN PARA EL ERROR DE DUPLICATE KEY ---
-        // Incrementar y obtener el nuevo ultimo_numero_ticket de forma atómica
-        const updatedConfigRes = await client.query(
-            `UPDATE configuracion
-             SET ultimo_numero_ticket = COALESCE(ultimo_numero_ticket, 0) + 1
-             WHERE id = $1
-             RETURNING ultimo_numero_ticket;`,
-            [configuracion.id] // Asegúrate de que configuracion.id tenga el ID correcto de tu fila de configuración
-        );
-        const newUltimoNumeroSecuencial = updatedConfigRes.rows[0].ultimo_numero_ticket;
-        // Generar el ticketNumber incluyendo la fecha del sorteo
+        // Generar el ticketNumber incluyendo la fecha del sorteo; el secuencial sale de la secuencia de esa
+        // fecha sin bloquear la fila de 'configuracion'
         const formattedDrawDate = moment(configuracion.fecha_sorteo).format('YYYYMMDD');
+        const newUltimoNumeroSecuencial = await nextTicketSequenceNumber(formattedDrawDate);
         const numeroTicket = `${formattedDrawDate}-${newUltimoNumeroSecuencial.toString().padStart(5, '0')}`;
-        // --- FIN DE LA CORRECCIÓN ---
 
         const nuevaVenta = {
-            id: Date.now(), // Usar timestamp como ID único
+            id: generateId(), // ID de 64 bits ordenado por tiempo y único entre procesos
             purchaseDate: now.toISOString(),
             drawDate: configuracion.fecha_sorteo,
             drawTime: horaSorteo,
@@ -1260,46 +4604,25 @@ app.post('/api/comprar', async (req, res) => {
             // FIN DE NUEVA LÓGICA: CAMPOS DEL VENDEDOR EN LA NUEVA VENTA
         };
 
-        await insertVentaInDB(nuevaVenta);
+        await insertVentaInDB(nuevaVenta, client);
         console.log('DEBUG_BACKEND: Venta guardada en DB.');
 
-        // No es necesario actualizar ultimo_numero_ticket en configuracion aquí, ya se hizo atómicamente
+        // El número de ticket sale de 'secuencia_tickets'; 'ultimo_numero_ticket' en configuracion ya no se actualiza por compra.
         // Si otros campos de configuracion necesitaran ser actualizados en esta solicitud, irían aquí.
 
-        await client.query('COMMIT'); // Confirmar transacción
-
-        res.status(200).json({ message: 'Compra realizada con éxito!', ticket: nuevaVenta });
-        console.log('DEBUG_BACKEND: Respuesta de compra enviada al frontend.');
-
+        // Efectos secundarios (WhatsApp, umbral de ventas, Excel y correo) se encolan en la misma
+        // transacción: solo existen si la compra se confirma y no retrasan la respuesta.
         const whatsappMessageIndividual = `*¡Nueva Compra!*%0A%0A*Fecha Sorteo:* ${configuracion.fecha_sorteo}%0A*Hora Sorteo:* ${horaSorteo}%0A*Nro. Ticket:* ${numeroTicket}%0A*Comprador:* ${comprador}%0A*Teléfono:* ${telefono}%0A*Números:* ${numerosSeleccionados.join(', ')}%0A*Valor USD:* $${valorUsd}%0A*Valor Bs:* Bs ${valorBs}%0A*Método Pago:* ${metodoPago}%0A*Referencia:* ${referenciaPago}`;
-        await sendWhatsappNotification(whatsappMessageIndividual);
-        console.log('DEBUG_BACKEND: Proceso de compra en backend finalizado.');
+        await enqueueJob('notificacion_whatsapp', { mensaje: whatsappMessageIndividual }, client);
+        await enqueueJob('verificar_umbral_ventas', {}, client);
 
-        // Lógica de notificación por umbral de ventas
-        configuracion = await getConfiguracionFromDB(); // Recargar la más reciente
-        ventas = await getVentasFromDB(); // Recargar la más reciente
-
-        const currentTotalSales = ventas.filter(sale =>
-            sale.drawDate === configuracion.fecha_sorteo &&
-            (sale.validationStatus === 'Confirmado' || sale.validationStatus === 'Pendiente')
-        ).length;
-
-        const prevNotifiedCount = configuracion.last_sales_notification_count || 0;
-        const notificationThreshold = configuracion.sales_notification_threshold || 20;
-
-        const currentMultiple = Math.floor(currentTotalSales / notificationThreshold);
-        const prevMultiple = Math.floor(prevNotifiedCount / notificationThreshold);
-
-        if (currentMultiple > prevMultiple) {
-            console.log(`[WhatsApp Notificación Resumen] Ventas actuales (${currentTotalSales}) han cruzado un nuevo múltiplo (${currentMultiple * notificationThreshold}) del umbral (${notificationThreshold}). Enviando notificación de resumen.`);
-            await sendSalesSummaryNotifications();
+        await client.query('COMMIT'); // Confirmar transacción
+        kickJobWorker();
+        markNumerosInCache(numerosSeleccionados, true, configuracion.numero_sorteo_correlativo);
+        if (tokenReserva) clearHoldInCache(tokenReserva);
 
-            configuracion.last_sales_notification_count = currentMultiple * notificationThreshold;
-            await updateConfiguracionInDB(configuracion);
-            console.log(`[WhatsApp Notificación Resumen] Contador 'last_sales_notification_count' actualizado a ${currentMultiple * notificationThreshold} en DB.`);
-        } else {
-            console.log(`[WhatsApp Notificación Resumen Check] Ventas actuales (${currentTotalSales}) no han cruzado un nuevo múltiplo del umbral (${notificationThreshold}). Último contador notificado: ${prevNotifiedCount}. No se envió notificación de resumen.`);
-        }
+        res.status(200).json({ message: 'Compra realizada con éxito!', ticket: nuevaVenta });
+        console.log('DEBUG_BACKEND: Respuesta de compra enviada al frontend. Proceso de compra en backend finalizado.');
 
     } catch (error) {
         if (client) await client.query('ROLLBACK'); // Revertir en caso de error
@@ -1311,8 +4634,11 @@ app.post('/api/comprar', async (req, res) => {
 });
 
 // Subir comprobante de pago
-app.post('/api/upload-comprobante/:ventaId', async (req, res) => {
-    const ventaId = parseInt(req.params.ventaId);
+app.post('/api/upload-comprobante/:ventaId', idempotency(), async (req, res) => {
+    const ventaId = req.params.ventaId; // BIGINT: se maneja como string para no perder precisión
+    if (!/^\d+$/.test(ventaId)) {
+        return res.status(400).json({ message: 'ID de venta inválido.' });
+    }
     if (!req.files || Object.keys(req.files).length === 0) {
         return res.status(400).json({ message: 'No se subió ningún archivo.' });
     }
@@ -1347,12 +4673,12 @@ app.post('/api/upload-comprobante/:ventaId', async (req, res) => {
         await comprobanteFile.mv(filePath);
 
         // Actualizar la URL del comprobante en la venta
-        await updateVentaVoucherURLInDB(ventaId, `/uploads/comprobantes/${fileName}`); // Ajustar URL para el subdirectorio
+        await updateVentaVoucherURLInDB(ventaId, `/uploads/comprobantes/${fileName}`, client); // Ajustar URL para el subdirectorio
         console.log(`Voucher URL actualizado en DB para venta ${ventaId}.`);
 
         // Registrar en comprobantes (metadata)
         await insertComprobanteInDB({
-            id: Date.now(), // Nuevo ID para el registro de comprobante
+            id: generateId(), // Nuevo ID para el registro de comprobante
             ventaId: ventaId,
             comprador: ventaData.buyerName,
             telefono: ventaData.buyerPhone,
@@ -1360,38 +4686,19 @@ app.post('/api/upload-comprobante/:ventaId', async (req, res) => {
             comprobante_tipo: comprobanteFile.mimetype,
             fecha_compra: moment(ventaData.purchaseDate).format('YYYY-MM-DD'),
             url_comprobante: `/uploads/comprobantes/${fileName}` // Ajustar URL para el subdirectorio
-        });
+        }, client);
         console.log(`Comprobante registrado en DB.`);
 
-        await client.query('COMMIT'); // Confirmar transacción
+        // El correo a los administradores se envía en segundo plano desde la cola de tareas
+        await enqueueJob('correo_comprobante', {
+            ventaData,
+            fileName,
+            filePath,
+            mimetype: comprobanteFile.mimetype
+        }, client);
 
-        const configuracion = await getConfiguracionFromDB(); // Obtener la configuración más reciente
-        if (configuracion.admin_email_for_reports && configuracion.admin_email_for_reports.length > 0) {
-            const subject = `Nuevo Comprobante de Pago para Venta #${ventaData.ticketNumber}`;
-            const htmlContent = `
-                <p>Se ha subido un nuevo comprobante de pago para la venta con Ticket Nro. <strong>${ventaData.ticketNumber}</strong>.</p>
-                <p><b>Comprador:</b> ${ventaData.buyerName}</p>
-                <p><b>Teléfono:</b> ${ventaData.buyerPhone}</p>
-                <p><b>Números:</b> ${ventaData.numbers.join(', ')}</p>
-                <p><b>Monto USD:</b> $${(parseFloat(ventaData.valueUSD) || 0).toFixed(2)}</p>
-                <p><b>Monto Bs:</b> Bs ${(parseFloat(ventaData.valueBs) || 0).toFixed(2)}</p>
-                <p><b>Método de Pago:</b> ${ventaData.paymentMethod}</p>
-                <p><b>Referencia:</b> ${ventaData.paymentReference}</p>
-                <p>Haz clic <a href="${API_BASE_URL}/uploads/comprobantes/${fileName}" target="_blank">aquí</a> para ver el comprobante.</p>
-                <p>También puedes verlo en el panel de administración.</p>
-            `;
-            const attachments = [
-                {
-                    filename: fileName,
-                    path: filePath,
-                    contentType: comprobanteFile.mimetype
-                }
-            ];
-            const emailSent = await sendEmail(configuracion.admin_email_for_reports, subject, htmlContent, attachments);
-            if (!emailSent) {
-                console.error('Fallo al enviar el correo con el comprobante.');
-            }
-        }
+        await client.query('COMMIT'); // Confirmar transacción
+        kickJobWorker();
 
         res.status(200).json({ message: 'Comprobante subido y asociado con éxito.', url: `/uploads/comprobantes/${fileName}` });
     } catch (error) {
@@ -1421,14 +4728,19 @@ app.get('/api/horarios-zulia', async (req, res) => {
 // Endpoint para actualizar horarios de Zulia (y Chance)
 app.post('/api/horarios', async (req, res) => {
     const { tipo, horarios } = req.body;
-    if (!tipo || (tipo !== 'zulia' && tipo !== 'chance')) {
-        return res.status(400).json({ message: 'Tipo de lotería inválido. Debe ser "zulia" o "chance".' });
+    if (typeof tipo !== 'string' || !/^[a-z0-9_-]{1,50}$/i.test(tipo)) {
+        return res.status(400).json({ message: 'Tipo de lotería inválido (ej. "zulia" o "chance").' });
     }
-    if (!Array.isArray(horarios) || !horarios.every(h => typeof h === 'string')) {
-        return res.status(400).json({ message: 'Formato de horarios inválido. Espera un array de strings.' });
+    const horarioValido = h => typeof h === 'string' ||
+        (h && typeof h === 'object' && typeof h.hora === 'string' && (h.premio === undefined || (typeof h.premio === 'string' && h.premio.length <= 50)));
+    if (!Array.isArray(horarios) || !horarios.every(horarioValido)) {
+        return res.status(400).json({ message: 'Formato de horarios inválido. Espera un array de strings o de objetos { hora, premio }.' });
     }
     try {
-        await updateHorariosInDB(tipo, horarios); // Asumiendo que esta función maneja la lógica de la DB
+        const recalculos = await updateHorariosInDB(tipo, horarios); // Asumiendo que esta función maneja la lógica de la DB
+        if (recalculos > 0) {
+            kickJobWorker();
+        }
         const updatedHorarios = await getHorariosZuliaFromDB(); // Obtener los horarios actualizados para la respuesta
         console.log(`Horarios de ${tipo} actualizados en DB.`);
 
@@ -1486,6 +4798,7 @@ app.post('/api/resultados-sorteo', async (req, res) => {
     const now = moment().tz("America/Caracas");
     const currentDay = now.format('YYYY-MM-DD');
 
+    let client;
     try {
         const dataToSave = {
             fecha,
@@ -1494,8 +4807,22 @@ app.post('/api/resultados-sorteo', async (req, res) => {
             ultimaActualizacion: now.format('YYYY-MM-DD HH:mm:ss')
         };
 
-        await upsertResultadosZuliaInDB(dataToSave);
-        console.log('Resultados de sorteo guardados/actualizados en DB.');
+        // Guardar y encolar el cálculo de ganadores de las horas cambiadas en la misma transacción
+        client = await pool.connect();
+        await client.query('BEGIN');
+        const anteriores = await getResultadosZuliaFromDB(fecha, tipoLoteria, client, true);
+        await upsertResultadosZuliaInDB(dataToSave, client);
+        const horasCambiadas = horasConResultadosCambiados(anteriores.length > 0 ? anteriores[0].resultados : [], resultadosPorHora);
+        if (horasCambiadas.length > 0) {
+            await enqueueJob('calcular_ganadores', { fecha, tipoLoteria, horas: horasCambiadas }, client);
+        }
+        await client.query('COMMIT');
+        client.release();
+        client = null;
+        if (horasCambiadas.length > 0) {
+            kickJobWorker();
+        }
+        console.log(`Resultados de sorteo guardados/actualizados en DB. Horas con cambios: ${horasCambiadas.join(', ') || 'ninguna'}.`);
 
         if (fecha === currentDay && tipoLoteria === 'zulia') {
             let configuracion = await getConfiguracionFromDB();
@@ -1504,11 +4831,14 @@ app.post('/api/resultados-sorteo', async (req, res) => {
             console.log('Configuración (ultima_fecha_resultados_zulia) actualizada en DB.');
         }
 
-        res.status(200).json({ message: 'Resultados de sorteo guardados/actualizados con éxito.' });
+        res.status(200).json({ message: 'Resultados de sorteo guardados/actualizados con éxito.', horasRecalculadas: horasCambiadas });
     } catch (error) {
+        if (client) await client.query('ROLLBACK');
         console.error('Error al guardar/actualizar resultados de sorteo en DB:', error.message);
         console.error('Detalle del error:', error.stack);
         res.status(500).json({ message: 'Error interno del servidor al guardar/actualizar resultados de sorteo.', error: error.message });
+    } finally {
+        if (client) client.release();
     }
 });
 
@@ -1639,10 +4969,11 @@ async function generateDatabaseBackupZipBuffer() {
             // INICIO DE MODIFICACIÓN: Incluir campos de vendedor en la exportación de ventas
             { name: 'ventas', columns: ['id', '"purchaseDate"', '"drawDate"', '"drawTime"', '"drawNumber"', '"ticketNumber"', '"buyerName"', '"buyerPhone"', 'numbers', '"valueUSD"', '"valueBs"', '"paymentMethod"', '"paymentReference"', '"voucherURL"', '"validationStatus"', '"voidedReason"', '"voidedAt"', '"closedReason"', '"closedAt"', '"sellerId"', '"sellerName"', '"sellerAgency"'] },
             // FIN DE MODIFICACIÓN: Incluir campos de vendedor en la exportación de ventas
-            { name: 'horarios_zulia', columns: ['id', 'hora'] },
+            { name: 'horarios_zulia', columns: ['id', 'hora', 'tipo_loteria', 'premio_clave'] },
             { name: 'resultados_zulia', columns: ['id', 'data'] }, // 'data' is JSONB
             { name: 'premios', columns: ['id', 'data'] }, // 'data' is JSONB
             { name: 'ganadores', columns: ['id', 'data'] }, // 'data' is JSONB
+            { name: 'ganadores_tickets', columns: ['draw_date', 'draw_number', 'lottery_type', 'ticket_number', 'venta_id', 'buyer_name', 'buyer_phone', 'numbers', 'purchase_date', 'coincident_numbers', 'detalle_horas', 'premio_usd', 'premio_bs', 'estado_pago', 'pagado_at', 'pago_referencia', 'premio_usd_pagado', 'processed_at'] },
             { name: 'comprobantes', columns: ['id', '"ventaId"', 'comprador', 'telefono', 'comprobante_nombre', 'comprobante_tipo', 'fecha_compra', 'url_comprobante'] },
             // INICIO DE NUEVA LÓGICA: Incluir tabla de vendedores en el backup
             { name: 'sellers', columns: ['seller_id', 'full_name', 'id_card', 'agency_name', 'created_at', 'updated_at', 'commission_percentage', 'commission_draw_date', 'commission_value_usd', 'commission_value_bs'] }
@@ -1818,23 +5149,9 @@ app.post('/api/corte-ventas', async (req, res) => {
         }
 
         if (shouldResetNumbers) {
-            let numeros = await getNumerosFromDB();
-            const currentDrawCorrelativo = parseInt(configuracion.numero_sorteo_correlativo);
-            let changedCount = 0;
-
-            for (const num of numeros) {
-                if (num.comprado && num.originalDrawNumber < currentDrawCorrelativo - 1) { // Nota: 'originalDrawNumber' en minúsculas por DB
-                    await updateNumeroInDB(num.numero, false, null);
-                    changedCount++;
-                    console.log(`Número ${num.numero} liberado. Comprado originalmente para sorteo ${num.originalDrawNumber}, ahora en sorteo ${currentDrawCorrelativo}.`);
-                }
-            }
-
-            if (changedCount > 0) {
-                console.log(`Se liberaron ${changedCount} números antiguos en DB.`);
-            } else {
-                console.log('No hay números antiguos para liberar en este momento.');
-            }
+            // Los números de sorteos anteriores ya cuentan como libres por su generación (numero_vendido);
+            // aquí solo se adelanta la limpieza de sus filas.
+            await compactNumerosGeneracionesAntiguas();
         }
 
         res.status(200).json({ message: message });
@@ -1883,38 +5200,51 @@ app.post('/api/premios', async (req, res) => {
 
     const fechaFormateada = moment.tz(fechaSorteo, CARACAS_TIMEZONE).format('YYYY-MM-DD');
 
+    let client;
     try {
+        // Premios de cada clave (las de horarios_zulia.premio_clave); las tres clásicas siempre existen
+        const normalizarPremio = premio => premio ? {
+            tripleA: premio.tripleA || '',
+            tripleB: premio.tripleB || '',
+            valorTripleA: (parseFloat(premio.valorTripleA) || 0), // Ensure number
+            valorTripleB: (parseFloat(premio.valorTripleB) || 0)  // Ensure number
+        } : { tripleA: '', tripleB: '', valorTripleA: 0, valorTripleB: 0 };
         const premiosData = {
             fechaSorteo: fechaFormateada,
-            sorteo12PM: sorteo12PM ? {
-                tripleA: sorteo12PM.tripleA || '',
-                tripleB: sorteo12PM.tripleB || '',
-                valorTripleA: (parseFloat(sorteo12PM.valorTripleA) || 0), // Ensure number
-                valorTripleB: (parseFloat(sorteo12PM.valorTripleB) || 0)  // Ensure number
-            } : { tripleA: '', tripleB: '', valorTripleA: 0, valorTripleB: 0 },
-            sorteo3PM: sorteo3PM ? {
-                tripleA: sorteo3PM.tripleA || '',
-                tripleB: sorteo3PM.tripleB || '',
-                valorTripleA: (parseFloat(sorteo3PM.valorTripleA) || 0), // Ensure number
-                valorTripleB: (parseFloat(sorteo3PM.valorTripleB) || 0)  // Ensure number
-            } : { tripleA: '', tripleB: '', valorTripleA: 0, valorTripleB: 0 },
-            sorteo5PM: sorteo5PM ? {
-                tripleA: sorteo5PM.tripleA || '',
-                tripleB: sorteo5PM.tripleB || '',
-                valorTripleA: (parseFloat(sorteo5PM.valorTripleA) || 0), // Ensure number
-                valorTripleB: (parseFloat(sorteo5PM.valorTripleB) || 0)  // Ensure number
-            } : { tripleA: '', tripleB: '', valorTripleA: 0, valorTripleB: 0 }
+            sorteo12PM: normalizarPremio(sorteo12PM),
+            sorteo3PM: normalizarPremio(sorteo3PM),
+            sorteo5PM: normalizarPremio(sorteo5PM)
         };
+        Object.entries(req.body).forEach(([clave, premio]) => {
+            if (clave !== 'fechaSorteo' && !(clave in premiosData) && premio && typeof premio === 'object' && !Array.isArray(premio)) {
+                premiosData[clave] = normalizarPremio(premio);
+            }
+        });
 
-        await upsertPremiosInDB(premiosData);
-        console.log('Premios guardados/actualizados en DB.');
+        // Guardar y encolar el recálculo completo de los ganadores de la fecha en la misma transacción:
+        // los montos cambian en todas las horas, y si los resultados llegaron antes que los premios el
+        // cálculo anterior terminó sin premios
+        client = await pool.connect();
+        await client.query('BEGIN');
+        await upsertPremiosInDB(premiosData, client);
+        const recalculos = await encolarRecalculoGanadores(client, { fecha: fechaFormateada });
+        await client.query('COMMIT');
+        client.release();
+        client = null;
+        if (recalculos > 0) {
+            kickJobWorker();
+        }
+        console.log(`Premios guardados/actualizados en DB. Recálculos de ganadores encolados: ${recalculos}.`);
 
         res.status(200).json({ message: 'Premios guardados/actualizados con éxito.', premiosGuardados: premiosData });
 
     } catch (error) {
+        if (client) await client.query('ROLLBACK');
         console.error('Error al guardar premios en DB:', error.message);
         console.error('Detalle del error:', error.stack);
         res.status(500).json({ message: 'Error interno del servidor al guardar premios.', error: error.message });
+    } finally {
+        if (client) client.release();
     }
 });
 
@@ -1940,9 +5270,13 @@ app.post('/api/send-test-email', async (req, res) => {
 });
 
 app.put('/api/tickets/validate/:id', async (req, res) => {
-    const ventaId = parseInt(req.params.id);
+    const ventaId = req.params.id; // BIGINT: se maneja como string para no perder precisión
     const { validationStatus } = req.body;
 
+    if (!/^\d+$/.test(ventaId)) {
+        return res.status(400).json({ message: 'ID de venta inválido.' });
+    }
+
     const estadosValidos = ['Confirmado', 'Falso', 'Pendiente', 'Anulado por bajo porcentaje', 'Cerrado por Suficiencia de Ventas'];
     if (!validationStatus || !estadosValidos.includes(validationStatus)) {
         return res.status(400).json({ message: 'Estado de validación inválido. Debe ser "Confirmado", "Falso", "Pendiente", "Anulado por bajo porcentaje" o "Cerrado por Suficiencia de Ventas".' });
@@ -1964,19 +5298,21 @@ app.put('/api/tickets/validate/:id', async (req, res) => {
         ventaData.numbers = typeof ventaData.numbers === 'string' ? JSON.parse(ventaData.numbers) : ventaData.numbers;
 
 
-        await updateVentaStatusInDB(ventaId, validationStatus); // Actualiza el estado en la DB
+        await updateVentaStatusInDB(ventaId, validationStatus, null, null, null, null, client); // Actualiza el estado en la DB
 
+        let numerosLiberados = [];
         if (validationStatus === 'Falso' && oldValidationStatus !== 'Falso') {
-            const numerosAnulados = ventaData.numbers; // Ya es un array
-            if (numerosAnulados && numerosAnulados.length > 0) {
-                for (const numAnulado of numerosAnulados) {
-                    await updateNumeroInDB(numAnulado, false, null);
-                }
-                console.log(`Números ${numerosAnulados.join(', ')} de la venta ${ventaId} (marcada como Falsa) han sido puestos nuevamente disponibles en DB.`);
+            // Solo los números que siguen siendo de esta venta (ventas_numeros): no se liberan los ya revendidos
+            numerosLiberados = await releaseNumerosDeVentaInDB(ventaId, client);
+            if (numerosLiberados.length > 0) {
+                console.log(`Números ${numerosLiberados.join(', ')} de la venta ${ventaId} (marcada como Falsa) han sido puestos nuevamente disponibles en DB.`);
             }
         }
 
         await client.query('COMMIT');
+        if (numerosLiberados.length > 0) {
+            markNumerosInCache(numerosLiberados, false, null);
+        }
 
         res.status(200).json({ message: `Estado de la venta ${ventaId} actualizado a "${validationStatus}" con éxito.`, venta: { id: ventaId, ...ventaData, validationStatus: validationStatus } });
     } catch (error) {
@@ -2144,6 +5480,32 @@ app.post('/api/notify-winner', async (req, res) => {
 });
 
 
+// GET /api/tickets/by-number
+// Quién tiene un número en un sorteo (?numero=427&drawNumber=N; por defecto el sorteo actual).
+// El número se busca con los dígitos de cada espacio permitido ('427' también encuentra '0427' y '00427').
+app.get('/api/tickets/by-number', async (req, res) => {
+    const numero = typeof req.query.numero === 'string' ? req.query.numero.trim() : '';
+    const variantes = /^\d+$/.test(numero) ? variantesNumeroVendido(numero) : [];
+    if (variantes.length === 0) {
+        return res.status(400).json({ message: 'Número inválido. Debe tener solo dígitos y no más que los del mayor espacio de números.' });
+    }
+    if (req.query.drawNumber !== undefined && !/^\d+$/.test(String(req.query.drawNumber))) {
+        return res.status(400).json({ message: 'drawNumber inválido.' });
+    }
+
+    try {
+        const drawNumber = req.query.drawNumber !== undefined
+            ? parseInt(req.query.drawNumber, 10)
+            : (await getConfiguracionFromDB()).numero_sorteo_correlativo;
+        const ventas = await getVentasByNumerosFromDB(drawNumber, variantes);
+        res.status(200).json({ numero, drawNumber, ventas });
+    } catch (error) {
+        console.error('Error al buscar ventas por número en DB:', error.message);
+        res.status(500).json({ message: 'Error interno del servidor al buscar ventas por número.', error: error.message });
+    }
+});
+
+
 // POST /api/tickets/procesar-ganadores
 app.post('/api/tickets/procesar-ganadores', async (req, res) => {
     const { fecha, numeroSorteo, tipoLoteria } = req.body;
@@ -2153,101 +5515,17 @@ app.post('/api/tickets/procesar-ganadores', async (req, res) => {
     }
 
     try {
-        const ventas = await getVentasFromDB();
-        const resultadosZulia = (await pool.query('SELECT data FROM resultados_zulia WHERE (data->>\'fecha\')::text = $1 AND (data->>\'tipoLoteria\')::text = $2', [fecha, tipoLoteria])).rows.map(row => row.data);
-        const premios = await getPremiosFromDB(fecha);
-        const configuracion = await getConfiguracionFromDB();
-
-        const ticketsGanadoresParaEsteSorteo = [];
-
-        const resultadosDelDia = resultadosZulia.find(r =>
-            r.fecha === fecha && r.tipoLoteria.toLowerCase() === tipoLoteria.toLowerCase()
-        );
-
-        if (!resultadosDelDia || !resultadosDelDia.resultados || resultadosDelDia.resultados.length === 0) {
+        // Recalculo completo manual; al guardar resultados ya se recalculan solas las horas cambiadas
+        const resultado = await procesarGanadoresSorteo(fecha, parseInt(numeroSorteo, 10), tipoLoteria);
+        if (resultado.estado === 'sin_resultados') {
             return res.status(200).json({ message: 'No se encontraron resultados de sorteo para esta fecha y lotería para procesar ganadores.' });
         }
-
-        const premiosDelDia = premios; // getPremiosFromDB ya devuelve el objeto para la fecha
-        if (!premiosDelDia) {
+        if (resultado.estado === 'sin_premios') {
             return res.status(200).json({ message: 'No se encontraron configuraciones de premios para esta fecha para procesar ganadores.' });
         }
-
-        for (const venta of ventas) {
-            // Asegurarse de que venta.numbers sea un array (viene de JSONB)
-            const ventaNumbers = Array.isArray(venta.numbers) ? venta.numbers : JSON.parse(venta.numbers || '[]');
-
-            if (venta.drawDate === fecha && venta.drawNumber.toString() === numeroSorteo.toString()) {
-                let coincidentNumbers = [];
-                let totalPotentialPrizeUSD = 0;
-                let totalPotentialPrizeBs = 0;
-
-                resultadosDelDia.resultados.forEach(r => {
-                    const winningTripleA = r.tripleA ? r.tripleA.toString().padStart(3, '0') : null;
-                    const winningTripleB = r.tripleB ? r.tripleB.toString().padStart(3, '0') : null;
-
-                    let currentCoincidentNumbersForHour = [];
-
-                    if (winningTripleA && ventaNumbers.includes(winningTripleA)) {
-                        currentCoincidentNumbersForHour.push(parseInt(winningTripleA, 10));
-                    }
-                    if (winningTripleB && ventaNumbers.includes(winningTripleB)) {
-                        currentCoincidentNumbersForHour.push(parseInt(winningTripleB, 10));
-                    }
-
-                    if (currentCoincidentNumbersForHour.length > 0) {
-                        let prizeConfigForHour;
-                        if (r.hora.includes('12:45 PM')) {
-                            prizeConfigForHour = premiosDelDia.sorteo12PM;
-                        } else if (r.hora.includes('04:45 PM')) {
-                            prizeConfigForHour = premiosDelDia.sorteo3PM;
-                        } else if (r.hora.includes('07:05 PM')) {
-                            prizeConfigForHour = premiosDelDia.sorteo5PM;
-                        }
-
-                        if (prizeConfigForHour) {
-                            if (currentCoincidentNumbersForHour.includes(parseInt(winningTripleA, 10)) && (parseFloat(prizeConfigForHour.valorTripleA) || 0)) {
-                                totalPotentialPrizeUSD += (parseFloat(prizeConfigForHour.valorTripleA) || 0);
-                            }
-                            if (currentCoincidentNumbersForHour.includes(parseInt(winningTripleB, 10)) && (parseFloat(prizeConfigForHour.valorTripleB) || 0)) {
-                                totalPotentialPrizeUSD += (parseFloat(prizeConfigForHour.valorTripleB) || 0);
-                            }
-                        }
-                        coincidentNumbers = Array.from(new Set([...coincidentNumbers, ...currentCoincidentNumbersForHour]));
-                    }
-                });
-
-                if (coincidentNumbers.length > 0) {
-                    totalPotentialPrizeBs = totalPotentialPrizeUSD * configuracion.tasa_dolar[0]; // Acceder al valor numérico del array
-                    ticketsGanadoresParaEsteSorteo.push({
-                        ticketNumber: venta.ticketNumber,
-                        buyerName: venta.buyerName,
-                        buyerPhone: venta.buyerPhone,
-                        numbers: ventaNumbers, // Asegurarse de que sea el array
-                        drawDate: venta.drawDate,
-                        drawNumber: venta.drawNumber,
-                        purchaseDate: venta.purchaseDate,
-                        coincidentNumbers: coincidentNumbers,
-                        totalPotentialPrizeUSD: totalPotentialPrizeUSD,
-                        totalPotentialPrizeBs: totalPotentialPrizeBs
-                    });
-                }
-            }
-        }
-
-        const now = moment().tz(CARACAS_TIMEZONE).toISOString();
-        const newWinnersEntry = {
-            drawDate: fecha,
-            drawNumber: parseInt(numeroSorteo),
-            lotteryType: tipoLoteria,
-            winners: ticketsGanadoresParaEsteSorteo,
-            processedAt: now
-        };
-
-        await upsertGanadoresInDB(newWinnersEntry);
         console.log(`Ganadores para el sorteo ${numeroSorteo} de ${tipoLoteria} del ${fecha} guardados/actualizados en DB.`);
 
-        res.status(200).json({ message: 'Ganadores procesados y guardados con éxito.', totalGanadores: ticketsGanadoresParaEsteSorteo.length });
+        res.status(200).json({ message: 'Ganadores procesados y guardados con éxito.', totalGanadores: resultado.totalGanadores });
 
     } catch (error) {
         console.error('Error al procesar y guardar tickets ganadores en DB:', error.message);
@@ -2257,16 +5535,48 @@ app.post('/api/tickets/procesar-ganadores', async (req, res) => {
 
 
 // GET /api/tickets/ganadores
+// Con ?limit= o ?cursor= devuelve { ganadores, nextCursor } por fecha de compra; sin ellos, todos los ganadores del sorteo.
+// ?estadoPago= filtra por estado de pago. ?buyerPhone= devuelve los premios más recientes de un comprador (fecha, número
+// de sorteo y tipo de lotería no son necesarios en ese caso).
 app.get('/api/tickets/ganadores', async (req, res) => {
-    const { fecha, numeroSorteo, tipoLoteria } = req.query;
+    const { fecha, numeroSorteo, tipoLoteria, estadoPago, buyerPhone } = req.query;
+    const limite = Math.min(Math.max(parseInt(req.query.limit, 10) || GANADORES_PAGINA_DEFECTO, 1), GANADORES_PAGINA_MAXIMA);
+
+    if (buyerPhone) {
+        try {
+            const ganadores = await getGanadoresByPhoneFromDB(String(buyerPhone), limite);
+            return res.status(200).json({ ganadores });
+        } catch (error) {
+            console.error('Error al obtener ganadores por teléfono desde DB:', error.message);
+            return res.status(500).json({ message: 'Error interno del servidor al obtener ganadores.', error: error.message });
+        }
+    }
 
     if (!fecha || !numeroSorteo || !tipoLoteria) {
         return res.status(400).json({ message: 'Fecha, número de sorteo y tipo de lotería son requeridos.' });
     }
+    if (estadoPago !== undefined && !GANADORES_ESTADOS_CONSULTA.includes(estadoPago)) {
+        return res.status(400).json({ message: `Estado de pago no válido. Usa uno de: ${GANADORES_ESTADOS_CONSULTA.join(', ')}.` });
+    }
+    const paginado = req.query.limit !== undefined || req.query.cursor !== undefined;
+    let cursor = null;
+    if (req.query.cursor !== undefined) {
+        cursor = decodeGanadoresCursor(req.query.cursor);
+        if (!cursor) {
+            return res.status(400).json({ message: 'El parámetro "cursor" no es válido.' });
+        }
+    }
 
     try {
-        const ganadores = await getGanadoresFromDB(fecha, parseInt(numeroSorteo), tipoLoteria);
-        if (ganadores && ganadores.length > 0) {
+        const { ganadores, nextCursor } = await getGanadoresPageFromDB(fecha, parseInt(numeroSorteo), tipoLoteria, {
+            limite: paginado ? limite : null,
+            cursor,
+            estadoPago: estadoPago || null
+        });
+        if (paginado) {
+            return res.status(200).json({ ganadores, nextCursor });
+        }
+        if (ganadores.length > 0) {
             res.status(200).json({ ganadores: ganadores });
         } else {
             res.status(200).json({ ganadores: [], message: 'No se encontraron tickets ganadores procesados para esta consulta.' });
@@ -2277,34 +5587,60 @@ app.get('/api/tickets/ganadores', async (req, res) => {
     }
 });
 
-// Función para liberar números que ya excedieron la reserva de 2 sorteos
-async function liberateOldReservedNumbers(currentDrawCorrelativo) {
-    console.log(`[liberateOldReservedNumbers] Revisando números para liberar (correlativo actual: ${currentDrawCorrelativo})...`);
+// PUT /api/tickets/ganadores/:ticketNumber/pago
+// Marca un premio como pagado (o lo devuelve a pendiente) sin reescribir el resto de ganadores del sorteo.
+app.put('/api/tickets/ganadores/:ticketNumber/pago', async (req, res) => {
+    const { ticketNumber } = req.params;
+    const { fecha, numeroSorteo, tipoLoteria, estadoPago, referencia } = req.body;
+
+    if (!fecha || !numeroSorteo || !tipoLoteria) {
+        return res.status(400).json({ message: 'Fecha, número de sorteo y tipo de lotería son requeridos.' });
+    }
+    if (!GANADORES_ESTADOS_PAGO.includes(estadoPago)) {
+        return res.status(400).json({ message: `Estado de pago no válido. Usa uno de: ${GANADORES_ESTADOS_PAGO.join(', ')}.` });
+    }
 
-    const client = await pool.connect();
     try {
-        // Seleccionar números que cumplen la condición para ser liberados
-        const res = await client.query(
-            'SELECT numero FROM numeros WHERE comprado = TRUE AND "originalDrawNumber" < $1', // Added quotes for consistency
-            [currentDrawCorrelativo - 1]
-        );
-        const numbersToLiberate = res.rows.map(row => row.numero);
+        const ganador = await updateGanadorPagoInDB(fecha, parseInt(numeroSorteo, 10), tipoLoteria, ticketNumber, estadoPago, referencia || null);
+        if (!ganador) {
+            return res.status(404).json({ message: 'Ticket ganador no encontrado para este sorteo.' });
+        }
+        console.log(`DEBUG_GANADORES: Ticket ${ticketNumber} del sorteo ${numeroSorteo} (${fecha}) marcado como ${estadoPago}.`);
+        res.status(200).json({ message: 'Estado de pago actualizado.', ganador });
+    } catch (error) {
+        console.error('Error al actualizar el pago del ganador en DB:', error.message);
+        res.status(500).json({ message: 'Error interno del servidor al actualizar el pago del ganador.', error: error.message });
+    }
+});
 
-        if (numbersToLiberate.length > 0) {
-            // Actualizar el estado de esos números
-            await client.query(
-                'UPDATE numeros SET comprado = FALSE, "originalDrawNumber" = NULL WHERE numero = ANY($1::text[])', // Added quotes for consistency
-                [Array.from(numbersToLiberate)]
+// Los números de sorteos ya pasados quedan libres en cuanto avanza el correlativo (numero_vendido),
+// sin UPDATE masivo en el avance. Esta compactación borra después las filas que ya no están vendidas
+// (un número sin fila está disponible), así 'numeros' crece con lo vendido y no con el espacio de números.
+// Trabaja en lotes pequeños y salta filas bloqueadas, para no competir con los compradores.
+const NUMEROS_COMPACTACION_LOTE = 200;
+
+async function compactNumerosGeneracionesAntiguas() {
+    let compactados = 0;
+    try {
+        while (true) {
+            const res = await pool.query(
+                `DELETE FROM numeros
+                 WHERE numero IN (
+                     SELECT numero FROM numeros
+                     WHERE NOT numero_vendido(comprado, "originalDrawNumber")
+                     LIMIT $1
+                     FOR UPDATE SKIP LOCKED
+                 )`,
+                [NUMEROS_COMPACTACION_LOTE]
             );
-            console.log(`Se liberaron ${numbersToLiberate.length} números antiguos en DB.`);
-        } else {
-            console.log('No hay números antiguos para liberar en este momento.');
+            compactados += res.rowCount;
+            if (res.rowCount < NUMEROS_COMPACTACION_LOTE) break;
+        }
+        if (compactados > 0) {
+            console.log(`[compactNumerosGeneracionesAntiguas] ${compactados} filas de números ya no vendidos eliminadas en DB.`);
         }
     } catch (error) {
-        console.error('Error al liberar números antiguos en DB:', error.message);
-        throw error; // Propagar el error para que sea manejado por el llamador
-    } finally {
-        client.release();
+        console.error('Error al compactar números de sorteos anteriores en DB:', error.message);
     }
 }
 
@@ -2337,19 +5673,15 @@ async function evaluateDrawStatusOnly(nowMoment) {
     let client;
     try {
         client = await pool.connect();
-        let configuracion = await getConfiguracionFromDB();
-        let ventas = await getVentasFromDB();
+        let configuracion = await getConfiguracionFromDB(client);
 
         const currentDrawDateStr = configuracion.fecha_sorteo;
 
-        const soldTicketsForCurrentDraw = ventas.filter(venta =>
-            venta.drawDate === currentDrawDateStr &&
-            (venta.validationStatus === 'Confirmado' || venta.validationStatus === 'Pendiente')
-        );
-        const totalSoldTicketsCount = soldTicketsForCurrentDraw.length;
+        const { tickets: totalSoldTicketsCount } = await getSalesTotalsFromDB(currentDrawDateStr, ESTADOS_VENTA_ACTIVOS, client);
+        let soldTicketsForCurrentDraw = [];
 
 
-        const totalPossibleTickets = TOTAL_RAFFLE_NUMBERS;
+        const totalPossibleTickets = createNumerosEspacio(configuracion.total_numeros).total;
         const soldPercentage = (totalSoldTicketsCount / totalPossibleTickets) * 100;
 
         console.log(`[evaluateDrawStatusOnly] Ventas (${soldPercentage.toFixed(2)}%) por debajo del ${SALES_THRESHOLD_PERCENTAGE}% requerido. Marcando tickets como anulados.`);
@@ -2363,9 +5695,7 @@ async function evaluateDrawStatusOnly(nowMoment) {
         if (soldPercentage < SALES_THRESHOLD_PERCENTAGE) {
             console.log(`[evaluateDrawStatusOnly] Ventas (${soldPercentage.toFixed(2)}%) por debajo del ${SALES_THRESHOLD_PERCENTAGE}% requerido. Marcando tickets como anulados.`);
 
-            for (const venta of soldTicketsForCurrentDraw) {
-                await updateVentaStatusInDB(venta.id, 'Anulado por bajo porcentaje', 'Ventas insuficientes para el sorteo', nowMoment.toISOString(), null, null);
-            }
+            soldTicketsForCurrentDraw = await updateVentasStatusByDrawInDB(currentDrawDateStr, ESTADOS_VENTA_ACTIVOS, 'Anulado por bajo porcentaje', 'Ventas insuficientes para el sorteo', nowMoment.toISOString(), null, null, client);
             message = `Sorteo del ${currentDrawDateStr} marcado como anulado por ventas insuficientes.`;
             whatsappMessageContent = `*¡Alerta de Sorteo Suspendido!* 🚨\n\nEl sorteo del *${currentDrawDateStr}* ha sido *ANULADO* debido a un bajo porcentaje de ventas (${soldPercentage.toFixed(2)}%).\n\nTodos los tickets válidos para este sorteo serán revalidados automáticamente para el próximo sorteo.`;
             emailSubject = `ALERTA: Sorteo Anulado - ${currentDrawDateStr}`;
@@ -2391,9 +5721,7 @@ async function evaluateDrawStatusOnly(nowMoment) {
         } else {
             console.log(`[evaluateDrawStatusOnly] Ventas (${soldPercentage.toFixed(2)}%) cumplen o superan el ${SALES_THRESHOLD_PERCENTAGE}%. Marcando tickets como cerrados.`);
 
-            for (const venta of soldTicketsForCurrentDraw) {
-                await updateVentaStatusInDB(venta.id, 'Cerrado por Suficiencia de Ventas', null, null, 'Ventas suficientes para el sorteo', nowMoment.toISOString());
-            }
+            soldTicketsForCurrentDraw = await updateVentasStatusByDrawInDB(currentDrawDateStr, ESTADOS_VENTA_ACTIVOS, 'Cerrado por Suficiencia de Ventas', null, null, 'Ventas suficientes para el sorteo', nowMoment.toISOString(), client);
             message = `Sorteo del ${currentDrawDateStr} marcado como cerrado por suficiencia de ventas.`;
             whatsappMessageContent = `*¡Sorteo Cerrado Exitosamente!* ✅\n\nEl sorteo del *${currentDrawDateStr}* ha sido *CERRADO* con éxito. Se alcanzó el porcentaje de ventas (${soldPercentage.toFixed(2)}%) requerido.`;
             emailSubject = `NOTIFICACIÓN: Sorteo Cerrado Exitosamente - ${currentDrawDateStr}`;
@@ -2415,7 +5743,7 @@ async function evaluateDrawStatusOnly(nowMoment) {
                 'Reporte_Cierre'
             );
         }
-        await updateConfiguracionInDB(configuracion); // Guardar cambios en configuracion en DB
+        await updateConfiguracionInDB(configuracion, client); // Guardar cambios en configuracion en DB
         console.log('[evaluateDrawStatusOnly] Estado de ventas y configuración actualizados en DB.');
 
         await sendWhatsappNotification(whatsappMessageContent);
@@ -2460,8 +5788,10 @@ async function cerrarSorteoManualmente(nowMoment) {
             return evaluationResult;
         }
 
-        await liberateOldReservedNumbers(currentDrawCorrelativo);
-
+        // Los números de sorteos anteriores quedan libres al avanzar el correlativo (ver numero_vendido).
+        // Antes este cierre liberaba con el correlativo previo al avance y conservaba tres sorteos hasta el
+        // siguiente avance; ahora, como en /api/set-manual-draw-date, quedan vendidos solo el sorteo que
+        // se cierra y el nuevo (NUMEROS_GENERACIONES_VIGENTES).
         const nextDayDate = nowMoment.clone().add(1, 'days').format('YYYY-MM-DD');
         configuracion = await advanceDrawConfiguration(configuracion, nextDayDate); // Actualizar 'configuracion' después de avanzar
 
@@ -2567,8 +5897,6 @@ app.post('/api/set-manual-draw-date', async (req, res) => {
 
         configuracion = await advanceDrawConfiguration(configuracion, newDrawDate); // Actualizar 'configuracion' después de avanzar
 
-        await liberateOldReservedNumbers(configuracion.numero_sorteo_correlativo);
-
         const ventas = await getVentasFromDB();
         const salesForOldDraw = ventas.filter(venta =>
             venta.drawDate === oldDrawDate &&
@@ -2630,18 +5958,12 @@ app.post('/api/developer-sales-notification', async (req, res) => {
     console.log('API: Recibida solicitud para notificación de ventas para desarrolladores.');
     try {
         const configuracion = await getConfiguracionFromDB();
-        const ventas = await getVentasFromDB();
 
         const now = moment().tz(CARACAS_TIMEZONE);
 
         const currentDrawDateStr = configuracion.fecha_sorteo;
-        const ventasParaFechaSorteo = ventas.filter(venta =>
-            venta.drawDate === currentDrawDateStr &&
-            (venta.validationStatus === 'Confirmado' || venta.validationStatus === 'Pendiente')
-        );
-
-        const totalVentas = ventasParaFechaSorteo.length;
-        const totalPossibleTickets = TOTAL_RAFFLE_NUMBERS;
+        const { tickets: totalVentas } = await getSalesTotalsFromDB(currentDrawDateStr);
+        const totalPossibleTickets = createNumerosEspacio(configuracion.total_numeros).total;
         const soldPercentage = (totalVentas / totalPossibleTickets) * 100;
 
         let messageText = `*Notificación de Ventas para Desarrolladores*\n\n`;
@@ -2836,21 +6158,17 @@ app.post('/api/admin/limpiar-datos', async (req, res) => {
         await client.query('BEGIN'); // Iniciar transacción
 
         // Resetear números
-        await client.query('TRUNCATE TABLE numeros RESTART IDENTITY;');
-        const initialNumbers = [];
-        for (let i = 0; i < TOTAL_RAFFLE_NUMBERS; i++) {
-            const numStr = i.toString().padStart(3, '0');
-            initialNumbers.push({ numero: numStr, comprado: false, originalDrawNumber: null });
-        }
-        for (const num of initialNumbers) {
-            await client.query('INSERT INTO numeros (numero, comprado, "originalDrawNumber") VALUES ($1, $2, $3)', [num.numero, num.comprado, num.originalDrawNumber]);
-        }
+        await client.query('TRUNCATE TABLE numeros RESTART IDENTITY;'); // Sin filas, toda la grilla queda disponible
 
         // Limpiar ventas, resultados, ganadores, comprobantes y vendedores
         await client.query('TRUNCATE TABLE ventas RESTART IDENTITY CASCADE;'); // CASCADE para eliminar referencias
         await client.query('TRUNCATE TABLE resultados_zulia RESTART IDENTITY;');
         await client.query('TRUNCATE TABLE ganadores RESTART IDENTITY;');
+        await client.query('TRUNCATE TABLE ganadores_tickets;');
         await client.query('TRUNCATE TABLE comprobantes RESTART IDENTITY;');
+        await client.query('TRUNCATE TABLE secuencia_tickets;'); // Reiniciar la numeración de tickets
+        await client.query('TRUNCATE TABLE contadores_ventas;'); // TRUNCATE no dispara el trigger de contadores
+        await client.query('TRUNCATE TABLE reservas_numeros;'); // Descartar reservas temporales
         await client.query('TRUNCATE TABLE premios RESTART IDENTITY;'); // También limpiar premios
         await client.query('TRUNCATE TABLE sellers RESTART IDENTITY;'); // NUEVO: Limpiar tabla de vendedores
         await client.query('TRUNCATE TABLE sorteos_historial RESTART IDENTITY;'); // Limpiar historial de sorteos
@@ -2863,7 +6181,7 @@ app.post('/api/admin/limpiar-datos', async (req, res) => {
         console.log('Archivos de comprobantes en /uploads/comprobantes eliminados.');
 
         // Resetear configuración a valores iniciales (o un estado limpio)
-        const configuracion = await getConfiguracionFromDB(); // Obtener la configuración actual para mantener mail/whatsapp
+        const configuracion = await getConfiguracionFromDB(client); // Obtener la configuración actual para mantener mail/whatsapp
         const resetConfig = {
             id: configuracion.id, // Mantener el ID de la configuración
             tasa_dolar: [36.50], // Corregido: Array para JSONB
@@ -2886,9 +6204,12 @@ app.post('/api/admin/limpiar-datos', async (req, res) => {
             sales_notification_threshold: 20,
             block_reason_message: ""
         };
-        await updateConfiguracionInDB(resetConfig);
+        await updateConfiguracionInDB(resetConfig, client);
+        // Los demás procesos descartan sus bloques de tickets al confirmarse (ver startCambiosListener)
+        await client.query('SELECT pg_notify($1, $2)', [CONFIGURACION_NOTIFY_CHANNEL, TICKET_SEQUENCE_RESET_PAYLOAD]);
 
         await client.query('COMMIT'); // Confirmar transacción
+        resetTicketSequenceBlocks(); // Descartar bloques de tickets reservados antes del reseteo
 
         res.status(200).json({ message: 'Todos los datos de la aplicación han sido limpiados y reseteados.' });
         console.log('Todos los datos de la aplicación han sido limpiados y reseteados.');
@@ -2983,6 +6304,31 @@ cron.schedule('*/55 * * * *', dailyDatabaseBackupCronJob, {
 });
 
 
+// Eliminar reservas de números vencidas (ya se ignoran al comprar; esto solo mantiene la tabla pequeña)
+cron.schedule('* * * * *', purgeExpiredHoldsInDB, {
+    timezone: CARACAS_TIMEZONE
+});
+
+// Limpiar en segundo plano las filas de números de sorteos anteriores (ya libres por generación)
+cron.schedule('*/15 * * * *', compactNumerosGeneracionesAntiguas, {
+    timezone: CARACAS_TIMEZONE
+});
+
+// Reconciliar la caché de números con la DB por si se perdió algún NOTIFY
+cron.schedule('*/2 * * * *', reconcileNumerosCache, {
+    timezone: CARACAS_TIMEZONE
+});
+
+// Recortar el registro de cambios de la grilla (GET /api/numeros?since=)
+cron.schedule('40 * * * *', purgeNumerosCambiosLog, {
+    timezone: CARACAS_TIMEZONE
+});
+
+// Eliminar claves de idempotencia vencidas
+cron.schedule('30 * * * *', purgeExpiredIdempotencyKeysInDB, {
+    timezone: CARACAS_TIMEZONE
+});
+
 // Cron jobs para la limpieza de datos antiguos
 cron.schedule('0 3 * * *', async () => { // Cada día a las 03:00 AM
     console.log('CRON JOB: Ejecutando limpieza de datos antiguos.');
@@ -3011,33 +6357,13 @@ async function cleanOldSalesAndRaffleNumbers(daysToRetain = 30) {
     try {
         await client.query('BEGIN');
 
-        // Obtener IDs de ventas antiguas
-        const oldSalesRes = await client.query('SELECT id, numbers FROM ventas WHERE "purchaseDate"::date < $1', [cutoffDate]);
-        const oldSales = oldSalesRes.rows;
-
-        console.log(`INFO_CLEANUP: Encontradas ${oldSales.length} ventas antiguas para procesar.`);
-
-        // Actualizar el estado 'comprado' de los números de rifa asociados a estas ventas antiguas
-        const numbersToUpdate = new Set();
-        oldSales.forEach(sale => {
-            // Asegurarse de que sale.numbers sea un array (viene de JSONB)
-            const saleNumbers = Array.isArray(sale.numbers) ? sale.numbers : JSON.parse(sale.numbers || '[]');
-            saleNumbers.forEach(num => numbersToUpdate.add(num));
-        });
-
-        if (numbersToUpdate.size > 0) {
-            console.log(`INFO_CLEANUP: Procesando ${numbersToUpdate.size} números de rifa para posible actualización.`);
-            await client.query(
-                'UPDATE numeros SET comprado = FALSE, "originalDrawNumber" = NULL WHERE numero = ANY($1::text[])', // Added quotes for consistency
-                [Array.from(numbersToUpdate)]
-            );
-            console.log('INFO_CLEANUP: Números de rifa asociados a ventas antiguas actualizados (comprado: false).');
-        } else {
-            console.log('INFO_CLEANUP: No hay números de rifa para actualizar de ventas antiguas.');
-        }
+        // Los números de estas ventas ya quedaron libres por generación al avanzar los sorteos
+        // (numero_vendido); sus filas las limpia compactNumerosGeneracionesAntiguas. Sus filas de
+        // 'ventas_numeros' se borran en cascada con cada venta (por el índice sobre venta_id).
 
-        // Eliminar las ventas antiguas
-        const deleteSalesRes = await client.query('DELETE FROM ventas WHERE "purchaseDate"::date < $1', [cutoffDate]);
+        // Eliminar las ventas antiguas. Equivale a "purchaseDate"::date < $1, pero sin el cast puede usar
+        // el índice sobre "purchaseDate".
+        const deleteSalesRes = await client.query('DELETE FROM ventas WHERE "purchaseDate" < $1::date', [cutoffDate]);
         console.log(`INFO_CLEANUP: Total de ventas antiguas eliminadas: ${deleteSalesRes.rowCount}.`);
 
         await client.query('COMMIT');
@@ -3061,7 +6387,9 @@ async function cleanOldDrawResults(daysToRetain = 60) {
 
     const client = await pool.connect();
     try {
-        const deleteRes = await client.query('DELETE FROM resultados_zulia WHERE (data->>\'fecha\')::date < $1', [cutoffDate]);
+        // Las fechas se guardan como 'YYYY-MM-DD', así que comparar el texto equivale a comparar fechas
+        // y usa el índice único sobre (data->>'fecha') (el cast a DATE no es indexable).
+        const deleteRes = await client.query('DELETE FROM resultados_zulia WHERE (data->>\'fecha\') < $1', [cutoffDate]);
         console.log(`INFO_CLEANUP: Total de resultados de sorteos antiguos eliminados: ${deleteRes.rowCount}.`);
     } catch (error) {
         console.error('ERROR_CLEANUP: Error durante la limpieza de resultados de sorteos:', error.message);
@@ -3081,7 +6409,8 @@ async function cleanOldPrizes(daysToRetain = 60) {
 
     const client = await pool.connect();
     try {
-        const deleteRes = await client.query('DELETE FROM premios WHERE (data->>\'fechaSorteo\')::date < $1', [cutoffDate]);
+        // Comparación de texto 'YYYY-MM-DD' para usar el índice único sobre (data->>'fechaSorteo')
+        const deleteRes = await client.query('DELETE FROM premios WHERE (data->>\'fechaSorteo\') < $1', [cutoffDate]);
         console.log(`INFO_CLEANUP: Total de premios antiguos eliminados: ${deleteRes.rowCount}.`);
     } catch (error) {
         console.error('ERROR_CLEANUP: Error durante la limpieza de premios:', error.message);
@@ -3101,8 +6430,10 @@ async function cleanOldWinners(daysToRetain = 60) {
 
     const client = await pool.connect();
     try {
-        const deleteRes = await client.query('DELETE FROM ganadores WHERE (data->>\'drawDate\')::date < $1', [cutoffDate]);
-        console.log(`INFO_CLEANUP: Total de ganadores antiguos eliminados: ${deleteRes.rowCount}.`);
+        // Comparación de texto 'YYYY-MM-DD' para usar los índices que empiezan por (data->>'drawDate')
+        const deleteRes = await client.query('DELETE FROM ganadores WHERE (data->>\'drawDate\') < $1', [cutoffDate]);
+        const deleteTicketsRes = await client.query('DELETE FROM ganadores_tickets WHERE draw_date < $1::date', [cutoffDate]);
+        console.log(`INFO_CLEANUP: Total de ganadores antiguos eliminados: ${deleteRes.rowCount} sorteos, ${deleteTicketsRes.rowCount} tickets.`);
     } catch (error) {
         console.error('ERROR_CLEANUP: Error durante la limpieza de ganadores:', error.message);
     } finally {
@@ -3119,10 +6450,14 @@ async function cleanOldWinners(daysToRetain = 60) {
         console.log('DEBUG: Directorios asegurados.');
         await ensureTablesExist(); // Asegurar que las tablas de la DB existan
         console.log('DEBUG: Tablas de la DB verificadas/creadas.');
+        await initIdGenerator(); // Arrendar un ID de nodo para generar IDs de ventas y comprobantes
+        console.log('DEBUG: Generador de IDs inicializado.');
         await loadInitialData(); // Cargar o inicializar datos desde la DB
         console.log('DEBUG: Datos iniciales cargados.');
+        await startCambiosListener(); // Cachés de números y configuración (si falla, se lee de la DB y se reintenta)
         await configureMailer(); // Configurar el mailer después de cargar la configuración de DB
         console.log('DEBUG: Mailer configurado.');
+        startJobWorker(); // Procesar tareas en segundo plano (incluidas las pendientes de antes del reinicio)
         app.listen(port, () => {
             console.log(`Servidor de la API escuchando en el puerto ${port}`);
             console.log(`URL Base de la API: ${API_BASE_URL}`);